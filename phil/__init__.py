@@ -20,4 +20,10 @@
 from phil.check import Phil
 from phil._version import __version__, __releasedate__
 from phil.util import err, out, wrap_paragraphs, get_template
-from phil.cmdline import main
+
+
+def main(argv):
+    """Runs phil-cmd with argv.  See :py:func:`phil.cmdline.main`."""
+    # Imported here so using phil as a library doesn't load argparse.
+    from phil.cmdline import main
+    return main(argv)
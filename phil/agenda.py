@@ -0,0 +1,177 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Lists upcoming occurrences of many events in order.
+
+Each event gets an iterator over its occurrences and the iterators are
+merged with a heap, so an agenda streams out without expanding more of
+any rule than it shows.  An agenda with an end date expands every
+event's occurrences before it at once with :py:mod:`phil.expand`
+instead.
+"""
+
+import csv
+import heapq
+import json
+from collections import namedtuple
+
+import dateutil.rrule
+
+from phil.util import align, format_date, to_local
+
+
+FORMATS = ('text', 'json', 'csv')
+
+
+Item = namedtuple('Item', ['date', 'calendar', 'event', 'reminded'])
+
+
+def iter_occurrences(event, start):
+    """Yields the occurrences of event at or after start in order.
+
+    dateutil works out occurrences from the rule's dtstart, so for an
+    old event the rule is rebuilt to start at its first occurrence
+    after start.  That's the same series unless the rule has a COUNT.
+
+    """
+    first = event.rrule.after(align(start, event.rrule), inc=True)
+    if first is None:
+        return
+
+    rule = event.rrule
+    if event.rule_args is not None and 'count' not in event.rule_args[1]:
+        freq, args = event.rule_args
+        rule = dateutil.rrule.rrule(freq, **dict(args, dtstart=first))
+
+    for date in rule:
+        if date >= first:
+            yield date
+
+
+def tag(dates, seq, calendar, event):
+    # Events can be in different timezones or floating, so they're
+    # merged by local time.  The sequence number keeps heapq.merge from
+    # comparing events.
+    for date in dates:
+        yield to_local(date), seq, date, calendar, event
+
+
+def expand(sources, start, end):
+    """Returns (date, calendar, event) for every occurrence of the events
+    in sources in [start, end), sorted by date.
+
+    """
+    from phil.expand import expand_windows
+
+    owners = []
+    windows = []
+    for calendar, events in sources:
+        for event in events:
+            owners.append((calendar, event))
+            windows.append((event, start, end))
+
+    occurrences = []
+    for seq, dates in enumerate(expand_windows(windows)):
+        calendar, event = owners[seq]
+        occurrences.extend([(to_local(date), seq, date, calendar, event)
+                            for date in dates])
+    occurrences.sort(key=lambda occurrence: occurrence[:2])
+    return [(date, calendar, event)
+            for local, seq, date, calendar, event in occurrences]
+
+
+def merge(sources, start, end=None, count=None):
+    """Yields (date, calendar, event) for every occurrence of the
+    events in sources, sorted by date.
+
+    :arg sources: list of (calendar, events) tuples
+    :arg start: the earliest occurrence to include
+    :arg end: stop before this date
+    :arg count: stop after this many occurrences
+
+    """
+    if end is not None:
+        occurrences = expand(sources, start, end)
+    else:
+        iterators = []
+        for calendar, events in sources:
+            for event in events:
+                iterators.append(tag(iter_occurrences(event, start),
+                                     len(iterators), calendar, event))
+        occurrences = (
+            (date, calendar, event)
+            for local, seq, date, calendar, event in heapq.merge(*iterators))
+
+    for i, occurrence in enumerate(occurrences):
+        if count is not None and i >= count:
+            return
+        yield occurrence
+
+
+def encode(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def write_text(items, stream):
+    for item in items:
+        line = u'{0}  {1}'.format(format_date(item.date), item.event.summary)
+        if item.calendar != 'default':
+            line = u'{0}  [{1}]'.format(line, item.calendar)
+        if item.reminded:
+            line += u' (sent reminder already)'
+        stream.write(encode(line) + '\n')
+
+
+def to_dict(item):
+    return {
+        'date': item.date.isoformat(),
+        'calendar': item.calendar,
+        'summary': item.event.summary,
+        'event_id': item.event.event_id,
+        'reminded': item.reminded
+        }
+
+
+def write_json(items, stream):
+    # Written an item at a time so long agendas stream.
+    stream.write('[')
+    for i, item in enumerate(items):
+        if i:
+            stream.write(',')
+        stream.write('\n' + json.dumps(to_dict(item), sort_keys=True))
+    stream.write('\n]\n')
+
+
+def write_csv(items, stream):
+    fields = ['date', 'calendar', 'summary', 'event_id', 'reminded']
+    writer = csv.writer(stream)
+    writer.writerow(fields)
+    for item in items:
+        data = to_dict(item)
+        writer.writerow([encode(data[field]) for field in fields])
+
+
+WRITERS = {
+    'text': write_text,
+    'json': write_json,
+    'csv': write_csv
+    }
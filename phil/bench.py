@@ -0,0 +1,252 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Benchmarks for the stages of a phil run: parsing the ics file,
+converting rrules, working out which events need reminders, expanding
+the occurrence index's windows, rendering messages and sending them to
+a local stub SMTP server.
+"""
+
+import asyncore
+import datetime
+import os
+import random
+import resource
+import shutil
+import smtpd
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+import icalendar
+
+from phil.expand import expand_windows
+from phil.ics import convert_rrule, iter_ics
+from phil.index import WINDOW
+from phil.mailer import Mailer
+from phil.template import render as render_template
+from phil.util import (
+    out, get_next_date, should_remind, format_date)
+
+
+# (weight, RRULE) pairs used to build synthetic calendars
+RULE_MIX = [
+    (3, 'FREQ=WEEKLY;INTERVAL={weeks}'),
+    (1, 'FREQ=WEEKLY;BYDAY=MO,WE,FR'),
+    (3, 'FREQ=DAILY;INTERVAL={interval}'),
+    (1, 'FREQ=MONTHLY;INTERVAL={interval}'),
+    (1, 'FREQ=MONTHLY;BYMONTHDAY={monthday}'),
+    (1, 'FREQ=HOURLY;INTERVAL={interval}'),
+    (1, 'FREQ=YEARLY'),
+    ]
+
+DESCRIPTION = ('Meeting {0}\\nAgenda: http://example.com/notes/'
+               '%(Y)s-%(m)s-%(d)s\\nStarts at %(H)s:%(M)s on %(A)s.')
+
+
+Result = namedtuple('Result', ['name', 'count', 'total', 'latencies'])
+
+
+def generate_ics(path, count, seed=0):
+    """Writes a calendar with count recurring events to path."""
+    rand = random.Random(seed)
+    rules = []
+    for weight, rule in RULE_MIX:
+        rules.extend([rule] * weight)
+
+    start = datetime.datetime(2010, 1, 1, 9, 0)
+    f = open(path, 'wb')
+    try:
+        f.write('BEGIN:VCALENDAR\r\nVERSION:2.0\r\n')
+        for i in range(count):
+            dtstart = start + datetime.timedelta(
+                days=rand.randint(0, 700), hours=rand.randint(0, 8))
+            rule = rand.choice(rules).format(
+                interval=rand.randint(1, 4), weeks=rand.randint(1, 2),
+                monthday=rand.randint(1, 28))
+            f.write('BEGIN:VEVENT\r\n')
+            f.write('UID:bench-{0}@example.com\r\n'.format(i))
+            f.write('DTSTART:{0}\r\n'.format(
+                dtstart.strftime('%Y%m%dT%H%M%S')))
+            f.write('SUMMARY:Meeting {0}\r\n'.format(i))
+            f.write('DESCRIPTION:{0}\r\n'.format(DESCRIPTION.format(i)))
+            f.write('RRULE:{0}\r\n'.format(rule))
+            f.write('END:VEVENT\r\n')
+        f.write('END:VCALENDAR\r\n')
+    finally:
+        f.close()
+
+
+def percentile(values, pct):
+    """Returns the pct percentile of sorted values."""
+    if not values:
+        return 0.0
+    i = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[i]
+
+
+def peak_memory():
+    """Returns the peak resident set size of this process in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def time_each(name, items, fun):
+    """Calls fun for each item and returns a Result with the latency of
+    each call.
+
+    """
+    latencies = []
+    start = time.time()
+    for item in items:
+        before = time.time()
+        fun(item)
+        latencies.append(time.time() - before)
+    return Result(name, len(latencies), time.time() - start, latencies)
+
+
+def time_iter(name, iterable, collect):
+    """Times how long each item of iterable takes to produce."""
+    latencies = []
+    start = before = time.time()
+    for item in iterable:
+        now = time.time()
+        latencies.append(now - before)
+        collect(item)
+        before = time.time()
+    return Result(name, len(latencies), time.time() - start, latencies)
+
+
+class StubSMTPServer(smtpd.SMTPServer):
+    """SMTP server that accepts and counts every message.
+
+    Listens on a free port on localhost; ``port`` says which.  Call
+    ``start`` to serve from a background thread and ``stop`` when
+    done.
+
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = 0
+        self.recipients = 0
+        self._thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages += 1
+        self.recipients += len(rcpttos)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=asyncore.loop, kwargs={'timeout': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.close()
+        asyncore.close_all()
+        if self._thread is not None:
+            self._thread.join(1)
+
+
+def run_benchmarks(events=1000, messages=200, recipients=5, seed=0):
+    """Runs every benchmark and returns a list of Results."""
+    tempdir = tempfile.mkdtemp()
+    try:
+        icsfile = os.path.join(tempdir, 'bench.ics')
+        generate_ics(icsfile, events, seed)
+        return _run_benchmarks(icsfile, messages, recipients)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def _run_benchmarks(icsfile, messages, recipients):
+    results = []
+    now = datetime.datetime(2013, 6, 1, 8, 0)
+
+    parsed = []
+    results.append(time_iter('parse_ics', iter_ics(icsfile), parsed.append))
+
+    cal = icalendar.Calendar.from_ical(open(icsfile, 'rb').read())
+    rrules = [component['rrule'] for component in cal.walk('vevent')]
+    results.append(time_each('convert_rrule', rrules, convert_rrule))
+
+    next_dates = []
+
+    def check(event):
+        next_date = get_next_date(now, event.rrule)
+        should_remind(now, next_date, 3)
+        next_dates.append((event, next_date))
+    results.append(time_each('get_next_date', parsed, check))
+
+    # The occurrence index expands a window for a batch of events at a
+    # time.
+    batches = [parsed[i:i + 100] for i in range(0, len(parsed), 100)]
+    results.append(time_each(
+        'expand_window', batches,
+        lambda batch: expand_windows(
+            [(event, now, now + WINDOW) for event in batch])))
+
+    rendered = []
+
+    def render(item):
+        event, next_date = item
+        subject = '{0} ({1})'.format(event.summary, format_date(next_date))
+        body = render_template(event.description, event, next_date)
+        rendered.append((subject, body))
+    results.append(time_each('render', next_dates, render))
+
+    to_list = ['Person {0} <person{0}@example.com>'.format(i)
+               for i in range(recipients)]
+    server = StubSMTPServer()
+    server.start()
+    try:
+        mailer = Mailer('127.0.0.1', server.port)
+        try:
+            results.append(time_each(
+                'send_smtp', rendered[:messages],
+                lambda item: mailer.send(
+                    'phil@example.com', to_list, item[0], item[1])))
+        finally:
+            mailer.close()
+    finally:
+        server.stop()
+
+    return results
+
+
+def report(results):
+    out('{0:<15} {1:>7} {2:>9} {3:>11} {4:>9} {5:>9} {6:>9}'.format(
+        'stage', 'count', 'total', 'per sec', 'p50 ms', 'p90 ms', 'p99 ms'),
+        wrap=False)
+    for result in results:
+        latencies = sorted(result.latencies)
+        if result.total:
+            rate = result.count / result.total
+        else:
+            rate = 0.0
+        out('{0:<15} {1:>7} {2:>8.3f}s {3:>11.1f} {4:>9.3f} {5:>9.3f} '
+            '{6:>9.3f}'.format(
+                result.name, result.count, result.total, rate,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 90) * 1000,
+                percentile(latencies, 99) * 1000),
+            wrap=False)
+    out('peak memory: {0} KB'.format(peak_memory()))
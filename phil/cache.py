@@ -0,0 +1,184 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Caches parsed events in the datadir so runs where the ics file hasn't
+changed don't have to parse it again.
+
+The cache file is a pickled header followed by one pickle per Event
+record and a final None, so it can be read and written one Event at a
+time.  It's used as long as the ics file has the same mtime and size
+or, failing that, the same sha1 digest.
+"""
+
+import cPickle
+import hashlib
+import os
+
+
+# Bump this when Event or the cache format changes.
+CACHE_VERSION = 7
+
+# What cPickle raises for truncated, corrupt or outdated pickles.
+PICKLE_ERRORS = (EOFError, cPickle.UnpicklingError, AttributeError,
+                 ImportError, IndexError, TypeError, ValueError)
+
+
+def iter_ics(icsfile, metrics=None):
+    # phil.ics pulls in icalendar, which a run that's served entirely
+    # from the cache never needs.
+    import phil.ics
+
+    return phil.ics.iter_ics(icsfile, metrics)
+
+
+def get_cache_path(datadir, icsfile):
+    key = hashlib.sha1(os.path.abspath(icsfile)).hexdigest()[:12]
+    return os.path.join(datadir, 'events-{0}.cache'.format(key))
+
+
+def get_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size)
+
+
+def get_digest(path):
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def read_header(f):
+    """Returns the cache header from f or None if it's not usable."""
+    try:
+        header = cPickle.load(f)
+    except PICKLE_ERRORS:
+        # Truncated, corrupt or from an older phil--ignore it.
+        return None
+    if not isinstance(header, dict):
+        return None
+    if header.get('version') != CACHE_VERSION:
+        return None
+    return header
+
+
+def iter_records(f):
+    """Yields the Events following the header in f."""
+    while True:
+        event = cPickle.load(f)
+        if event is None:
+            return
+        yield event
+
+
+def iter_cached(path, icsfile):
+    """Yields Events from the cache at path.
+
+    If the cache turns out to be damaged part way through, it's removed
+    and the remaining Events come from parsing icsfile instead.
+
+    """
+    f = open(path, 'rb')
+    count = 0
+    try:
+        read_header(f)
+        try:
+            for event in iter_records(f):
+                count += 1
+                yield event
+            return
+        except PICKLE_ERRORS:
+            pass
+    finally:
+        f.close()
+
+    os.remove(path)
+    for i, event in enumerate(iter_ics(icsfile)):
+        if i >= count:
+            yield event
+
+
+def iter_and_write(path, header, events):
+    """Yields events while writing them to the cache at path.
+
+    The cache is written to a temp file and only moved into place once
+    all the events have been written, so readers never see a partial
+    cache.
+
+    """
+    header = dict(header, version=CACHE_VERSION)
+    tmppath = path + '.tmp'
+    f = open(tmppath, 'wb')
+    try:
+        cPickle.dump(header, f, cPickle.HIGHEST_PROTOCOL)
+        for event in events:
+            cPickle.dump(event, f, cPickle.HIGHEST_PROTOCOL)
+            yield event
+        cPickle.dump(None, f, cPickle.HIGHEST_PROTOCOL)
+    except:
+        f.close()
+        os.remove(tmppath)
+        raise
+    f.close()
+    os.rename(tmppath, path)
+
+
+def iter_events(icsfile, datadir, metrics=None):
+    """Yields the Events for icsfile, parsing it only if the cache in
+    datadir is missing or stale.
+
+    If metrics is given, reading from the cache or parsing is timed.
+
+    """
+    path = get_cache_path(datadir, icsfile)
+    stamp = get_stamp(icsfile)
+
+    header = None
+    if os.path.exists(path):
+        f = open(path, 'rb')
+        try:
+            header = read_header(f)
+        finally:
+            f.close()
+
+    if header is not None and header['stamp'] == stamp:
+        if metrics is not None:
+            return metrics.timed('cache_load', iter_cached(path, icsfile))
+        return iter_cached(path, icsfile)
+
+    digest = get_digest(icsfile)
+    new_header = {'stamp': stamp, 'digest': digest}
+    if header is not None and header['digest'] == digest:
+        # Only the mtime changed.  Copy the cache over with the new
+        # stamp so the next run can skip the digest.
+        events = iter_cached(path, icsfile)
+    else:
+        events = iter_ics(icsfile, metrics)
+
+    return iter_and_write(path, new_header, events)
+
+
+def load_events(icsfile, datadir):
+    """Returns the Events for icsfile as a list."""
+    return list(iter_events(icsfile, datadir))
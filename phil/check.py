@@ -20,11 +20,27 @@
 
 import ConfigParser
 import datetime
+import os
+import sys
+import threading
+import time
 
+import phil.cache
+import phil.digest
+import phil.fetch
+import phil.index
+import phil.mailer
+import phil.metrics
+import phil.outbox
+import phil.plan
+import phil.scheduler
+import phil.state
+import phil.template
 import phil.util
+from phil.plan import Reminder, get_token
 from phil.util import (
-    out, err, parse_configuration, parse_ics, get_next_date, should_remind,
-    format_date, generate_date_bits)
+    out, err, parse_configurations, should_remind,
+    format_date)
 
 
 class Phil(object):
@@ -32,96 +48,638 @@ class Phil(object):
         self.config = None
         self.quiet = quiet
         self.debug = debug
+        # Set by run() so all the calendars share SMTP connections.
+        self.pool = None
+        # icsfile -> list of Events for ics files used by more than one
+        # calendar so they're only parsed once.
+        self._shared_events = {}
+        # Counts and timings for the calendar that's running.
+        self.metrics = phil.metrics.Metrics()
+        # Keeps connections to calendar servers open between fetches.
+        self.fetcher = None
+        # URLs fetched since the config file was loaded.
+        self._fetched = set()
 
-    def _run(self):
-        dtstart = datetime.datetime.today()
+    def _fetch(self):
+        """Fetches the current calendar's ics file if it's a URL.
+
+        If it can't be fetched, the copy from last time is used.
+
+        :returns: True if there's no copy of the ics file to use
+
+        """
+        url = self.config.url
+        if url is None or url in self._fetched:
+            return False
+        self._fetched.add(url)
 
         if not self.quiet:
-            out('Loading state....')
+            out('Fetching "{0}"....'.format(url))
+        if self.fetcher is None:
+            self.fetcher = phil.fetch.Fetcher()
+        start = time.time()
+        try:
+            try:
+                changed = self.fetcher.fetch(url, self.config.icsfile)
+            finally:
+                self.metrics.add_time('fetch', time.time() - start)
+        except phil.fetch.FetchError, fe:
+            if not os.path.exists(self.config.icsfile):
+                err('Could not fetch calendar: {0}'.format(fe))
+                return True
+            err('Could not fetch calendar, using the copy from last time: '
+                '{0}'.format(fe))
+            return False
+
+        if changed:
+            self.metrics.incr('fetch_changed')
+        else:
+            self.metrics.incr('fetch_not_modified')
+            if not self.quiet:
+                out('Calendar hasn\'t changed.')
+        return False
 
-        state = phil.util.load_state(self.config.datadir)
+    def _iter_events(self):
+        if self.config.cache:
+            return phil.cache.iter_events(
+                self.config.icsfile, self.config.datadir, self.metrics)
+        from phil.ics import iter_ics
 
+        return iter_ics(self.config.icsfile, self.metrics)
+
+    def _load_events(self):
+        icsfile = self.config.icsfile
+        if icsfile not in self._shared_events:
+            return self._iter_events()
+        if self._shared_events[icsfile] is None:
+            self._shared_events[icsfile] = list(self._iter_events())
+        return self._shared_events[icsfile]
+
+    def _load_configs(self, conffile):
         if not self.quiet:
-            out('Parsing ics file "{0}"....'.format(self.config.icsfile))
+            out('Parsing config file....')
+        try:
+            configs = parse_configurations(conffile)
+        except ConfigParser.NoOptionError, noe:
+            err('Missing option in config file: {0}'.format(noe))
+            return None
 
-        events = parse_ics(self.config.icsfile)
-        for event in events:
+        self._fetched = set()
+        icsfiles = [config.icsfile for config in configs]
+        self._shared_events = dict(
+            (icsfile, None) for icsfile in icsfiles
+            if icsfiles.count(icsfile) > 1)
+        return configs
+
+    def _for_each_config(self, configs, fun):
+        """Calls fun for each config and returns the exit code."""
+        failed = False
+        for config in configs:
+            self.config = config
+            if len(configs) > 1 and not self.quiet:
+                out('Calendar "{0}"....'.format(config.name))
+            try:
+                if fun():
+                    failed = True
+
+            except Exception:
+                import traceback
+                err(''.join(traceback.format_exc()), wrap=False)
+                err('phil has died unexpectedly.  If you think this is an '
+                    'error (which it is), then contact phil\'s authors for '
+                    'help.')
+                failed = True
+
+        return 1 if failed else 0
+
+    def _load_index(self):
+        if self.config.cache:
+            return phil.index.OccurrenceIndex.load(
+                self.config.datadir, self.config.name, self.config.icsfile)
+        return phil.index.OccurrenceIndex()
+
+    def _open_state(self):
+        return phil.state.open_store(
+            self.config.datadir, self.config.name, self.config.state_backend)
+
+    def _collect_garbage(self, state, event_ids):
+        """Drops state for events that aren't in event_ids.
+
+        A calendar with no events is more likely a bad download than
+        one with no meetings, so its state is kept.
+
+        """
+        if not event_ids:
+            return
+        removed = phil.state.collect_garbage(state, event_ids)
+        if removed:
+            self.metrics.incr('state_removed', removed)
+            if not self.quiet:
+                out('Forgot {0} event(s) that are gone.'.format(removed))
+
+    def _open_outbox(self):
+        """Returns the Outbox for the current calendar or None if it
+        doesn't use one.
+
+        """
+        if not self.config.outbox:
+            return None
+        return phil.outbox.Outbox(self.config.datadir, self.config.name)
+
+    def _fill_index(self, events, dtstart, index):
+        """Yields events, expanding the next window of each batch of
+        them in index at once.
+
+        """
+        for batch in phil.index.iter_batches(events):
+            start = time.time()
+            index.fill(batch, dtstart)
+            # Counted per event below.
+            self.metrics.add_time('evaluate', time.time() - start, count=0)
+            for event in batch:
+                yield event
+
+    def _due_reminders(self, events, dtstart, state, index, outbox=None,
+                       migrate=True):
+        """Yields (event, next_date) for each event that needs a
+        reminder sent.
+
+        :arg migrate: False to leave state alone; state can then be a
+            dict from :py:func:`phil.state.read_state`
+
+        """
+        for event in self._fill_index(events, dtstart, index):
+            start = time.time()
+            self.metrics.incr('events')
             if not self.quiet:
                 out('Looking at event "{0}"....'.format(event.summary))
 
-            next_date = get_next_date(dtstart, event.rrule)
-            previous_remind = state.get(event.event_id)
-            if previous_remind and previous_remind == str(next_date.date()):
+            next_date = index.after(event, dtstart, inc=True)
+            previous_remind = phil.state.get_reminded(state, event, migrate)
+            due = False
+            if next_date is None:
+                if not self.quiet:
+                    out('This meeting doesn\'t happen again.')
+
+            elif (previous_remind
+                    and previous_remind == str(next_date.date())):
                 if not self.quiet:
                     out('Already sent a reminder for this meeting.')
-                continue
 
-            if should_remind(dtstart, next_date, self.config.remind):
+            elif (outbox is not None
+                    and (event.event_id, str(next_date.date())) in outbox):
                 if not self.quiet:
-                    out('Sending reminder....')
-                summary = '{0} ({1})'.format(
-                    event.summary, format_date(next_date))
-                description = event.description % generate_date_bits(next_date)
+                    out('The reminder for this meeting is in the outbox.')
 
-                if self.debug:
-                    out('From:', self.config.sender)
-                    out('To:', self.config.to_list)
-                    out('Subject:', summary)
-                    out('Body:')
-                    out(description, indent='    ', wrap=False)
-                else:
-                    phil.util.send_mail_smtp(
-                        self.config.sender, self.config.to_list, summary,
-                        description, self.config.host, self.config.port)
+            elif should_remind(dtstart, next_date, self.config.remind):
+                due = True
 
-                    state[event.event_id] = str(next_date.date())
             elif not self.quiet:
                 out('Next reminder should get sent on {0}.'.format(
                     next_date.date() - datetime.timedelta(self.config.remind)))
 
-        phil.util.save_state(self.config.datadir, state)
+            self.metrics.add_time('evaluate', time.time() - start)
+            if due:
+                self.metrics.incr('reminders_due')
+                yield event, next_date
+
+    def _recipients(self, event):
+        """Returns the addresses the reminder for event goes to.
+
+        Which of the config's to list and the event's organizer and
+        attendees are used depends on the ``recipients`` option.
+        Addresses in an X-PHIL-TO property are always added.
+
+        """
+        people = list(event.attendees)
+        if event.organizer is not None:
+            people.insert(0, event.organizer)
+
+        recipients = self.config.recipients
+        if recipients == 'to' or (recipients == 'attendees' and not people):
+            addresses = list(self.config.to_list)
+        elif recipients == 'attendees':
+            addresses = people
+        else:
+            addresses = list(self.config.to_list) + people
+
+        for name, value in event.properties:
+            if name == 'X-PHIL-TO':
+                addresses.extend(value.split(','))
+        return phil.mailer.unique_addresses(addresses)
+
+    def _make_message(self, event, next_date):
+        start = time.time()
+        summary = '{0} ({1})'.format(event.summary, format_date(next_date))
+        description = phil.template.render(
+            event.description, event, next_date)
+        message = phil.mailer.Message(
+            self.config.sender, self._recipients(event), summary,
+            description, self.config.delivery)
+        self.metrics.add_time('render', time.time() - start)
+        return message
+
+    def _make_pool(self, configs):
+        """Returns a MailerPool for configs.
+
+        Calendars sending through the same host share a pool of
+        connections capped at the lowest limit any of them asks for,
+        and the lowest rate.
+
+        """
+        host_limits = {}
+        host_rates = {}
+        for config in configs:
+            limit = config.max_connections or config.workers
+            host_limits[config.host] = min(
+                host_limits.get(config.host, limit), limit)
+            if config.rate:
+                rate = (config.rate, config.burst)
+                host_rates[config.host] = min(
+                    host_rates.get(config.host, rate), rate)
+        return phil.mailer.MailerPool(1, host_limits, host_rates)
+
+    def _group(self, jobs):
+        """Groups jobs that send the same message to the same people so
+        each group is sent once.
+
+        :arg jobs: iterable of (token, message) tuples
+
+        :returns: list of (tokens, message) tuples in the order each
+            group was first seen, where tokens is a tuple of the tokens
+            of the jobs in the group
+
+        """
+        groups = []
+        by_key = {}
+        for token, message in jobs:
+            key = (message.sender,
+                   frozenset([phil.mailer.get_address_key(address)
+                              for address in message.to_list]),
+                   message.subject, message.body, message.delivery)
+            if key in by_key:
+                by_key[key][0].append(token)
+                self.metrics.incr('grouped')
+            else:
+                by_key[key] = ([token], message)
+                groups.append(by_key[key])
+        return [(tuple(tokens), message) for tokens, message in groups]
+
+    def _dispatch(self, jobs, callback):
+        """Sends messages for the current calendar.
+
+        :arg jobs: iterable of (tokens, message) tuples
+        :arg callback: called with (tokens, error) as each message is
+            done
+
+        :returns: list of (tokens, error) tuples
+
+        """
+        pool = self.pool
+        if pool is None:
+            host_rates = {}
+            if self.config.rate:
+                host_rates[self.config.host] = (
+                    self.config.rate, self.config.burst)
+            pool = phil.mailer.MailerPool(
+                self.config.max_connections or self.config.workers,
+                host_rates=host_rates)
+        first_timing = len(pool.timings)
+        first_connect = len(pool.connect_timings)
+        first_waited = pool.waited
+
+        dispatcher = phil.mailer.Dispatcher(
+            pool, self.config.workers, callback)
+        dispatcher.start()
+        try:
+            for token, message in jobs:
+                if self.debug:
+                    phil.plan.write_message(message, sys.stdout)
+                else:
+                    dispatcher.submit(
+                        token, self.config.host, self.config.port, message)
+        finally:
+            try:
+                results = dispatcher.join()
+            finally:
+                if pool is not self.pool:
+                    pool.close()
+
+        timings = pool.timings[first_timing:]
+        sent = sum([elapsed for subject, elapsed in timings])
+        if timings and not self.quiet:
+            out('Sent {0} message(s) in {1:.3f}s.'.format(len(timings), sent))
+        waited = pool.waited - first_waited
+        if waited and not self.quiet:
+            out('Waited {0:.3f}s for the smtp_rate limit.'.format(waited))
+
+        connects = pool.connect_timings[first_connect:]
+        if connects:
+            self.metrics.add_time('smtp_connect', sum(connects), len(connects))
+        if timings:
+            self.metrics.add_time('smtp_send', sent, len(timings))
+        if waited:
+            self.metrics.add_time('rate_wait', waited)
+        failed = len([token for token, error in results if error is not None])
+        self.metrics.incr('sent', len(results) - failed)
+        self.metrics.incr('failed', failed)
+        return results
+
+    def _plan_reminders(self, reminders):
+        """Returns a list of Reminders for the current calendar.
+
+        :arg reminders: iterable of (event, next_date) tuples
+
+        """
+        return [Reminder(self.config, event, next_date,
+                         self._make_message(event, next_date))
+                for event, next_date in reminders]
+
+    def _send(self, reminders, state, outbox=None):
+        """Renders and sends reminders for the current calendar.
+
+        :arg reminders: iterable of (event, next_date) tuples
+
+        :returns: the number of reminders that couldn't be sent
+
+        """
+        return self._execute(self._plan_reminders(reminders), state, outbox)
+
+    def _execute(self, plan, state, outbox=None):
+        """Sends the Reminders in plan and records the ones that were
+        accepted in state as soon as they're accepted.
+
+        With the ``digest`` option, everyone gets one message with all
+        of their reminders.  A reminder is recorded once every message
+        it's in has been accepted.
+
+        :arg plan: list of Reminders for the current calendar
+        :arg state: the state store for the current calendar
+        :arg outbox: the Outbox to queue reminders that couldn't be
+            sent in or None
+
+        :returns: the number of reminders that couldn't be sent
+
+        """
+        # token -> the reminder's own Message
+        originals = {}
+        # token -> how many of the messages it's in aren't done
+        remaining = {}
+        # token -> addresses of the messages it's in that failed
+        failed = {}
+        lock = threading.Lock()
+
+        def record(tokens, message, error):
+            lock.acquire()
+            try:
+                # Without an outbox there's nowhere to keep just the
+                # people a partly delivered message missed, and sending
+                # it again would go to everyone, so it counts as sent.
+                # The error is still reported.
+                partial = (outbox is None and
+                           isinstance(error, phil.mailer.DeliveryError))
+                for token in tokens:
+                    remaining[token] -= 1
+                    if error is not None and not partial:
+                        if outbox is not None and token not in failed:
+                            self.metrics.incr('queued')
+                        failed[token] = phil.mailer.unique_addresses(
+                            failed.get(token, ())
+                            + phil.mailer.get_failed(message.to_list, error))
+                        if outbox is not None:
+                            # Queued with just the people who didn't
+                            # get it.
+                            outbox.put(token, originals[token]._replace(
+                                to_list=failed[token]), error)
+                    # Only record state for reminders every recipient's
+                    # server accepted so the rest get retried.
+                    if not remaining[token] and token not in failed:
+                        state.record(*token)
+            finally:
+                lock.release()
+
+        def jobs():
+            for reminder in plan:
+                if not self.quiet:
+                    out('Sending reminder....')
+                token = get_token(reminder)
+                originals[token] = reminder.message
+                yield token, reminder.message
+
+        if self.config.digest:
+            groups = phil.digest.build_digests(list(jobs()))
+            self.metrics.incr('digests', len(groups))
+        else:
+            # Reminders that would be the same message to the same
+            # people go out as one.
+            groups = self._group(jobs())
+        messages = dict(groups)
+        for tokens, message in groups:
+            for token in tokens:
+                remaining[token] = remaining.get(token, 0) + 1
+
+        def callback(tokens, error):
+            record(tokens, messages[tokens], error)
+
+        for tokens, error in self._dispatch(groups, callback):
+            if error is None:
+                continue
+            for event_id, next_date in tokens:
+                err('Sending reminder for "{0}" failed: {1}'.format(
+                    event_id, error))
+        failures = len(failed)
+
+        if failures:
+            if outbox is not None:
+                err('{0} reminder(s) could not be sent and are in the '
+                    'outbox.  Run "phil-cmd flush" to try again.'.format(
+                        failures))
+            else:
+                err('{0} reminder(s) could not be sent.'.format(failures))
+        return failures
+
+    def _flush_outbox(self, state, outbox, limit=None):
+        """Tries to send the reminders in outbox that are due for
+        another try.
+
+        :returns: the number of reminders still waiting
+
+        """
+        for entry in outbox.expire():
+            err('Dropped the reminder for "{0}" from the outbox: the '
+                'meeting was on {1}.'.format(*entry.token))
+
+        entries = outbox.due()
+        if limit is not None:
+            entries = entries[:limit]
+        if not entries:
+            return 0
 
-    def run(self, conffile):
         if not self.quiet:
-            out('Parsing config file....')
+            out('Sending {0} reminder(s) from the outbox....'.format(
+                len(entries)))
+
+        by_token = dict((entry.token, entry) for entry in entries)
+
+        def record(tokens, error):
+            for token in tokens:
+                entry = by_token[token]
+                if error is None:
+                    state.record(*token)
+                    outbox.remove(entry)
+                else:
+                    # Only the people who didn't get it are tried
+                    # again.
+                    entry.message = entry.message._replace(
+                        to_list=phil.mailer.get_failed(
+                            entry.message.to_list, error))
+                    outbox.retry(entry, error)
+
+        failures = 0
+        results = self._dispatch(
+            self._group([(entry.token, entry.message) for entry in entries]),
+            record)
+        for tokens, error in results:
+            if error is None:
+                continue
+            for token in tokens:
+                entry = by_token[token]
+                err('Sending reminder for "{0}" failed again ({1} '
+                    'tries): {2}'.format(token[0], entry.attempts, error))
+                failures += 1
+        return failures
+
+    def _run(self):
+        self.metrics = phil.metrics.Metrics()
+        start = time.time()
         try:
-            self.config = parse_configuration(conffile)
-        except ConfigParser.NoOptionError, noe:
-            err('Missing option in config file: {0}'.format(noe))
-            return 1
+            return self._run_calendar()
+        finally:
+            self.metrics.add_time('run', time.time() - start)
+            if self.config.metrics:
+                self.metrics.write(
+                    self.config.datadir, self.config.name,
+                    self.config.metrics)
+
+    def _run_calendar(self):
+        dtstart = datetime.datetime.today()
+
+        if not self.quiet:
+            out('Loading state....')
 
+        start = time.time()
+        state = self._open_state()
+        self.metrics.add_time('state_load', time.time() - start)
         try:
-            self._run()
+            outbox = self._open_outbox()
+            if outbox is not None and not self.debug:
+                self._flush_outbox(state, outbox)
 
-        except Exception:
-            import traceback
-            err(''.join(traceback.format_exc()), wrap=False)
-            err('phil has died unexpectedly.  If you think this is an error '
-                '(which it is), then contact phil\'s authors for help.')
+            if self._fetch():
+                return 1
+
+            if not self.quiet:
+                out('Parsing ics file "{0}"....'.format(self.config.icsfile))
+
+            events = self._load_events()
+            index = self._load_index()
+            plan = self._plan_reminders(
+                self._due_reminders(events, dtstart, state, index, outbox))
+            failures = self._execute(plan, state, outbox)
+            if not self.debug:
+                # Every event has been looked at, so anything else in
+                # the state is for events that are gone.
+                self._collect_garbage(state, index.seen)
+        finally:
+            start = time.time()
+            state.close()
+            self.metrics.add_time('state_save', time.time() - start)
+
+        # Every event has been looked at, so anything else in the index
+        # is for events that are gone.
+        index.prune(dtstart, index.seen)
+        index.save()
+        return failures
+
+    def run(self, conffile):
+        configs = self._load_configs(conffile)
+        if configs is None:
             return 1
 
+        self.pool = self._make_pool(configs)
+        try:
+            ret = self._for_each_config(configs, self._run)
+        finally:
+            self.pool.close()
+            self.pool = None
+            self._close_fetcher()
+
+        if ret == 0 and not self.quiet:
+            out('Finished!')
+        return ret
+
+    def _flush(self, limit=None):
+        outbox = self._open_outbox()
+        if outbox is None:
+            return 0
+
+        state = self._open_state()
+        try:
+            failures = self._flush_outbox(state, outbox, limit)
+        finally:
+            state.close()
+
         if not self.quiet:
+            out('{0} reminder(s) left in the outbox.'.format(len(outbox)))
+        return failures
+
+    def flush(self, conffile, limit=None):
+        configs = self._load_configs(conffile)
+        if configs is None:
+            return 1
+
+        self.pool = self._make_pool(configs)
+        try:
+            ret = self._for_each_config(
+                configs, lambda: self._flush(limit))
+        finally:
+            self.pool.close()
+            self.pool = None
+
+        if ret == 0 and not self.quiet:
             out('Finished!')
-        return 0
+        return ret
+
+    def _close_fetcher(self):
+        if self.fetcher is not None:
+            self.fetcher.close()
+            self.fetcher = None
 
     def _next6(self):
         # TODO: This is a repeat of _run for the most part.
         dtstart = datetime.datetime.today()
 
+        if self._fetch():
+            return 1
+
         out('Loading state....')
 
-        state = phil.util.load_state(self.config.datadir)
+        state = self._open_state()
+        try:
+            self._print_next6(dtstart, state)
+        finally:
+            state.close()
 
+    def _print_next6(self, dtstart, state):
         out('Parsing ics file "{0}"....'.format(self.config.icsfile))
 
-        events = parse_ics(self.config.icsfile)
+        events = self._load_events()
+        index = self._load_index()
         for event in events:
             out('Looking at event "{0}"....'.format(event.summary))
-            next_date = dtstart
 
-            for i in range(6):
-                next_date = get_next_date(next_date, event.rrule)
-                previous_remind = state.get(event.event_id)
+            previous_remind = phil.state.get_reminded(state, event)
+            for next_date in index.next_n(event, dtstart, 6):
                 if (previous_remind
                         and previous_remind == str(next_date.date())):
                     out('* {0} (sent reminder already)'.format(
@@ -130,19 +688,213 @@ class Phil(object):
                 else:
                     out('* {0}'.format(next_date.strftime('%c')))
 
-                next_date = next_date + datetime.timedelta(1)
+        index.save()
 
     def next6(self, conffile):
+        configs = self._load_configs(conffile)
+        if configs is None:
+            return 1
+
+        try:
+            ret = self._for_each_config(configs, self._next6)
+        finally:
+            self._close_fetcher()
+
+        if ret == 0 and not self.quiet:
+            out('Finished!')
+        return ret
+
+    def agenda(self, conffile, start=None, end=None, count=None,
+               fmt='text', stream=None):
+        """Writes the occurrences of every event in every calendar
+        from start, sorted by date, until end or until count of them
+        have been written.
+
+        :arg fmt: text, json or csv; progress isn't printed for json
+            and csv so it doesn't end up in the output
+        :arg stream: file to write to; defaults to stdout
+
+        """
+        quiet = self.quiet
+        self.quiet = quiet or fmt != 'text'
+        try:
+            return self._agenda(conffile, start, end, count, fmt, stream)
+        finally:
+            self.quiet = quiet
+
+    def _agenda(self, conffile, start, end, count, fmt, stream):
+        from phil.agenda import Item, WRITERS, merge
+
+        configs = self._load_configs(conffile)
+        if configs is None:
+            return 1
+
+        start = start or datetime.datetime.today()
+        states = {}
+        failed = False
+        try:
+            sources = []
+            for config in configs:
+                self.config = config
+                if self._fetch():
+                    failed = True
+                    continue
+                states[config.name] = self._open_state()
+                sources.append((config.name, list(self._load_events())))
+
+            items = (
+                Item(date, name, event,
+                     phil.state.get_reminded(states[name], event)
+                     == str(date.date()))
+                for date, name, event in merge(sources, start, end, count))
+            WRITERS[fmt](items, stream or sys.stdout)
+
+        except Exception:
+            import traceback
+            err(''.join(traceback.format_exc()), wrap=False)
+            err('phil has died unexpectedly.  If you think this is an error '
+                '(which it is), then contact phil\'s authors for help.')
+            return 1
+
+        finally:
+            for state in states.values():
+                state.close()
+            self._close_fetcher()
+
+        return 1 if failed else 0
+
+    def _plan_configs(self, configs, start):
+        """Returns (plan, failed) for configs where failed is True if
+        any calendar couldn't be fetched.
+
+        """
+        plan = []
+        failed = False
+        for config in configs:
+            self.config = config
+            if len(configs) > 1 and not self.quiet:
+                out('Calendar "{0}"....'.format(config.name))
+            if self._fetch():
+                failed = True
+                continue
+
+            # Planning doesn't change state or save the index.
+            state = phil.state.read_state(
+                config.datadir, config.name, config.state_backend)
+            plan.extend(self._plan_reminders(self._due_reminders(
+                self._load_events(), start, state, self._load_index(),
+                self._open_outbox(), migrate=False)))
+        return plan, failed
+
+    def plan(self, conffile, start=None):
+        """Returns the Reminders a run at start would send, in the order
+        it would send them, without sending them.
+
+        :arg start: when the run would be; defaults to now
+
+        :returns: list of Reminders or None if the config file couldn't
+            be parsed
+
+        """
+        configs = self._load_configs(conffile)
+        if configs is None:
+            return None
+        try:
+            return self._plan_configs(
+                configs, start or datetime.datetime.today())[0]
+        finally:
+            self._close_fetcher()
+
+    def execute(self, plan):
+        """Sends the Reminders in a plan from :py:meth:`plan` and records
+        them in state.  Reminders that were sent since the plan was made
+        are skipped.
+
+        :returns: 0 if every reminder was sent and 1 if any couldn't be
+
+        """
+        configs = []
+        by_calendar = {}
+        for reminder in plan:
+            name = reminder.config.name
+            if name not in by_calendar:
+                configs.append(reminder.config)
+                by_calendar[name] = []
+            by_calendar[name].append(reminder)
+
+        failures = 0
+        self.pool = self._make_pool(configs)
+        try:
+            for config in configs:
+                self.config = config
+                state = self._open_state()
+                try:
+                    reminders = [
+                        reminder for reminder in by_calendar[config.name]
+                        if phil.state.get_reminded(state, reminder.event)
+                        != get_token(reminder)[1]]
+                    failures += self._execute(
+                        reminders, state, self._open_outbox())
+                finally:
+                    state.close()
+        finally:
+            self.pool.close()
+            self.pool = None
+        return 1 if failures else 0
+
+    def show_plan(self, conffile, start=None, fmt='text', stream=None):
+        """Writes the reminders a run at start would send without
+        sending them.
+
+        :arg fmt: text or json; progress isn't printed for json so it
+            doesn't end up in the output
+        :arg stream: file to write to; defaults to stdout
+
+        """
+        quiet = self.quiet
+        self.quiet = quiet or fmt != 'text'
+        try:
+            return self._show_plan(conffile, start, fmt, stream)
+        finally:
+            self.quiet = quiet
+
+    def _show_plan(self, conffile, start, fmt, stream):
+        from phil.plan import WRITERS
+
+        configs = self._load_configs(conffile)
+        if configs is None:
+            return 1
+
+        try:
+            plan, failed = self._plan_configs(
+                configs, start or datetime.datetime.today())
+            WRITERS[fmt](plan, stream or sys.stdout)
+
+        except Exception:
+            import traceback
+            err(''.join(traceback.format_exc()), wrap=False)
+            err('phil has died unexpectedly.  If you think this is an error '
+                '(which it is), then contact phil\'s authors for help.')
+            return 1
+
+        finally:
+            self._close_fetcher()
+
+        return 1 if failed else 0
+
+    def serve(self, conffile, poll=60):
         if not self.quiet:
             out('Parsing config file....')
+        scheduler = phil.scheduler.Scheduler(self, conffile, poll)
         try:
-            self.config = parse_configuration(conffile)
+            scheduler.serve()
+
         except ConfigParser.NoOptionError, noe:
             err('Missing option in config file: {0}'.format(noe))
             return 1
 
-        try:
-            self._next6()
+        except KeyboardInterrupt:
+            pass
 
         except Exception:
             import traceback
@@ -151,6 +903,9 @@ class Phil(object):
                 '(which it is), then contact phil\'s authors for help.')
             return 1
 
+        finally:
+            self._close_fetcher()
+
         if not self.quiet:
             out('Finished!')
         return 0
@@ -18,6 +18,7 @@
 #######################################################################
 
 import argparse
+import datetime
 import sys
 import os
 
@@ -76,8 +77,103 @@ def next6_cmd(parsed):
     return p.next6(conffile)
 
 
+def agenda_cmd(parsed):
+    conffile = os.path.abspath(parsed.runconffile)
+    if not os.path.exists(conffile):
+        phil.err('{0} does not exist.'.format(conffile))
+        return 1
+
+    start = None
+    if parsed.start:
+        try:
+            start = datetime.datetime.strptime(parsed.start, '%Y-%m-%d')
+        except ValueError:
+            phil.err('{0} is not a YYYY-MM-DD date.'.format(parsed.start))
+            return 1
+
+    end = None
+    count = parsed.count
+    if parsed.days is not None:
+        end = (start or datetime.datetime.today()) + datetime.timedelta(
+            days=parsed.days)
+    elif count is None:
+        count = 20
+
+    p = phil.Phil(parsed.quiet, parsed.debug)
+    return p.agenda(conffile, start, end, count, parsed.format)
+
+
+def plan_cmd(parsed):
+    conffile = os.path.abspath(parsed.runconffile)
+    if not os.path.exists(conffile):
+        phil.err('{0} does not exist.'.format(conffile))
+        return 1
+
+    start = None
+    if parsed.start:
+        try:
+            start = datetime.datetime.strptime(parsed.start, '%Y-%m-%d')
+        except ValueError:
+            phil.err('{0} is not a YYYY-MM-DD date.'.format(parsed.start))
+            return 1
+
+    p = phil.Phil(parsed.quiet, parsed.debug)
+    return p.show_plan(conffile, start, parsed.format)
+
+
+def serve_cmd(parsed):
+    conffile = os.path.abspath(parsed.runconffile)
+    if not os.path.exists(conffile):
+        phil.err('{0} does not exist.'.format(conffile))
+        return 1
+
+    p = phil.Phil(parsed.quiet, parsed.debug)
+    return p.serve(conffile, parsed.poll)
+
+
+def flush_cmd(parsed):
+    conffile = os.path.abspath(parsed.runconffile)
+    if not os.path.exists(conffile):
+        phil.err('{0} does not exist.'.format(conffile))
+        return 1
+
+    p = phil.Phil(parsed.quiet, parsed.debug)
+    return p.flush(conffile, parsed.limit)
+
+
+def bench_cmd(parsed):
+    import phil.bench
+
+    if not parsed.quiet:
+        phil.out('Running benchmarks with {0} events....'.format(
+            parsed.events))
+    results = phil.bench.run_benchmarks(
+        parsed.events, parsed.messages, parsed.recipients)
+    phil.bench.report(results)
+    return 0
+
+
+def wants_byline(argv):
+    """Returns False if the byline would get in the way: with -q or
+    when the output is json or csv for something else to read.
+
+    """
+    if '-q' in argv or '--quiet' in argv:
+        return False
+    for i, arg in enumerate(argv):
+        if arg.startswith('--format='):
+            fmt = arg[len('--format='):]
+        elif arg == '--format' and i + 1 < len(argv):
+            fmt = argv[i + 1]
+        else:
+            continue
+        if fmt != 'text':
+            return False
+    return True
+
+
 def main(argv):
-    if '-q' not in argv and '--quiet' not in argv:
+    if wants_byline(argv):
         phil.out(BYLINE)
 
     parser = argparse.ArgumentParser(
@@ -101,6 +197,20 @@ def main(argv):
         default=False,
         help='runs phil in debug mode--no sending email.')
 
+    parser.add_argument(
+        '--profile',
+        metavar='FILE',
+        default=None,
+        help='profiles the command with cProfile, writes the profile to '
+        'FILE and prints the hottest functions to stderr')
+
+    parser.add_argument(
+        '--profile-top',
+        metavar='N',
+        type=int,
+        default=20,
+        help='how many functions the profile summary lists')
+
     subparsers = parser.add_subparsers(
         title='Commands',
         help='Run "%(prog)s CMD --help" for additional help')
@@ -126,8 +236,102 @@ def main(argv):
         help='name/path for the configuration file')
     next6_parser.set_defaults(func=next6_cmd)
 
+    agenda_parser = subparsers.add_parser(
+        'agenda', help='lists upcoming meetings in all calendars in order')
+    agenda_parser.add_argument(
+        '--count',
+        type=int,
+        default=None,
+        help='how many meetings to list (20 if there\'s no --days)')
+    agenda_parser.add_argument(
+        '--days',
+        type=int,
+        default=None,
+        help='list the meetings in this many days')
+    agenda_parser.add_argument(
+        '--start',
+        default=None,
+        help='list meetings from this YYYY-MM-DD date rather than now')
+    agenda_parser.add_argument(
+        '--format',
+        choices=['text', 'json', 'csv'],
+        default='text',
+        help='output format')
+    agenda_parser.add_argument(
+        'runconffile',
+        help='name/path for the configuration file')
+    agenda_parser.set_defaults(func=agenda_cmd)
+
+    plan_parser = subparsers.add_parser(
+        'plan', help='lists the reminders a run would send without '
+        'sending them')
+    plan_parser.add_argument(
+        '--start',
+        default=None,
+        help='plan a run on this YYYY-MM-DD date rather than now')
+    plan_parser.add_argument(
+        '--format',
+        choices=['text', 'json'],
+        default='text',
+        help='output format')
+    plan_parser.add_argument(
+        'runconffile',
+        help='name/path for the configuration file')
+    plan_parser.set_defaults(func=plan_cmd)
+
+    serve_parser = subparsers.add_parser(
+        'serve', help='keeps running and sends reminders when they\'re due')
+    serve_parser.add_argument(
+        '--poll',
+        type=int,
+        default=60,
+        help='seconds between checks for config and ics file changes')
+    serve_parser.add_argument(
+        'runconffile',
+        help='name/path for the configuration file')
+    serve_parser.set_defaults(func=serve_cmd)
+
+    flush_parser = subparsers.add_parser(
+        'flush', help='tries again to send the reminders in the outbox')
+    flush_parser.add_argument(
+        '--limit',
+        type=int,
+        default=None,
+        help='the most reminders to send per calendar')
+    flush_parser.add_argument(
+        'runconffile',
+        help='name/path for the configuration file')
+    flush_parser.set_defaults(func=flush_cmd)
+
+    bench_parser = subparsers.add_parser(
+        'bench', help='times phil on a generated calendar')
+    bench_parser.add_argument(
+        '--events',
+        type=int,
+        default=1000,
+        help='number of events in the generated calendar')
+    bench_parser.add_argument(
+        '--messages',
+        type=int,
+        default=200,
+        help='number of messages to send to the stub SMTP server')
+    bench_parser.add_argument(
+        '--recipients',
+        type=int,
+        default=5,
+        help='number of recipients for each message')
+    bench_parser.set_defaults(func=bench_cmd)
+
     parsed = parser.parse_args(argv)
 
+    if parsed.profile:
+        from phil.profiling import profile_call, summarize
+
+        ret, stats = profile_call(parsed.profile, parsed.func, parsed)
+        summarize(stats, parsed.profile_top)
+        sys.stderr.write('Profile written to {0}.\n'.format(parsed.profile))
+        return ret
+
     return parsed.func(parsed)
 
 
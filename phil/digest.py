@@ -0,0 +1,92 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Combines the reminders due in a run into one message per recipient.
+
+Everyone who gets the same reminders shares a digest, so a run sends
+at most one message per distinct set of reminders instead of one per
+event.
+"""
+
+from phil.mailer import get_address_key
+
+
+def format_digest(messages):
+    """Returns (subject, body) for a digest of messages."""
+    subject = 'Reminders for {0} meetings'.format(len(messages))
+    sections = []
+    for message in messages:
+        sections.append(u'{0}\n{1}\n\n{2}'.format(
+            message.subject, u'=' * len(message.subject), message.body))
+    return subject, u'\n\n\n'.join(sections)
+
+
+def build_digests(jobs):
+    """Combines reminders into digests.
+
+    :arg jobs: list of (token, message) tuples, one per reminder, where
+        token is (event_id, date)
+
+    :returns: list of (tokens, message) tuples, one per distinct set
+        of reminders, where tokens is a tuple of the tokens of the
+        reminders in the message.  A set of one reminder is sent as
+        that reminder's own message.
+
+    """
+    # Reminders go in meeting date order.
+    jobs = sorted(jobs, key=lambda job: (job[0][1], job[1].subject))
+
+    # address key -> (address, indexes into jobs)
+    by_address = {}
+    order = []
+    for i, (token, message) in enumerate(jobs):
+        for address in message.to_list:
+            key = get_address_key(address)
+            if key not in by_address:
+                by_address[key] = (address, [])
+                order.append(key)
+            indexes = by_address[key][1]
+            if not indexes or indexes[-1] != i:
+                indexes.append(i)
+
+    # tuple of indexes -> addresses that get those reminders
+    by_indexes = {}
+    groups = []
+    for key in order:
+        address, indexes = by_address[key]
+        indexes = tuple(indexes)
+        if indexes not in by_indexes:
+            by_indexes[indexes] = []
+            groups.append(indexes)
+        by_indexes[indexes].append(address)
+
+    digests = []
+    for indexes in groups:
+        tokens = tuple([jobs[i][0] for i in indexes])
+        messages = [jobs[i][1] for i in indexes]
+        to_list = tuple(by_indexes[indexes])
+        if len(messages) == 1:
+            message = messages[0]._replace(to_list=to_list)
+        else:
+            subject, body = format_digest(messages)
+            message = messages[0]._replace(
+                to_list=to_list, subject=subject, body=body)
+        digests.append((tokens, message))
+    return digests
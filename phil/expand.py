@@ -0,0 +1,330 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Expands the occurrences of many events in a window at once.
+
+The rule shapes ``convert_rrule`` produces most often are arithmetic
+progressions: every N seconds/minutes/hours/days, every N weeks on
+some weekdays and every N months on some day of the month.  Those are
+compiled into series and evaluated for all events together with NumPy.
+Everything else, and everything when NumPy isn't installed, goes
+through dateutil.
+"""
+
+import datetime
+
+import dateutil.rrule
+
+from phil.util import align, to_local
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Series kinds
+STEP = 'step'
+MONTH = 'month'
+
+# dateutil freq -> step length in seconds for a fixed-step rule
+STEP_FREQS = {
+    dateutil.rrule.SECONDLY: 1,
+    dateutil.rrule.MINUTELY: 60,
+    dateutil.rrule.HOURLY: 3600,
+    dateutil.rrule.DAILY: 86400,
+    dateutil.rrule.WEEKLY: 7 * 86400,
+    }
+
+# rrule arguments a compiled rule may have
+COMPILABLE_ARGS = set(['dtstart', 'interval', 'until', 'count', 'wkst',
+                       'byweekday', 'bymonthday'])
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def has_fixed_offset(dt):
+    """Returns True if dt is naive or its timezone never changes its
+    UTC offset, so wall-clock arithmetic is safe.
+
+    """
+    tz = dt.tzinfo
+    if tz is None:
+        return True
+    if hasattr(tz, '_utc_transition_times'):
+        # A pytz zone with DST.  Its utcoffset() doesn't tell us about
+        # other dates.
+        return False
+    offsets = set([tz.utcoffset(dt.replace(month=month, day=1))
+                   for month in (1, 4, 7, 10)])
+    return len(offsets) == 1
+
+
+def compile_rule(rule_args):
+    """Compiles (freq, args) into a list of series or returns None if the
+    rule has to be expanded by dateutil.
+
+    Each series is a tuple of (kind, base, step, first, last, day)
+    where occurrence k, for first <= k <= last, is:
+
+    * STEP: base + k * step seconds
+    * MONTH: day ``day`` of the month base + k * step months at base's
+      time, skipping months that don't have that day
+
+    Dates are naive wall-clock datetimes; last is None when the series
+    doesn't end.
+
+    """
+    if rule_args is None:
+        return None
+    freq, args = rule_args
+    if set(args) - COMPILABLE_ARGS:
+        return None
+
+    dtstart = args['dtstart']
+    if not isinstance(dtstart, datetime.datetime):
+        return None
+    if not has_fixed_offset(dtstart):
+        return None
+    base = dtstart.replace(tzinfo=None)
+
+    interval = args.get('interval') or 1
+    count = args.get('count')
+    byweekday = args.get('byweekday')
+    bymonthday = args.get('bymonthday')
+    if byweekday is not None and freq != dateutil.rrule.WEEKLY:
+        return None
+    if bymonthday is not None and freq != dateutil.rrule.MONTHLY:
+        return None
+
+    if freq == dateutil.rrule.MONTHLY:
+        if isinstance(bymonthday, (list, tuple)):
+            if len(bymonthday) != 1:
+                return None
+            bymonthday = bymonthday[0]
+        day = base.day if bymonthday is None else bymonthday
+        if not isinstance(day, int) or not 1 <= day <= 31:
+            return None
+        # If dtstart is past ``day`` the first month doesn't count.
+        first = 0 if base.day <= day else 1
+        last = None
+        if count is not None:
+            if day > 28:
+                # Skipped months make the count irregular.
+                return None
+            last = first + count - 1
+        return [(MONTH, base, interval, first, last, day)]
+
+    if freq not in STEP_FREQS:
+        return None
+    step = STEP_FREQS[freq] * interval
+    last = None if count is None else count - 1
+
+    if freq != dateutil.rrule.WEEKLY or byweekday is None:
+        return [(STEP, base, step, 0, last, None)]
+
+    if not isinstance(byweekday, (list, tuple)):
+        byweekday = [byweekday]
+    weekdays = []
+    for weekday in byweekday:
+        if isinstance(weekday, int):
+            weekdays.append(weekday)
+        elif getattr(weekday, 'n', None) is None:
+            weekdays.append(weekday.weekday)
+        else:
+            return None
+    if count is not None and len(weekdays) > 1:
+        return None
+
+    wkst = args.get('wkst') or 0
+    if not isinstance(wkst, int):
+        wkst = wkst.weekday
+    week_start = base - ONE_DAY * ((base.weekday() - wkst) % 7)
+    series = []
+    for weekday in sorted(set(weekdays)):
+        start = week_start + ONE_DAY * ((weekday - wkst) % 7)
+        if start < base:
+            # The first week is only partly after dtstart.
+            first = 1
+        else:
+            first = 0
+        if last is not None:
+            series.append((STEP, start, step, first, first + last, None))
+        else:
+            series.append((STEP, start, step, first, None, None))
+    return series
+
+
+def to_wall(dt, tzinfo):
+    """Converts dt to a naive wall-clock datetime in tzinfo."""
+    if dt.tzinfo is not None and tzinfo is not None:
+        dt = dt.astimezone(tzinfo)
+    return dt.replace(tzinfo=None)
+
+
+def expand_series(compiled, start, end):
+    """Evaluates compiled series over [start, end).
+
+    :arg compiled: list of (index, series, dtstart, until) where dtstart
+        and until are naive wall-clock datetimes
+    :arg start: naive start of the window per item, as a list
+    :arg end: naive end of the window per item, as a list
+
+    :returns: list of (index, naive datetime)
+
+    """
+    results = []
+    for kind in (STEP, MONTH):
+        items = [(i, item) for i, item in enumerate(compiled)
+                 if item[1][0] == kind]
+        if not items:
+            continue
+        positions = numpy.array([i for i, item in items])
+        index = numpy.array([item[0] for i, item in items])
+        base = numpy.array([item[1][1] for i, item in items],
+                           dtype='datetime64[us]')
+        step = numpy.array([item[1][2] for i, item in items],
+                           dtype='int64')
+        first = numpy.array([item[1][3] for i, item in items],
+                            dtype='int64')
+        last = numpy.array(
+            [item[1][4] if item[1][4] is not None else 2 ** 40
+             for i, item in items], dtype='int64')
+        lo = numpy.array([start[i] for i in positions],
+                         dtype='datetime64[us]')
+        hi = numpy.array([end[i] for i in positions],
+                         dtype='datetime64[us]')
+        dtstart = numpy.array([item[2] for i, item in items],
+                              dtype='datetime64[us]')
+        until = numpy.array(
+            [item[3] if item[3] is not None else datetime.datetime.max
+             for i, item in items], dtype='datetime64[us]')
+
+        if kind == STEP:
+            step_us = step * 1000000
+            offset_lo = (lo - base).astype('int64')
+            offset_hi = (hi - base).astype('int64')
+            k_lo = numpy.maximum(first, offset_lo // step_us)
+            k_hi = numpy.minimum(last, offset_hi // step_us)
+        else:
+            base_month = base.astype('datetime64[M]').astype('int64')
+            lo_month = lo.astype('datetime64[M]').astype('int64')
+            hi_month = hi.astype('datetime64[M]').astype('int64')
+            k_lo = numpy.maximum(first, (lo_month - base_month) // step)
+            k_hi = numpy.minimum(last, (hi_month - base_month) // step)
+
+        counts = numpy.maximum(k_hi - k_lo + 1, 0)
+        total = int(counts.sum())
+        if total == 0:
+            continue
+        which = numpy.repeat(numpy.arange(len(items)), counts)
+        starts = numpy.cumsum(counts) - counts
+        k = k_lo[which] + (numpy.arange(total) - starts[which])
+
+        if kind == STEP:
+            dates = (base[which] +
+                     (k * step_us[which]).astype('timedelta64[us]'))
+            valid = numpy.ones(total, dtype=bool)
+        else:
+            months = base_month[which] + k * step[which]
+            days = numpy.array([item[1][5] for i, item in items],
+                               dtype='int64')[which]
+            month_starts = months.astype('datetime64[M]')
+            time_of_day = base - base.astype('datetime64[D]')
+            dates = (month_starts.astype('datetime64[us]') +
+                     ((days - 1) * 86400000000).astype('timedelta64[us]') +
+                     time_of_day[which])
+            valid = dates.astype('datetime64[M]') == month_starts
+
+        valid &= ((dates >= lo[which]) & (dates < hi[which]) &
+                  (dates >= dtstart[which]) & (dates <= until[which]))
+        for i, date in zip(index[which][valid].tolist(),
+                           dates[valid].tolist()):
+            results.append((i, date))
+    return results
+
+
+def expand_windows(windows):
+    """Returns the occurrences of each event in its own window.
+
+    :arg windows: list of (event, start, end) tuples; start and end are
+        aligned with the event's dates, so naive bounds are local time
+        for aware events
+
+    :returns: list with the sorted occurrences in [start, end) for each
+        window
+
+    """
+    results = [[] for window in windows]
+    compiled = []
+    windows_lo = []
+    windows_hi = []
+    for i, (event, start, end) in enumerate(windows):
+        series = None
+        if numpy is not None:
+            series = compile_rule(event.rule_args)
+        lo = align(start, event.rrule)
+        hi = align(end, event.rrule)
+        if series is None:
+            results[i] = [date
+                          for date in event.rrule.between(lo, hi, inc=True)
+                          if date < hi]
+            continue
+
+        dtstart = event.rule_args[1]['dtstart']
+        tzinfo = dtstart.tzinfo
+        until = event.rule_args[1].get('until')
+        if until is not None:
+            until = to_wall(until, tzinfo)
+        for item in series:
+            compiled.append(
+                (i, item, dtstart.replace(tzinfo=None), until))
+            windows_lo.append(to_wall(lo, tzinfo))
+            windows_hi.append(to_wall(hi, tzinfo))
+
+    if not compiled:
+        return results
+
+    touched = set()
+    for i, date in expand_series(compiled, windows_lo, windows_hi):
+        tzinfo = windows[i][0].rule_args[1]['dtstart'].tzinfo
+        results[i].append(date.replace(tzinfo=tzinfo))
+        touched.add(i)
+    # Weekly rules on several days are a series per day.
+    for i in touched:
+        results[i].sort()
+    return results
+
+
+def occurrences_between(events, start, end):
+    """Returns (event_id, occurrence) for every occurrence of events in
+    [start, end), sorted by occurrence.
+
+    start and end are aligned with each event's dates, so naive bounds
+    are local time for aware events.  Occurrences in different zones are
+    sorted by local time.
+
+    """
+    windows = [(event, start, end) for event in events]
+    pairs = []
+    for i, dates in enumerate(expand_windows(windows)):
+        pairs.extend([(i, date) for date in dates])
+    pairs.sort(key=lambda pair: (to_local(pair[1]), pair[0]))
+    return [(events[i].event_id, date) for i, date in pairs]
@@ -0,0 +1,219 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Fetches ics files from http and https URLs into the datadir.
+
+The ETag and Last-Modified headers of the last response are kept next
+to the copy and sent back with the next request.  If the server says
+the calendar hasn't changed, the copy is left alone, so its mtime
+doesn't change and the cache and index in the datadir stay good.
+
+Connections are kept open and reused for calendars on the same host.
+"""
+
+import hashlib
+import json
+import os
+import urlparse
+import zlib
+
+from phil._version import __version__
+
+
+USER_AGENT = 'phil/{0}'.format(__version__)
+
+# Seconds to wait for the server.
+TIMEOUT = 30
+
+MAX_REDIRECTS = 5
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class FetchError(Exception):
+    pass
+
+
+def is_url(icsfile):
+    return icsfile.startswith(('http://', 'https://'))
+
+
+def get_fetch_path(datadir, url):
+    """Returns where the copy of the calendar at url is kept."""
+    key = hashlib.sha1(url).hexdigest()[:12]
+    return os.path.join(datadir, 'remote-{0}.ics'.format(key))
+
+
+def get_meta_path(path):
+    return path + '.meta'
+
+
+def load_meta(path):
+    """Returns the validators saved for the copy at path."""
+    if not os.path.exists(path):
+        # Validators are no good without the copy they're for.
+        return {}
+    try:
+        f = open(get_meta_path(path), 'rb')
+    except IOError:
+        return {}
+    try:
+        try:
+            meta = json.load(f)
+        except ValueError:
+            return {}
+    finally:
+        f.close()
+    if not isinstance(meta, dict):
+        return {}
+    return meta
+
+
+def write_file(path, data):
+    tmppath = path + '.tmp'
+    f = open(tmppath, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmppath, path)
+
+
+class Fetcher(object):
+    """Fetches URLs over kept-alive connections, one per host.
+
+    :arg timeout: seconds to wait for the server
+
+    """
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        # (scheme, netloc) -> HTTPConnection
+        self.connections = {}
+
+    def _connection(self, scheme, netloc):
+        key = (scheme, netloc)
+        if key not in self.connections:
+            import httplib
+
+            if scheme == 'https':
+                cls = httplib.HTTPSConnection
+            else:
+                cls = httplib.HTTPConnection
+            self.connections[key] = cls(netloc, timeout=self.timeout)
+        return self.connections[key]
+
+    def _drop(self, scheme, netloc):
+        conn = self.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def request(self, url, headers):
+        """GETs url and returns (status, reason, headers, body).
+
+        headers in the result is a dict with lowercase names.
+
+        :raises FetchError: if the server can't be reached
+
+        """
+        import httplib
+        import socket
+
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise FetchError('{0}: not an http or https URL'.format(url))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        headers = dict(headers, **{
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'gzip'
+            })
+
+        # A kept-alive connection may have been closed by the server
+        # since it was last used, so a failure on a reused connection
+        # gets one more try on a new one.
+        reused = (parts.scheme, parts.netloc) in self.connections
+        while True:
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                break
+            except (httplib.HTTPException, socket.error), exc:
+                self._drop(parts.scheme, parts.netloc)
+                if not reused:
+                    raise FetchError('{0}: {1}'.format(url, exc))
+                reused = False
+
+        if resp.will_close:
+            self._drop(parts.scheme, parts.netloc)
+
+        resp_headers = dict(resp.getheaders())
+        if resp_headers.get('content-encoding') == 'gzip':
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            except zlib.error, exc:
+                raise FetchError('{0}: {1}'.format(url, exc))
+        return resp.status, resp.reason, resp_headers, body
+
+    def fetch(self, url, path):
+        """Fetches url to path unless the copy at path is current.
+
+        :returns: True if path was written, False if the server said
+            the copy hasn't changed
+
+        :raises FetchError: if the calendar couldn't be fetched
+
+        """
+        meta = load_meta(path)
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        location = url
+        for i in range(MAX_REDIRECTS + 1):
+            status, reason, resp_headers, body = self.request(
+                location, headers)
+            if status not in REDIRECTS or 'location' not in resp_headers:
+                break
+            location = urlparse.urljoin(location, resp_headers['location'])
+        else:
+            raise FetchError('{0}: too many redirects'.format(url))
+
+        if status == 304:
+            return False
+        if status != 200:
+            raise FetchError('{0}: HTTP {1} {2}'.format(url, status, reason))
+
+        write_file(path, body)
+        write_file(get_meta_path(path), json.dumps({
+            'url': url,
+            'etag': resp_headers.get('etag'),
+            'last_modified': resp_headers.get('last-modified')
+            }))
+        return True
+
+    def close(self):
+        for scheme, netloc in self.connections.keys():
+            self._drop(scheme, netloc)
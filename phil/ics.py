@@ -0,0 +1,455 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Parses ics files into Events.
+
+This is the only part of phil that needs icalendar and dateutil, so
+it's imported by the code paths that read calendars rather than with
+the rest of the package.
+"""
+
+import datetime
+import re
+import time
+
+import icalendar
+from icalendar import vText
+import dateutil.rrule
+
+import phil.zones
+from phil.util import Event, to_local
+
+
+FREQ_MAP = {
+    'SECONDLY': dateutil.rrule.SECONDLY,
+    'MINUTELY': dateutil.rrule.MINUTELY,
+    'HOURLY': dateutil.rrule.HOURLY,
+    'DAILY': dateutil.rrule.DAILY,
+    'WEEKLY': dateutil.rrule.WEEKLY,
+    'MONTHLY': dateutil.rrule.MONTHLY,
+    'YEARLY': dateutil.rrule.YEARLY
+    }
+
+
+WEEKDAY_MAP = {
+    'SU': dateutil.rrule.SU,
+    'MO': dateutil.rrule.MO,
+    'TU': dateutil.rrule.TU,
+    'WE': dateutil.rrule.WE,
+    'TH': dateutil.rrule.TH,
+    'FR': dateutil.rrule.FR,
+    'SA': dateutil.rrule.SA
+    }
+
+# A BYDAY value like MO, 2TU or -1FR
+WEEKDAY_RE = re.compile(r'^([+-]?\d+)?([A-Z]{2})$')
+
+# RRULE parts that are lists of numbers
+NUMBER_LISTS = ['bysetpos', 'bymonth', 'bymonthday', 'byyearday',
+                'byweekno', 'byhour', 'byminute', 'bysecond']
+
+# Finds VEVENTs that change one occurrence of another VEVENT.
+RECURRENCE_ID_RE = re.compile(r'^RECURRENCE-ID[;:]', re.I | re.M)
+
+
+def convert_weekday(value):
+    """Converts a BYDAY or WKST value to a dateutil weekday."""
+    match = WEEKDAY_RE.match(value.strip().upper())
+    if match is None or match.group(2) not in WEEKDAY_MAP:
+        raise ValueError('"{0}" is not a weekday.'.format(value))
+    n, day = match.groups()
+    if n:
+        return WEEKDAY_MAP[day](int(n))
+    return WEEKDAY_MAP[day]
+
+
+def convert_rrule(rrule):
+    """Converts an icalendar RRULE to (freq, args) for dateutil's
+    rrule.
+
+    """
+    freq = FREQ_MAP[rrule['freq'][0].upper()]
+
+    args = {}
+    for key in NUMBER_LISTS:
+        if rrule.get(key):
+            # icalendar's vInt won't do for dateutil or the cache.
+            args[key] = [int(value) for value in rrule[key]]
+    for key in ('interval', 'count'):
+        if rrule.get(key):
+            args[key] = int(rrule[key][0])
+    if rrule.get('until'):
+        args['until'] = rrule['until'][0]
+    if rrule.get('wkst'):
+        args['wkst'] = convert_weekday(rrule['wkst'][0])
+    if rrule.get('byday'):
+        args['byweekday'] = [convert_weekday(value)
+                             for value in rrule['byday']]
+
+    return freq, args
+
+
+def get_list(component, name):
+    """Returns the values of a property that can appear more than once
+    as a list.
+
+    """
+    values = component.get(name, [])
+    if not isinstance(values, list):
+        return [values]
+    return values
+
+
+def get_tzid(component):
+    """Returns the TZID of component's DTSTART or None."""
+    return component['dtstart'].params.get('TZID')
+
+
+def localize(value, tzid, zones):
+    """Puts the datetime value in the zone for tzid."""
+    if tzid is not None and isinstance(value, datetime.datetime):
+        # Floating if phil doesn't know the zone.
+        value = value.replace(tzinfo=phil.zones.get_zone(tzid, zones))
+    return value
+
+
+def match_dtstart(value, dtstart):
+    """Returns the datetime value so dateutil can compare it with
+    dtstart's occurrences.
+
+    """
+    if dtstart.tzinfo is None:
+        return to_local(value)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=dtstart.tzinfo)
+    return value
+
+
+def convert_until(until, dtstart):
+    """Returns UNTIL as something dateutil can compare with dtstart's
+    occurrences.
+
+    """
+    if not isinstance(until, datetime.datetime):
+        # A date UNTIL includes that whole day.
+        until = datetime.datetime.combine(until, datetime.time(23, 59, 59))
+    return match_dtstart(until, dtstart)
+
+
+def convert_date(value, tzid, dtstart, zones):
+    """Converts a DTSTART, RDATE, EXDATE or RECURRENCE-ID value to a
+    datetime like dtstart.
+
+    """
+    if isinstance(value, tuple):
+        # An RDATE period; the occurrence is when it starts.
+        value = value[0]
+    value = localize(value, tzid, zones)
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, dtstart.time())
+    return match_dtstart(value, dtstart)
+
+
+def get_dates(component, name, dtstart, zones):
+    """Returns the dates of every RDATE or EXDATE in component."""
+    dates = []
+    for prop in get_list(component, name):
+        tzid = prop.params.get('TZID')
+        dates.extend([convert_date(item.dt, tzid, dtstart, zones)
+                      for item in prop.dts])
+    return dates
+
+
+# Attendees that don't get reminders.
+SKIP_PARTSTATS = ('DECLINED',)
+SKIP_CUTYPES = ('ROOM', 'RESOURCE')
+
+
+def get_address(prop):
+    """Returns the address in an ORGANIZER or ATTENDEE property or None
+    if it's not an email address.
+
+    The CN parameter, if there is one, is kept as the name.
+
+    """
+    value = vText.from_ical(prop).strip()
+    if value.lower().startswith('mailto:'):
+        value = value[len('mailto:'):]
+    if '@' not in value:
+        return None
+    name = getattr(prop, 'params', {}).get('CN')
+    if name:
+        return u'"{0}" <{1}>'.format(name.replace('"', ''), value)
+    return value
+
+
+def get_people(component):
+    """Returns (organizer, attendees) for a VEVENT.
+
+    Attendees that declined and rooms and resources are left out.
+
+    """
+    organizer = None
+    if 'organizer' in component:
+        organizer = get_address(component['organizer'])
+
+    attendees = []
+    for prop in get_list(component, 'attendee'):
+        params = getattr(prop, 'params', {})
+        if (params.get('PARTSTAT', '').upper() in SKIP_PARTSTATS
+                or params.get('CUTYPE', '').upper() in SKIP_CUTYPES):
+            continue
+        address = get_address(prop)
+        if address is not None:
+            attendees.append(address)
+    return organizer, tuple(attendees)
+
+
+def get_properties(component):
+    """Returns a sorted tuple of (name, value) for the X- properties
+    of component.
+
+    """
+    properties = []
+    for name in component.keys():
+        if not name.upper().startswith('X-'):
+            continue
+        for value in get_list(component, name):
+            properties.append((name.upper(), vText.from_ical(value)))
+    return tuple(sorted(properties))
+
+
+def get_event_id(component):
+    """Returns the id for a VEVENT or None if it doesn't have a UID.
+
+    The id is the UID, plus the RECURRENCE-ID for an occurrence that's
+    an event of its own, so it stays the same when the meeting is
+    renamed or moved.
+
+    """
+    uid = vText.from_ical(component.get('uid', u'')).strip()
+    if not uid:
+        return None
+    if 'recurrence-id' in component:
+        return u'{0}::{1}'.format(
+            uid, component['recurrence-id'].to_ical().decode('utf-8'))
+    return uid
+
+
+def is_cancelled(component):
+    return str(component.get('status', '')).upper() == 'CANCELLED'
+
+
+def convert_event(component, zones=None, overrides=()):
+    """Converts an icalendar VEVENT component to an Event.
+
+    An event with one RRULE and nothing else gets a dateutil rrule.
+    Anything else--RDATEs, EXDATEs, more than one rule, no rule at all
+    or overrides--gets an rruleset.
+
+    :arg zones: dict of TZID -> Zone for the VTIMEZONEs in the ics file
+    :arg overrides: VEVENTs with the same UID and a RECURRENCE-ID; each
+        moves or cancels one occurrence
+
+    """
+    # The id is from the DTSTART as icalendar parses it so it doesn't
+    # change with how phil handles timezones.
+    original_dtstart = component['dtstart'].dt
+    dtstart = localize(original_dtstart, get_tzid(component), zones)
+    if not isinstance(dtstart, datetime.datetime):
+        # An all-day event.
+        dtstart = datetime.datetime.combine(dtstart, datetime.time())
+
+    rules = []
+    for rrule in get_list(component, 'rrule'):
+        freq, args = convert_rrule(rrule)
+        args['dtstart'] = dtstart
+        if 'until' in args:
+            args['until'] = convert_until(args['until'], dtstart)
+        rules.append((freq, args))
+
+    exrules = []
+    for exrule in get_list(component, 'exrule'):
+        freq, args = convert_rrule(exrule)
+        args['dtstart'] = dtstart
+        if 'until' in args:
+            args['until'] = convert_until(args['until'], dtstart)
+        exrules.append(dateutil.rrule.rrule(freq, **args))
+
+    rdates = get_dates(component, 'rdate', dtstart, zones)
+    exdates = get_dates(component, 'exdate', dtstart, zones)
+    for override in overrides:
+        prop = override['recurrence-id']
+        exdates.append(convert_date(
+            prop.dt, prop.params.get('TZID'), dtstart, zones))
+        if not is_cancelled(override):
+            prop = override['dtstart']
+            rdates.append(convert_date(
+                prop.dt, prop.params.get('TZID'), dtstart, zones))
+
+    if len(rules) == 1 and not (exrules or rdates or exdates):
+        freq, args = rules[0]
+        rule = dateutil.rrule.rrule(freq, **args)
+        rule_args = rules[0]
+    else:
+        rule = dateutil.rrule.rruleset()
+        for freq, args in rules:
+            rule.rrule(dateutil.rrule.rrule(freq, **args))
+        if not rules:
+            rule.rdate(dtstart)
+        for exrule in exrules:
+            rule.exrule(exrule)
+        for date in rdates:
+            rule.rdate(date)
+        for date in exdates:
+            rule.exdate(date)
+        rule_args = None
+
+    summary = vText.from_ical(component.get('summary', u''))
+    description = vText.from_ical(component.get('description', u''))
+    organizer = vText.from_ical(component.get('organizer', u''))
+
+    # Older versions of phil composed the id from the DTSTART, summary
+    # and organizer, so it changed whenever the meeting was edited.
+    legacy_id = "::".join((str(original_dtstart), summary, organizer))
+    event_id = get_event_id(component)
+    if event_id is None:
+        event_id, legacy_id = legacy_id, None
+
+    organizer, attendees = get_people(component)
+    return Event(event_id, rule, summary, description, rule_args,
+                 organizer, attendees, get_properties(component), legacy_id)
+
+
+BLOCKS = ('VEVENT', 'VTIMEZONE')
+
+
+def iter_blocks(lines):
+    """Takes an iterable of ics lines and yields (name, text) for each
+    VEVENT and VTIMEZONE.
+
+    Folded lines start with whitespace, so they never look like
+    ``BEGIN:`` or ``END:`` lines and are passed through untouched for
+    icalendar to unfold.
+
+    """
+    block = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        upper = line.upper()
+        if block is None:
+            if upper.startswith('BEGIN:') and upper[6:] in BLOCKS:
+                name = upper[6:]
+                block = [line]
+        else:
+            block.append(line)
+            if upper == 'END:' + name:
+                yield name, '\r\n'.join(block) + '\r\n'
+                block = None
+
+
+def iter_vevents(lines):
+    """Takes an iterable of ics lines and yields the text of each
+    VEVENT.
+
+    """
+    for name, text in iter_blocks(lines):
+        if name == 'VEVENT':
+            yield text
+
+
+def index_ics(icsfile):
+    """Reads icsfile once for what's needed before its events can be
+    converted.
+
+    :returns: (zones, overrides) where zones is a dict of TZID -> Zone
+        and overrides is a dict of UID -> list of VEVENT components
+        with a RECURRENCE-ID
+
+    """
+    zones = {}
+    overrides = {}
+    f = open(icsfile, 'rb')
+    try:
+        for name, text in iter_blocks(f):
+            if name == 'VTIMEZONE':
+                try:
+                    zone = phil.zones.load_zone(None, text)
+                except (ValueError, KeyError):
+                    # Events using it are floating.
+                    continue
+                zones[zone.name] = zone
+            elif RECURRENCE_ID_RE.search(text):
+                component = icalendar.Event.from_ical(text)
+                uid = component.get('uid')
+                if uid is not None:
+                    overrides.setdefault(uid, []).append(component)
+    finally:
+        f.close()
+    return zones, overrides
+
+
+def iter_ics(icsfile, metrics=None):
+    """Takes an icsfilename and yields Events one at a time.
+
+    The file is read twice: once to find the VTIMEZONEs and the
+    VEVENTs that override occurrences of others, and again to convert
+    the VEVENTs one at a time.  Only one VEVENT and the overrides are
+    held in memory at a time, so this works for ics files of any size.
+
+    If metrics is given, parsing and converting each VEVENT are timed.
+
+    """
+    zones, overrides = index_ics(icsfile)
+    used = set()
+    f = open(icsfile, 'rb')
+    try:
+        for name, text in iter_blocks(f):
+            if name != 'VEVENT':
+                continue
+
+            start = time.time()
+            component = icalendar.Event.from_ical(text)
+            parsed = time.time()
+            uid = component.get('uid')
+            if 'recurrence-id' in component and uid in overrides:
+                # It goes with the event it overrides.
+                continue
+            if uid in overrides:
+                used.add(uid)
+            event = convert_event(component, zones, overrides.get(uid, ()))
+            if metrics is not None:
+                metrics.add_time('ics_parse', parsed - start)
+                metrics.add_time('rrule_convert', time.time() - parsed)
+            yield event
+    finally:
+        f.close()
+
+    # Overrides of events that aren't in the file are events of their
+    # own.
+    for uid, components in sorted(overrides.items()):
+        if uid not in used:
+            for component in components:
+                yield convert_event(component, zones)
+
+
+def parse_ics(icsfile):
+    """Takes an icsfilename, parses it, and returns Events."""
+    return list(iter_ics(icsfile))
@@ -0,0 +1,246 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Keeps a sorted window of upcoming occurrences for each event so
+next-date lookups are a bisect instead of iterating the rrule from its
+dtstart every time.
+
+dateutil iterates every rule from its dtstart, so the cost of
+``rrule.after`` grows with the age of the event.  The index pays that
+once per window and the window is saved in the datadir next to the
+state.  Windows are expanded with :py:mod:`phil.expand`, and
+``OccurrenceIndex.fill`` expands the windows of a batch of events at
+once.
+"""
+
+import bisect
+import cPickle
+import datetime
+import os
+
+from phil.cache import CACHE_VERSION, PICKLE_ERRORS, get_stamp
+from phil.util import align, align_with
+
+
+# How far ahead of the requested date each extension of the window
+# goes.
+WINDOW = datetime.timedelta(days=90)
+
+# How many events a run hands to OccurrenceIndex.fill at once.
+BATCH = 500
+
+
+class Occurrences(object):
+    """The occurrences of one event between start and horizon.
+
+    ``dates`` holds every occurrence in [start, horizon).  A horizon of
+    None means the rule has no occurrences after the last one in
+    ``dates``.
+
+    """
+    def __init__(self, start):
+        self.start = start
+        self.horizon = start
+        self.dates = []
+
+
+class OccurrenceIndex(object):
+    """Upcoming occurrences of events keyed by event_id.
+
+    :arg path: where to save the index or None to keep it in memory
+    :arg fingerprint: identifies the ics file the index was built from;
+        a saved index with a different fingerprint is thrown away
+
+    """
+    def __init__(self, path=None, fingerprint=None, window=WINDOW):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.window = window
+        self.entries = {}
+        # event_ids looked up since the index was loaded
+        self.seen = set()
+
+    @classmethod
+    def load(cls, datadir, name, icsfile):
+        """Returns the index saved in datadir for calendar name, or a new
+        one if there isn't one for the current version of icsfile.
+
+        """
+        path = get_index_path(datadir, name)
+        # Dates in the index are the Events' dates, so it goes stale
+        # with the cache, too.
+        index = cls(path, (CACHE_VERSION,) + get_stamp(icsfile))
+        if not os.path.exists(path):
+            return index
+
+        f = open(path, 'rb')
+        try:
+            try:
+                fingerprint, entries = cPickle.load(f)
+            except PICKLE_ERRORS:
+                return index
+        finally:
+            f.close()
+
+        if fingerprint == index.fingerprint:
+            index.entries = entries
+        return index
+
+    def save(self):
+        if self.path is None:
+            return
+        tmppath = self.path + '.tmp'
+        f = open(tmppath, 'wb')
+        try:
+            cPickle.dump((self.fingerprint, self.entries), f,
+                         cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmppath, self.path)
+
+    def prune(self, before, event_ids=None):
+        """Drops occurrences before ``before`` and entries for events
+        not in event_ids so the saved index doesn't grow forever.
+
+        """
+        if event_ids is not None:
+            for event_id in self.entries.keys():
+                if event_id not in event_ids:
+                    del self.entries[event_id]
+
+        for entry in self.entries.values():
+            date = align_with(before, entry.start)
+            if entry.start >= date:
+                continue
+            i = bisect.bisect_left(entry.dates, date)
+            del entry.dates[:i]
+            entry.start = date
+
+    def _get_entry(self, event, dt):
+        entry = self.entries.get(event.event_id)
+        if entry is None or dt < entry.start:
+            entry = self.entries[event.event_id] = Occurrences(dt)
+        return entry
+
+    def _next_window(self, entry, dt):
+        """Returns (start, end) of the window that extends entry past dt
+        by one window.
+
+        """
+        if dt > entry.horizon:
+            # Skip over the gap rather than materializing it.  Nothing
+            # before dt is needed any more.
+            entry.start = entry.horizon = dt
+            entry.dates = []
+        return entry.horizon, max(entry.horizon, dt) + self.window
+
+    def _extend(self, entry, event, dt):
+        """Extends entry past dt by one window."""
+        from phil.expand import expand_windows
+
+        start, horizon = self._next_window(entry, dt)
+        dates, = expand_windows([(event, start, horizon)])
+        if not dates:
+            # Nothing in this window.  Jump straight to the next
+            # occurrence or find out there isn't one.
+            date = event.rrule.after(start, inc=True)
+            if date is None:
+                entry.horizon = None
+                return
+            horizon = date + self.window
+            dates, = expand_windows([(event, date, horizon)])
+
+        entry.dates.extend(dates)
+        entry.horizon = horizon
+
+    def fill(self, events, dt):
+        """Extends the entries of events that have nothing at or after
+        dt by one window, expanding all those windows together.
+
+        ``after(event, dt, inc=True)`` is then a bisect for every event
+        that has an occurrence in the window.
+
+        """
+        from phil.expand import expand_windows
+
+        windows = []
+        entries = []
+        for event in events:
+            date = align(dt, event.rrule)
+            entry = self._get_entry(event, date)
+            if entry.horizon is None:
+                continue
+            if bisect.bisect_left(entry.dates, date) < len(entry.dates):
+                continue
+            start, horizon = self._next_window(entry, date)
+            windows.append((event, start, horizon))
+            entries.append(entry)
+
+        for entry, (event, start, horizon), dates in zip(
+                entries, windows, expand_windows(windows)):
+            entry.dates.extend(dates)
+            entry.horizon = horizon
+
+    def after(self, event, dt, inc=False):
+        """Returns the first occurrence of event after dt (or at dt if
+        inc is True) or None if there isn't one.
+
+        """
+        dt = align(dt, event.rrule)
+        self.seen.add(event.event_id)
+        entry = self._get_entry(event, dt)
+
+        while True:
+            if inc:
+                i = bisect.bisect_left(entry.dates, dt)
+            else:
+                i = bisect.bisect_right(entry.dates, dt)
+            if i < len(entry.dates):
+                return entry.dates[i]
+            if entry.horizon is None:
+                return None
+            self._extend(entry, event, dt)
+
+    def next_n(self, event, dt, count):
+        """Returns up to count occurrences of event at or after dt."""
+        dates = []
+        date = self.after(event, dt, inc=True)
+        while date is not None and len(dates) < count:
+            dates.append(date)
+            date = self.after(event, date)
+        return dates
+
+
+def iter_batches(iterable, size=BATCH):
+    """Yields lists of up to size items from iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_index_path(datadir, name=None):
+    if not name or name == 'default':
+        return os.path.join(datadir, 'occurrences.cache')
+    return os.path.join(datadir, 'occurrences-{0}.cache'.format(name))
@@ -0,0 +1,452 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+import Queue
+import sys
+import threading
+import time
+from collections import namedtuple
+
+# smtplib and email are imported where they're used.  Together they
+# take longer to import than the rest of phil.
+
+
+# How a message is delivered to its recipients:
+#
+# to:   one transaction with everyone in the To: header
+# each: one transaction per recipient with only them in the To: header
+# bcc:  one transaction with the recipients left out of the headers
+DELIVERIES = ('to', 'each', 'bcc')
+
+UNDISCLOSED = 'undisclosed-recipients:;'
+
+
+class DeliveryError(Exception):
+    """Raised when a message got to some of its recipients but not all
+    of them.
+
+    :arg failed: the entries of the message's to_list that didn't get
+        it
+    :arg error: why
+
+    """
+    def __init__(self, failed, error):
+        Exception.__init__(self, '{0} (not sent to {1})'.format(
+            error, ', '.join(failed)))
+        self.failed = tuple(failed)
+        self.error = error
+
+
+def get_failed(to_list, error):
+    """Returns the entries of to_list that didn't get a message that
+    failed with error.
+
+    """
+    if isinstance(error, DeliveryError):
+        return error.failed
+    return tuple(to_list)
+
+
+def get_refused(to_list, refused):
+    """Returns the entries of to_list whose addresses are in refused."""
+    refused = set([addr.lower() for addr in refused])
+    return tuple([address for address in to_list
+                  if get_address_key(address) in refused])
+
+
+Message = namedtuple('Message', ['sender', 'to_list', 'subject', 'body',
+                                 'delivery'])
+Message.__new__.__defaults__ = ('to',)
+
+
+def get_address_key(address):
+    """Returns the lowercase email address in address, which can have
+    a name, for comparing addresses.
+
+    """
+    import email.utils
+
+    return email.utils.parseaddr(address)[1].lower()
+
+
+def unique_addresses(addresses):
+    """Returns a tuple of addresses without blanks or repeats of the
+    same email address.  The first form of each address is kept.
+
+    """
+    seen = set()
+    unique = []
+    for address in addresses:
+        if isinstance(address, unicode):
+            address = address.encode('utf-8')
+        address = address.strip()
+        key = get_address_key(address)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        unique.append(address)
+    return tuple(unique)
+
+
+def build_envelopes(sender, to_list, subject, body, delivery='each'):
+    """Builds the transactions for a message.
+
+    The body and the headers every recipient shares are encoded once
+    and only the To: header is added for each transaction, so sending
+    a message to many people separately costs about as much as
+    sending it once.
+
+    Returns a list of (sender address, recipient addresses, message
+    text) tuples.
+
+    """
+    import email.utils
+    from email.mime.text import MIMEText
+
+    if delivery not in DELIVERIES:
+        raise ValueError('"{0}" is not a delivery.'.format(delivery))
+
+    sender_name, sender_addr = email.utils.parseaddr(sender)
+    to_list = [email.utils.parseaddr(addr) for addr in to_list]
+    to_addrs = [to_addr for to_name, to_addr in to_list]
+
+    msg = MIMEText(body)
+    msg['From'] = email.utils.formataddr((sender_name, sender_addr))
+    msg['Subject'] = subject
+    common = msg.as_string()
+
+    if delivery == 'each':
+        return [
+            (sender_addr, [to[1]],
+             'To: ' + email.utils.formataddr(to) + '\n' + common)
+            for to in to_list]
+
+    if delivery == 'bcc':
+        to_header = UNDISCLOSED
+    else:
+        to_header = ', '.join([email.utils.formataddr(to) for to in to_list])
+    return [(sender_addr, to_addrs, 'To: ' + to_header + '\n' + common)]
+
+
+def build_message(sender, to_list, subject, body):
+    """Builds the message for a single multi-recipient transaction.
+
+    Returns a tuple of (sender address, recipient addresses, message
+    text).
+
+    """
+    return build_envelopes(sender, to_list, subject, body, 'to')[0]
+
+
+class RateLimiter(object):
+    """Token bucket that spaces out messages to an SMTP host.
+
+    Tokens are added at ``rate`` per minute up to ``burst``.  Each
+    message takes one, waiting until there is one if the bucket is
+    empty.  Threads reserve their token before sleeping, so together
+    they send at the rate rather than all waking up at once.
+
+    ``waited`` is the total seconds spent waiting.
+
+    """
+    def __init__(self, rate, burst=1, clock=None, sleep=None):
+        self.rate = rate / 60.0
+        self.burst = max(burst, 1)
+        self.clock = clock or time.time
+        self.sleep = sleep or time.sleep
+        self.tokens = float(self.burst)
+        self.last = self.clock()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token and returns how many seconds it waited."""
+        self._lock.acquire()
+        try:
+            now = self.clock()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = max(0.0, -self.tokens / self.rate)
+            self.waited += wait
+        finally:
+            self._lock.release()
+
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class Mailer(object):
+    """Keeps one SMTP session open across all the mail in a run.
+
+    The connection is opened on the first ``send`` and reused until
+    ``close`` is called.  Unless ``delivery`` says otherwise, every
+    recipient gets their own copy of a message, in a transaction of
+    its own on that connection.
+
+    If there's a ``limiter``, every transaction waits for it first.
+
+    After sending, ``timings`` holds a (subject, seconds) tuple for
+    each message, not counting time spent waiting for the limiter,
+    and ``waited`` holds the seconds spent waiting.  ``connect_timings``
+    holds the seconds each connection took to open.
+
+    """
+    def __init__(self, host, port, limiter=None):
+        self.host = host
+        self.port = port
+        self.limiter = limiter
+        self.server = None
+        self.timings = []
+        self.connect_timings = []
+        self.waited = 0.0
+
+    def connect(self):
+        import smtplib
+
+        if self.server is None:
+            start = time.time()
+            self.server = smtplib.SMTP(self.host, self.port)
+            self.connect_timings.append(time.time() - start)
+        return self.server
+
+    def send(self, sender, to_list, subject, body, delivery='each'):
+        """Sends a message and returns how long it took in seconds.
+
+        :raises DeliveryError: if the message went to some recipients
+            before a later transaction failed
+
+        """
+        import smtplib
+
+        start = time.time()
+        envelopes = build_envelopes(sender, to_list, subject, body, delivery)
+
+        waited = 0.0
+        sent = 0
+        # address -> (code, message) for recipients the server refused
+        # in transactions it otherwise accepted
+        refused = {}
+        try:
+            for sender_addr, to_addrs, text in envelopes:
+                if self.limiter is not None:
+                    waited += self.limiter.acquire()
+                try:
+                    refused.update(self.connect().sendmail(
+                        sender_addr, to_addrs, text) or {})
+                except smtplib.SMTPServerDisconnected:
+                    # The server hung up on us between messages.
+                    # Reconnect and try once more.
+                    self.server = None
+                    refused.update(self.connect().sendmail(
+                        sender_addr, to_addrs, text) or {})
+                sent += 1
+        except Exception, exc:
+            if not sent:
+                raise
+            # Only "each" delivery has more than one transaction, one
+            # per recipient in to_list order.
+            raise DeliveryError(
+                get_refused(to_list, refused) + tuple(to_list[sent:]), exc)
+
+        elapsed = time.time() - start - waited
+        self.waited += waited
+        self.timings.append((subject, elapsed))
+        if refused:
+            raise DeliveryError(get_refused(to_list, refused),
+                                smtplib.SMTPRecipientsRefused(refused))
+        return elapsed
+
+    def close(self):
+        if self.server is None:
+            return
+
+        import smtplib
+        try:
+            self.server.quit()
+        except smtplib.SMTPServerDisconnected:
+            pass
+        self.server = None
+
+
+class MailerPool(object):
+    """Hands out Mailers, at most ``limit`` at a time per SMTP host.
+
+    Mailers are handed back with ``release`` and reused, so their
+    connections stay open for the life of the pool.
+
+    :arg limit: the default number of connections per host
+    :arg host_limits: dict of host -> number of connections overriding
+        ``limit`` for that host
+    :arg host_rates: dict of host -> (messages per minute, burst) for
+        hosts that limit how fast they accept mail
+
+    """
+    def __init__(self, limit=1, host_limits=None, host_rates=None):
+        self.limit = limit
+        self.host_limits = host_limits or {}
+        self.host_rates = host_rates or {}
+        self.mailers = []
+        self._free = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def _get_limiter(self, host):
+        if host not in self.host_rates:
+            return None
+        if host not in self._limiters:
+            rate, burst = self.host_rates[host]
+            self._limiters[host] = RateLimiter(rate, burst)
+        return self._limiters[host]
+
+    def acquire(self, host, port):
+        """Returns a Mailer for host/port, blocking until one is free."""
+        key = (host, port)
+        self._lock.acquire()
+        try:
+            if key not in self._free:
+                free = Queue.Queue()
+                limit = max(self.host_limits.get(host, self.limit), 1)
+                limiter = self._get_limiter(host)
+                for i in range(limit):
+                    mailer = Mailer(host, port, limiter)
+                    self.mailers.append(mailer)
+                    free.put(mailer)
+                self._free[key] = free
+            free = self._free[key]
+        finally:
+            self._lock.release()
+        return free.get()
+
+    def release(self, mailer):
+        self._free[(mailer.host, mailer.port)].put(mailer)
+
+    @property
+    def timings(self):
+        timings = []
+        for mailer in self.mailers:
+            timings.extend(mailer.timings)
+        return timings
+
+    @property
+    def connect_timings(self):
+        timings = []
+        for mailer in self.mailers:
+            timings.extend(mailer.connect_timings)
+        return timings
+
+    @property
+    def waited(self):
+        return sum([mailer.waited for mailer in self.mailers])
+
+    def close(self):
+        for mailer in self.mailers:
+            mailer.close()
+
+
+class Dispatcher(object):
+    """Sends messages from a queue with a pool of worker threads.
+
+    Usage::
+
+        dispatcher = Dispatcher(pool, workers=4)
+        dispatcher.start()
+        dispatcher.submit(token, host, port, message)
+        ...
+        for token, error in dispatcher.join():
+            ...
+
+    ``join`` returns a (token, error) tuple for every submitted
+    message where error is None if the server accepted it.  With one
+    worker, messages are sent as they're submitted in the calling
+    thread.
+
+    If ``callback`` is given, it's called with (token, error) as soon
+    as each message is done, from whichever thread sent it.  If it
+    raises, the message counts as failed and ``join`` raises the
+    first such error once every message is done.
+
+    """
+    def __init__(self, pool, workers=1, callback=None):
+        self.pool = pool
+        self.workers = workers
+        self.callback = callback
+        self.results = []
+        self._queue = Queue.Queue()
+        self._threads = []
+        # exc_info of the first exception the callback raised
+        self._exc_info = None
+
+    def _send(self, token, host, port, message):
+        error = None
+        try:
+            mailer = self.pool.acquire(host, port)
+            try:
+                mailer.send(*message)
+            finally:
+                self.pool.release(mailer)
+        except Exception, exc:
+            error = exc
+
+        if self.callback is not None:
+            try:
+                self.callback(token, error)
+            except Exception, exc:
+                # Whatever the callback does with the result didn't
+                # happen.  The worker carries on and join() raises it.
+                if self._exc_info is None:
+                    self._exc_info = sys.exc_info()
+                if error is None:
+                    error = exc
+        self.results.append((token, error))
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self._send(*job)
+
+    def start(self):
+        if self.workers <= 1:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, token, host, port, message):
+        if not self._threads:
+            self._send(token, host, port, message)
+        else:
+            self._queue.put((token, host, port, message))
+
+    def join(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self.results
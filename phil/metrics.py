@@ -0,0 +1,166 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Counts and timings for a run of a calendar.
+
+Timings are kept per stage as a count and total seconds.  The stages
+are:
+
+* ``state_load``, ``state_save``: opening and closing the state store
+* ``fetch``: fetching the ics file when it's a URL
+* ``cache_load``: reading Events from the cache
+* ``ics_parse``: parsing VEVENTs with icalendar
+* ``rrule_convert``: turning VEVENTs into Events
+* ``evaluate``: working out whether an event needs a reminder
+* ``render``: building a reminder's message
+* ``smtp_connect``, ``smtp_send``: talking to the SMTP server
+* ``rate_wait``: waiting for ``smtp_rate``
+* ``run``: the whole run
+
+Metrics are written to datadir after the run if the ``metrics`` option
+says how: ``json`` appends a JSON line to metrics.jsonl and
+``prometheus`` writes phil.prom for the node_exporter textfile
+collector.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+FORMATS = ('json', 'prometheus')
+
+
+def get_metrics_path(datadir, name, fmt):
+    if fmt == 'json':
+        fn = 'metrics.jsonl'
+    else:
+        fn = 'phil.prom'
+    if name and name != 'default':
+        base, ext = os.path.splitext(fn)
+        fn = '{0}-{1}{2}'.format(base, name, ext)
+    return os.path.join(datadir, fn)
+
+
+class Metrics(object):
+    """Counts and timings for one calendar's run.
+
+    Safe to use from several threads.
+
+    """
+    def __init__(self, clock=None):
+        self.clock = clock or time.time
+        self.counts = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, count=1):
+        self._lock.acquire()
+        try:
+            self.counts[name] = self.counts.get(name, 0) + count
+        finally:
+            self._lock.release()
+
+    def add_time(self, stage, seconds, count=1):
+        self._lock.acquire()
+        try:
+            timing = self.timings.setdefault(stage, [0, 0.0])
+            timing[0] += count
+            timing[1] += seconds
+        finally:
+            self._lock.release()
+
+    def timed(self, stage, iterable):
+        """Yields from iterable, timing how long each item takes to
+        produce as one ``stage``.
+
+        """
+        iterator = iter(iterable)
+        while True:
+            start = self.clock()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                return
+            self.add_time(stage, self.clock() - start)
+            yield item
+
+    def as_dict(self):
+        self._lock.acquire()
+        try:
+            return {
+                'counts': dict(self.counts),
+                'timings': dict(
+                    (stage, {'count': count, 'seconds': seconds})
+                    for stage, (count, seconds) in self.timings.items())
+                }
+        finally:
+            self._lock.release()
+
+    def to_json(self, name, now):
+        data = self.as_dict()
+        data['calendar'] = name
+        data['time'] = now
+        return json.dumps(data, sort_keys=True)
+
+    def to_prometheus(self, name, now):
+        data = self.as_dict()
+        labels = 'calendar="{0}"'.format(
+            name.replace('\\', '\\\\').replace('"', '\\"'))
+        lines = [
+            '# HELP phil_last_run_timestamp_seconds When phil last ran.',
+            '# TYPE phil_last_run_timestamp_seconds gauge',
+            'phil_last_run_timestamp_seconds{{{0}}} {1}'.format(labels, now),
+            ]
+        for counter in sorted(data['counts']):
+            metric = 'phil_{0}'.format(counter)
+            lines.append('# TYPE {0} gauge'.format(metric))
+            lines.append('{0}{{{1}}} {2}'.format(
+                metric, labels, data['counts'][counter]))
+        for metric, key in (('phil_stage_seconds', 'seconds'),
+                            ('phil_stage_count', 'count')):
+            lines.append('# TYPE {0} gauge'.format(metric))
+            for stage in sorted(data['timings']):
+                lines.append('{0}{{{1},stage="{2}"}} {3}'.format(
+                    metric, labels, stage, data['timings'][stage][key]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, datadir, name, fmt):
+        """Writes the metrics to datadir in fmt."""
+        path = get_metrics_path(datadir, name, fmt)
+        now = time.time()
+        if fmt == 'json':
+            f = open(path, 'ab')
+            try:
+                f.write(self.to_json(name, now) + '\n')
+            finally:
+                f.close()
+            return
+
+        # The textfile collector might read it at any time, so it's
+        # moved into place.
+        tmppath = path + '.tmp'
+        f = open(tmppath, 'wb')
+        try:
+            f.write(self.to_prometheus(name, now))
+        finally:
+            f.close()
+        os.rename(tmppath, path)
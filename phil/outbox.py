@@ -0,0 +1,206 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+The outbox holds reminders that couldn't be sent so they can be tried
+again before the next run.
+
+Each reminder is a JSON file in the outbox directory in datadir.  It
+stays there until it's sent or the meeting it's for has started.
+After each failed try, the next one waits twice as long.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import time
+
+from phil.mailer import Message
+
+
+# Seconds to wait before the first retry.
+BACKOFF = 60
+
+# The most seconds to wait between tries.
+MAX_BACKOFF = 6 * 3600
+
+
+def get_outbox_path(datadir, name=None):
+    if not name or name == 'default':
+        return os.path.join(datadir, 'outbox')
+    return os.path.join(datadir, 'outbox-{0}'.format(name))
+
+
+def get_backoff(attempts):
+    """Returns how many seconds to wait after the attempts'th failure."""
+    return min(BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+class Entry(object):
+    """A reminder waiting in the outbox.
+
+    :arg token: the (event_id, date) the reminder is for
+    :arg message: the Message to send
+    :arg attempts: how many times sending it has failed
+    :arg next_try: when to try again in seconds since the epoch
+    :arg error: why the last try failed
+
+    """
+    def __init__(self, token, message, attempts=1, next_try=0, error=''):
+        self.token = tuple(token)
+        self.message = message
+        self.attempts = attempts
+        self.next_try = next_try
+        self.error = error
+
+    @property
+    def key(self):
+        return hashlib.sha1(
+            json.dumps(list(self.token)).encode('utf-8')).hexdigest()
+
+    def is_expired(self, today):
+        """Returns True if the day of the meeting this reminder is for
+        is over.
+
+        The token only has the meeting's date, so a reminder is kept
+        for the rest of that day after the meeting starts.
+
+        """
+        return str(today) > self.token[1]
+
+    def to_dict(self):
+        return {
+            'token': list(self.token),
+            'message': list(self.message),
+            'attempts': self.attempts,
+            'next_try': self.next_try,
+            'error': self.error
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['token'], Message(*data['message']),
+                   data['attempts'], data['next_try'], data['error'])
+
+
+class Outbox(object):
+    """The reminders waiting to be sent for a calendar.
+
+    :arg datadir: the calendar's datadir
+    :arg name: the calendar's name
+    :arg now: function returning the current time in seconds since the
+        epoch
+
+    """
+    def __init__(self, datadir, name=None, now=None):
+        self.path = get_outbox_path(datadir, name)
+        self.now = now or time.time
+        self._tokens = None
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def _write(self, entry):
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            if not os.path.isdir(self.path):
+                raise
+        path = self._entry_path(entry.key)
+        tmppath = path + '.tmp'
+        f = open(tmppath, 'wb')
+        try:
+            json.dump(entry.to_dict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmppath, path)
+        if self._tokens is not None:
+            self._tokens.add(entry.token)
+
+    def entries(self):
+        """Returns every Entry in the outbox, the next one to try
+        first.
+
+        """
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        for fn in os.listdir(self.path):
+            if not fn.endswith('.json'):
+                continue
+            f = open(os.path.join(self.path, fn), 'rb')
+            try:
+                try:
+                    entries.append(Entry.from_dict(json.load(f)))
+                except (ValueError, KeyError, TypeError):
+                    # Not something we wrote.  If its reminder is still
+                    # due, the next run sends it again.
+                    continue
+            finally:
+                f.close()
+        entries.sort(key=lambda entry: (entry.next_try, entry.token))
+        return entries
+
+    def __len__(self):
+        return len(self.entries())
+
+    def __contains__(self, token):
+        if self._tokens is None:
+            self._tokens = set([entry.token for entry in self.entries()])
+        return tuple(token) in self._tokens
+
+    def due(self):
+        """Returns the entries that are ready to be tried again."""
+        now = self.now()
+        return [entry for entry in self.entries() if entry.next_try <= now]
+
+    def put(self, token, message, error=''):
+        """Queues a message that couldn't be sent."""
+        self._write(Entry(token, message, 1,
+                          self.now() + get_backoff(1), str(error)))
+
+    def retry(self, entry, error=''):
+        """Records another failed try and pushes back the next one."""
+        entry.attempts += 1
+        entry.next_try = self.now() + get_backoff(entry.attempts)
+        entry.error = str(error)
+        self._write(entry)
+
+    def remove(self, entry):
+        try:
+            os.remove(self._entry_path(entry.key))
+        except OSError:
+            pass
+        if self._tokens is not None:
+            self._tokens.discard(entry.token)
+
+    def expire(self, today=None):
+        """Removes the entries for meetings whose day is over and
+        returns them.
+
+        """
+        today = today or datetime.date.fromtimestamp(self.now())
+        expired = [entry for entry in self.entries()
+                   if entry.is_expired(today)]
+        for entry in expired:
+            self.remove(entry)
+        return expired
@@ -0,0 +1,104 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Plans of the reminders a run would send.
+
+Working out which reminders are due and rendering them is separate
+from sending them.  ``Phil.plan`` returns a list of Reminders without
+sending anything or recording them as sent, and ``Phil.execute`` sends
+a plan.  A run is a plan that's executed straight away.
+"""
+
+import json
+from collections import namedtuple
+
+from phil.util import format_date
+
+
+FORMATS = ('text', 'json')
+
+
+# A reminder for the occurrence of event on date, rendered into
+# message, for the calendar config.
+Reminder = namedtuple('Reminder', ['config', 'event', 'date', 'message'])
+
+
+def get_token(reminder):
+    """Returns the (event_id, date) a reminder is recorded under."""
+    return (reminder.event.event_id, str(reminder.date.date()))
+
+
+def encode(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def write_message(message, stream):
+    """Writes a message the way ``--debug`` shows it."""
+    stream.write('From: {0}\n'.format(encode(message.sender)))
+    stream.write('To: {0}\n'.format(
+        ', '.join([encode(address) for address in message.to_list])))
+    stream.write('Subject: {0}\n'.format(encode(message.subject)))
+    stream.write('Body:\n')
+    for line in encode(message.body).splitlines():
+        stream.write('    {0}\n'.format(line))
+
+
+def write_text(reminders, stream):
+    for reminder in reminders:
+        line = u'{0}  {1}'.format(
+            format_date(reminder.date), reminder.event.summary)
+        if reminder.config.name != 'default':
+            line = u'{0}  [{1}]'.format(line, reminder.config.name)
+        stream.write(encode(line) + '\n')
+        stream.write('    To: {0}\n'.format(
+            ', '.join([encode(address)
+                       for address in reminder.message.to_list])))
+
+
+def to_dict(reminder):
+    message = reminder.message
+    return {
+        'calendar': reminder.config.name,
+        'event_id': reminder.event.event_id,
+        'date': reminder.date.isoformat(),
+        'from': message.sender,
+        'to': list(message.to_list),
+        'subject': message.subject,
+        'body': message.body,
+        'delivery': message.delivery
+        }
+
+
+def write_json(reminders, stream):
+    # Written a reminder at a time so long plans stream.
+    stream.write('[')
+    for i, reminder in enumerate(reminders):
+        if i:
+            stream.write(',')
+        stream.write('\n' + json.dumps(to_dict(reminder), sort_keys=True))
+    stream.write('\n]\n')
+
+
+WRITERS = {
+    'text': write_text,
+    'json': write_json
+    }
@@ -0,0 +1,106 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Profiles a phil-cmd command with cProfile.
+
+The profile is written to a file that ``pstats`` or a viewer like
+snakeviz can load, and a summary of the hottest functions and the time
+spent in the libraries phil leans on is printed to stderr, so it
+doesn't get mixed into a command's json or csv output.
+"""
+
+import cProfile
+import os
+import pstats
+import sys
+
+
+# (label, function(filename) -> True if the file belongs to the area)
+AREAS = [
+    ('icalendar parsing',
+     lambda fn: os.sep + 'icalendar' + os.sep in fn),
+    ('dateutil rrules',
+     lambda fn: os.sep + 'dateutil' + os.sep in fn),
+    ('smtplib I/O',
+     lambda fn: os.path.basename(fn) in ('smtplib.py', 'smtplib.pyc')),
+    ]
+
+
+def profile_call(path, fun, *args):
+    """Calls fun with args under cProfile, writes the profile to path
+    and returns (fun's return value, pstats.Stats).
+
+    """
+    profiler = cProfile.Profile()
+    try:
+        ret = profiler.runcall(fun, *args)
+    finally:
+        profiler.dump_stats(path)
+    return ret, pstats.Stats(path)
+
+
+def area_times(stats):
+    """Returns a list of (label, seconds) for AREAS.
+
+    An area's time is the cumulative time of calls into it from
+    outside it, so it includes whatever it calls, like socket reads
+    for smtplib.
+
+    """
+    times = []
+    for label, matches in AREAS:
+        seconds = 0.0
+        for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+            if not matches(func[0]):
+                continue
+            for caller, edge in callers.items():
+                if not matches(caller[0]):
+                    seconds += edge[3]
+        times.append((label, seconds))
+    return times
+
+
+def format_func(func):
+    filename, lineno, name = func
+    if filename == '~':
+        return name
+    return '{0}:{1}({2})'.format(os.path.basename(filename), lineno, name)
+
+
+def summarize(stats, top=20, stream=None):
+    """Writes the top functions by time spent in them and the time
+    spent in each of AREAS to stream, which defaults to stderr.
+
+    """
+    stream = stream or sys.stderr
+    total = stats.total_tt
+    stream.write('Profile: {0:.3f}s total\n'.format(total))
+    for label, seconds in area_times(stats):
+        pct = 100.0 * seconds / total if total else 0.0
+        stream.write('  {0:<20} {1:>9.3f}s {2:>5.1f}%\n'.format(
+            label, seconds, pct))
+
+    stream.write('Top {0} functions by own time:\n'.format(top))
+    stream.write('  {0:>9} {1:>9} {2:>9}  {3}\n'.format(
+        'calls', 'own s', 'cum s', 'function'))
+    rows = sorted(stats.stats.items(), key=lambda item: -item[1][2])
+    for func, (cc, nc, tt, ct, callers) in rows[:top]:
+        stream.write('  {0:>9} {1:>9.3f} {2:>9.3f}  {3}\n'.format(
+            nc, tt, ct, format_func(func)))
@@ -0,0 +1,255 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Keeps phil running and sends each reminder when it's due rather than
+waiting for the next cron run.
+"""
+
+import datetime
+import heapq
+import os
+import time
+
+from phil.state import get_reminded
+from phil.util import (
+    out, err, parse_configurations, get_next_date, to_local)
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def timedelta_seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+class Scheduler(object):
+    """Sends reminders from a heap ordered by when they're due.
+
+    A reminder is due ``remind`` days before the occurrence it's for.
+    The config file and ics files are only loaded again when their
+    mtimes change.
+
+    :arg phil: the Phil instance used to send reminders
+    :arg conffile: path to the config file
+    :arg poll: the most seconds to sleep before checking whether the
+        config file or ics files changed
+    :arg now: function returning the current datetime
+    :arg sleep: function that sleeps for some seconds
+
+    """
+    def __init__(self, phil, conffile, poll=60, now=None, sleep=None):
+        self.phil = phil
+        self.conffile = conffile
+        self.poll = poll
+        self.now = now or datetime.datetime.today
+        self.sleep = sleep or time.sleep
+        self.configs = {}
+        self.heap = []
+        self.mtimes = {}
+        self._seq = 0
+
+    def _push(self, config, event, after, inc=True):
+        """Schedules the reminder for the first occurrence of event
+        after ``after``.
+
+        """
+        if inc:
+            next_date = get_next_date(after, event.rrule)
+        else:
+            next_date = event.rrule.after(after)
+        if next_date is None:
+            # The event doesn't happen again.
+            return
+        self._schedule(next_date - datetime.timedelta(config.remind),
+                       config, event, next_date)
+
+    def _schedule(self, due, config, event, next_date):
+        # Events can be in different timezones or floating, so the heap
+        # is ordered by local time.  _seq keeps the heap from ever
+        # comparing two events.
+        self._seq += 1
+        heapq.heappush(
+            self.heap,
+            (to_local(due), self._seq, config.name, event, next_date))
+
+    def _watched(self):
+        paths = [self.conffile]
+        paths.extend([config.icsfile for config in self.configs.values()])
+        return paths
+
+    def fetch(self):
+        """Fetches the ics files that are URLs.  Each one is only
+        downloaded again if the server says it has changed.
+
+        """
+        self.phil._fetched = set()
+        for config in self.configs.values():
+            self.phil.config = config
+            self.phil._fetch()
+
+    def changed(self):
+        """Returns True if the config file or any ics file changed
+        since they were loaded.
+
+        """
+        self.fetch()
+        for path in self._watched():
+            if get_mtime(path) != self.mtimes.get(path):
+                return True
+        return False
+
+    def load(self):
+        """Loads the configuration and ics files and rebuilds the heap."""
+        configs = parse_configurations(self.conffile)
+        self.configs = dict((config.name, config) for config in configs)
+        self.heap = []
+
+        now = self.now()
+        for config in configs:
+            self.phil.config = config
+            if self.phil._fetch():
+                continue
+            state = self.phil._open_state()
+            outbox = self.phil._open_outbox()
+            try:
+                event_ids = set()
+                for event in self.phil._load_events():
+                    event_ids.add(event.event_id)
+                    next_date = get_next_date(now, event.rrule)
+                    if next_date is None:
+                        continue
+                    if self._handled(state, outbox, event, next_date):
+                        self._push(config, event, next_date, inc=False)
+                    else:
+                        self._push(config, event, now)
+                if not self.phil.debug:
+                    self.phil._collect_garbage(state, event_ids)
+            finally:
+                state.close()
+
+        self.mtimes = dict((path, get_mtime(path))
+                           for path in self._watched())
+
+    def _handled(self, state, outbox, event, next_date):
+        """Returns True if the reminder for next_date was sent or is
+        waiting in the outbox.
+
+        """
+        token = (event.event_id, str(next_date.date()))
+        if get_reminded(state, event) == token[1]:
+            return True
+        return outbox is not None and token in outbox
+
+    def flush_outboxes(self):
+        """Tries the reminders in each calendar's outbox that are due
+        for another try.
+
+        """
+        for config in self.configs.values():
+            self.phil.config = config
+            outbox = self.phil._open_outbox()
+            if outbox is None:
+                continue
+            state = self.phil._open_state()
+            try:
+                self.phil._flush_outbox(state, outbox)
+            finally:
+                state.close()
+
+    def run_pending(self):
+        """Sends every reminder that's due and schedules the next one
+        for those events.
+
+        :returns: the number of reminders that couldn't be sent
+
+        """
+        now = to_local(self.now())
+        due = {}
+        while self.heap and self.heap[0][0] <= now:
+            when, seq, name, event, next_date = heapq.heappop(self.heap)
+            due.setdefault(name, []).append((event, next_date))
+
+        failures = 0
+        for name, reminders in due.items():
+            config = self.configs[name]
+            self.phil.config = config
+            state = self.phil._open_state()
+            outbox = self.phil._open_outbox()
+            try:
+                failures += self.phil._send(reminders, state, outbox)
+
+                for event, next_date in reminders:
+                    if (self.phil.debug
+                            or self._handled(state, outbox, event, next_date)):
+                        self._push(config, event, next_date, inc=False)
+                    else:
+                        # Try again after the poll interval.
+                        retry = now + datetime.timedelta(seconds=self.poll)
+                        self._schedule(retry, config, event, next_date)
+            finally:
+                state.close()
+
+        return failures
+
+    def reload(self):
+        """Loads again after a change.  If that fails, say because an
+        ics file was caught half-written or the config file has a
+        typo, the old schedule is kept and the next poll tries again.
+
+        :returns: True if it reloaded
+
+        """
+        configs, heap, mtimes = self.configs, self.heap, self.mtimes
+        try:
+            self.load()
+        except Exception, exc:
+            self.configs, self.heap, self.mtimes = configs, heap, mtimes
+            err('Could not reload, keeping the old schedule: {0}: '
+                '{1}'.format(exc.__class__.__name__, exc))
+            return False
+        return True
+
+    def seconds_until_due(self):
+        if not self.heap:
+            return self.poll
+        delta = timedelta_seconds(self.heap[0][0] - to_local(self.now()))
+        return max(0, min(delta, self.poll))
+
+    def serve(self, iterations=None):
+        """Loops forever (or for iterations) sending reminders as they
+        come due.
+
+        """
+        self.load()
+        while iterations is None or iterations > 0:
+            if self.changed():
+                if not self.phil.quiet:
+                    out('Reloading configuration....')
+                self.reload()
+            if not self.phil.debug:
+                self.flush_outboxes()
+            self.run_pending()
+            self.sleep(self.seconds_until_due())
+            if iterations is not None:
+                iterations -= 1
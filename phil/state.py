@@ -0,0 +1,400 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+State stores remember which reminders phil has already sent.
+
+All stores have the same interface:
+
+* ``get(key)`` returns the value for key or None
+* ``record(key, value)`` saves a value
+* ``remove(key)`` forgets a key
+* ``keys()`` returns every key
+* ``flush()`` makes sure everything recorded is on disk
+* ``compact()`` reclaims space used by old values
+* ``close()`` flushes and releases the store
+
+``record`` is safe to call from several threads.
+
+Keys are event ids.  After a run has looked at every event in the
+calendar, ``collect_garbage`` drops the keys for events that are gone,
+so the state stays the size of the calendar rather than its history.
+"""
+
+import json
+import os
+import threading
+
+import phil.util
+
+
+BACKENDS = ('json', 'log', 'sqlite')
+
+
+def get_state_path(datadir, name, ext):
+    if not name or name == 'default':
+        return os.path.join(datadir, 'state.{0}'.format(ext))
+    return os.path.join(datadir, 'state-{0}.{1}'.format(name, ext))
+
+
+class JSONStateStore(object):
+    """Keeps state in a single JSON file that's rewritten on flush.
+
+    This is the original state.js format.
+
+    """
+    def __init__(self, datadir, name=None):
+        self.datadir = datadir
+        self.name = name
+        self.data = phil.util.load_state(datadir, name)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def record(self, key, value):
+        self._lock.acquire()
+        try:
+            self.data[key] = value
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        self._lock.acquire()
+        try:
+            self.data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        return self.data.keys()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            phil.util.save_state(self.datadir, self.data, self.name)
+        finally:
+            self._lock.release()
+
+    def compact(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+def read_log(path):
+    """Reads a state log.
+
+    :returns: (data, lines, clean) where lines is how many records
+        were read and clean is False if the log has a torn line
+
+    """
+    data = {}
+    lines = 0
+    clean = True
+    f = open(path, 'rb')
+    try:
+        for line in f:
+            try:
+                key, value = json.loads(line)
+            except ValueError:
+                # A line torn by a crash.  Everything before it is
+                # fine.
+                clean = False
+                continue
+            if not line.endswith('\n'):
+                # Whole, but the next append would run onto it.
+                clean = False
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+            lines += 1
+    finally:
+        f.close()
+    return data, lines, clean
+
+
+class LogStateStore(object):
+    """Appends each recorded value to a log of JSON lines.  A removed
+    key is a line with a null value.
+
+    Recording a value costs one small append rather than rewriting
+    everything, and a crash can lose at most the records since the
+    last fsync.  Writes are fsynced every ``sync_every`` records and
+    on flush.  The log is compacted on close once it's mostly
+    overwritten values.
+
+    """
+    def __init__(self, datadir, name=None, sync_every=20):
+        self.path = get_state_path(datadir, name, 'log')
+        self.sync_every = sync_every
+        self.data = {}
+        self.lines = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            if not self._replay():
+                # Drop the torn line so the next record doesn't get
+                # appended to it.
+                self._rewrite()
+        elif os.path.exists(phil.util.get_state_js(datadir, name)):
+            # Carry over state from state.js the first time.
+            self.data = phil.util.load_state(datadir, name)
+            self._rewrite()
+
+        self.log = open(self.path, 'ab')
+
+    def _replay(self):
+        """Reads the log into data and returns False if it has a torn
+        line.
+
+        """
+        self.data, self.lines, clean = read_log(self.path)
+        return clean
+
+    def _rewrite(self):
+        tmppath = self.path + '.tmp'
+        f = open(tmppath, 'wb')
+        try:
+            for key, value in sorted(self.data.items()):
+                f.write(json.dumps([key, value]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmppath, self.path)
+        self.lines = len(self.data)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def _append(self, key, value):
+        self.log.write(json.dumps([key, value]) + '\n')
+        self.lines += 1
+        self._pending += 1
+        if self._pending >= self.sync_every:
+            self._sync()
+
+    def record(self, key, value):
+        self._lock.acquire()
+        try:
+            self.data[key] = value
+            self._append(key, value)
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        self._lock.acquire()
+        try:
+            if key in self.data:
+                del self.data[key]
+                self._append(key, None)
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        return self.data.keys()
+
+    def _sync(self):
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self._pending = 0
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._sync()
+        finally:
+            self._lock.release()
+
+    def compact(self):
+        self._lock.acquire()
+        try:
+            self.log.close()
+            self._rewrite()
+            self.log = open(self.path, 'ab')
+            self._pending = 0
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self.flush()
+        if self.lines > 2 * len(self.data) + 100:
+            self.compact()
+        self.log.close()
+
+
+class SQLiteStateStore(object):
+    """Keeps state in a SQLite database.
+
+    Values are looked up as they're needed so a run only reads the keys
+    for events in the calendar.  Records are committed every
+    ``sync_every`` records and on flush.
+
+    """
+    def __init__(self, datadir, name=None, sync_every=20):
+        import sqlite3
+
+        self.path = get_state_path(datadir, name, 'db')
+        self.sync_every = sync_every
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        is_new = not os.path.exists(self.path)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS state '
+            '(key TEXT PRIMARY KEY, value TEXT)')
+        if is_new and os.path.exists(phil.util.get_state_js(datadir, name)):
+            # Carry over state from state.js the first time.
+            self.conn.executemany(
+                'INSERT INTO state (key, value) VALUES (?, ?)',
+                phil.util.load_state(datadir, name).items())
+        self.conn.commit()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            row = self.conn.execute(
+                'SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        finally:
+            self._lock.release()
+        return row[0] if row else None
+
+    def record(self, key, value):
+        self._lock.acquire()
+        try:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                (key, value))
+            self._pending += 1
+            if self._pending >= self.sync_every:
+                self.conn.commit()
+                self._pending = 0
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        self._lock.acquire()
+        try:
+            self.conn.execute('DELETE FROM state WHERE key = ?', (key,))
+            self._pending += 1
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        self._lock.acquire()
+        try:
+            return [row[0] for row in self.conn.execute(
+                'SELECT key FROM state')]
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self.conn.commit()
+            self._pending = 0
+        finally:
+            self._lock.release()
+
+    def compact(self):
+        self.flush()
+        self.conn.execute('VACUUM')
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def get_reminded(store, event, migrate=True):
+    """Returns the date of the last reminder sent for event or None.
+
+    State an older phil recorded under the event's legacy id is moved
+    to its id the first time it's looked up, unless migrate is False.
+
+    :arg store: a state store, or a dict from :py:func:`read_state` if
+        migrate is False
+
+    """
+    value = store.get(event.event_id)
+    if value is None and event.legacy_id is not None:
+        value = store.get(event.legacy_id)
+        if value is not None and migrate:
+            store.record(event.event_id, value)
+            store.remove(event.legacy_id)
+    return value
+
+
+def collect_garbage(store, event_ids):
+    """Removes the keys for events that aren't in event_ids and returns
+    how many were removed.
+
+    """
+    dead = [key for key in store.keys() if key not in event_ids]
+    for key in dead:
+        store.remove(key)
+    return len(dead)
+
+
+def read_state(datadir, name=None, backend='json'):
+    """Returns the state for calendar name in datadir as a dict
+    without creating, migrating or writing anything.
+
+    """
+    if backend not in BACKENDS:
+        raise ValueError('"{0}" is not a state backend.'.format(backend))
+    if backend == 'log':
+        path = get_state_path(datadir, name, 'log')
+        if os.path.exists(path):
+            return read_log(path)[0]
+    elif backend == 'sqlite':
+        path = get_state_path(datadir, name, 'db')
+        if os.path.exists(path):
+            import sqlite3
+
+            conn = sqlite3.connect(path)
+            try:
+                return dict(conn.execute('SELECT key, value FROM state'))
+            finally:
+                conn.close()
+
+    # No store yet, so it would start from state.js.
+    path = phil.util.get_state_js(datadir, name)
+    if not os.path.exists(path):
+        return {}
+    f = open(path, 'rb')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def open_store(datadir, name=None, backend='json'):
+    """Returns the state store for calendar name in datadir."""
+    if backend == 'log':
+        return LogStateStore(datadir, name)
+    if backend == 'sqlite':
+        return SQLiteStateStore(datadir, name)
+    if backend == 'json':
+        return JSONStateStore(datadir, name)
+    raise ValueError('"{0}" is not a state backend.'.format(backend))
@@ -0,0 +1,121 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Renders event descriptions.
+
+Descriptions use Python ``%`` formatting with named placeholders like
+``%(Y)s-%(m)s-%(d)s``.  Each description is parsed once into a
+Template that knows which placeholders it uses, so rendering only
+works out those values.
+
+Placeholders are:
+
+* any of ``DATE_FIELDS``: that strftime directive for the meeting date
+* ``FIELD@ZONE`` like ``H@UTC``: the same, with the meeting date
+  converted to the pytz timezone ZONE first (naive dates aren't
+  converted)
+* anything in ``FIELDS``, like ``summary`` and ``date``
+"""
+
+import re
+
+from phil.util import DATE_FIELDS, format_date
+
+
+PLACEHOLDER_RE = re.compile(r'%(?:%|\((?P<key>[^)]*)\))')
+
+# placeholder -> function(event, date) that returns its value
+FIELDS = {
+    'summary': lambda event, date: event.summary,
+    'date': lambda event, date: format_date(date),
+    'organizer': lambda event, date: event.organizer or u'',
+    'attendees': lambda event, date: u', '.join(event.attendees),
+    }
+
+# How many compiled templates to keep around.
+CACHE_SIZE = 1000
+
+_templates = {}
+
+
+def in_zone(date, zone):
+    if date.tzinfo is None:
+        return date
+    import pytz
+    return date.astimezone(pytz.timezone(zone))
+
+
+def get_field(key):
+    """Returns the function for placeholder key or None if there's no
+    such placeholder.
+
+    """
+    if key in FIELDS:
+        return FIELDS[key]
+
+    directive, sep, zone = key.partition('@')
+    if directive not in DATE_FIELDS:
+        return None
+    fmt = '%' + directive
+    if not sep:
+        return lambda event, date: date.strftime(fmt)
+    return lambda event, date: in_zone(date, zone).strftime(fmt)
+
+
+class Template(object):
+    """A description with its placeholders worked out.
+
+    Unknown placeholders are left for ``%`` to complain about when the
+    template is rendered, the same as they would be without a
+    Template.
+
+    """
+    def __init__(self, text):
+        self.text = text
+        self.fields = {}
+        for match in PLACEHOLDER_RE.finditer(text):
+            key = match.group('key')
+            if key is None or key in self.fields:
+                continue
+            field = get_field(key)
+            if field is not None:
+                self.fields[key] = field
+
+    def render(self, event, date):
+        if '%' not in self.text:
+            return self.text
+        values = dict((key, field(event, date))
+                      for key, field in self.fields.items())
+        return self.text % values
+
+
+def compile_template(text):
+    """Returns the Template for text, compiling it the first time."""
+    template = _templates.get(text)
+    if template is None:
+        if len(_templates) >= CACHE_SIZE:
+            _templates.clear()
+        template = _templates[text] = Template(text)
+    return template
+
+
+def render(text, event, date):
+    """Renders text for event happening on date."""
+    return compile_template(text).render(event, date)
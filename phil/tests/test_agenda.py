@@ -0,0 +1,181 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+import csv
+import datetime
+import json
+import os
+import sys
+from StringIO import StringIO
+
+import dateutil.rrule
+from nose.tools import eq_
+
+from phil.agenda import iter_occurrences, merge
+from phil.check import Phil
+from phil.tests import TempFileTestCase
+from phil.util import Event, to_local, utc
+
+
+R = dateutil.rrule
+START = datetime.datetime(2013, 1, 1)
+
+
+def build_event(event_id, freq, **args):
+    return Event(event_id, R.rrule(freq, **args), event_id, u'')
+
+
+def build_rule_event(freq, **args):
+    return Event('id', R.rrule(freq, **args), u'', u'', (freq, args))
+
+
+def test_iter_occurrences():
+    events = [
+        build_rule_event(R.HOURLY, interval=5,
+                         dtstart=datetime.datetime(2012, 1, 1, 0, 30)),
+        build_rule_event(R.DAILY, interval=14,
+                         dtstart=datetime.datetime(2011, 1, 1)),
+        build_rule_event(R.YEARLY, dtstart=datetime.datetime(2010, 3, 1),
+                         count=5),
+        build_rule_event(R.MONTHLY, bymonthday=31,
+                         dtstart=datetime.datetime(2012, 1, 31)),
+        build_rule_event(R.MONTHLY, dtstart=datetime.datetime(2014, 6, 1)),
+        build_event('plain', R.WEEKLY,
+                    dtstart=datetime.datetime(2012, 2, 3)),
+        ]
+    for event in events:
+        dates = [date for i, date in zip(range(50),
+                                         iter_occurrences(event, START))]
+        expected = event.rrule.between(
+            START, START + datetime.timedelta(days=5000), True)[:50]
+        eq_(dates, expected)
+
+
+def test_merge():
+    events = [
+        build_event('hourly', R.HOURLY, interval=3,
+                    dtstart=datetime.datetime(2012, 12, 31, 23)),
+        build_event('daily', R.DAILY,
+                    dtstart=datetime.datetime(2012, 1, 1, 4)),
+        ]
+    merged = list(merge([('default', events)], START, count=5))
+    eq_([(date.hour, event.event_id) for date, calendar, event in merged],
+        [(2, 'hourly'), (4, 'daily'), (5, 'hourly'), (8, 'hourly'),
+         (11, 'hourly')])
+
+    end = START + datetime.timedelta(days=2)
+    merged = list(merge([('default', events)], START, end=end))
+    eq_(len(merged), 16 + 2)
+    assert all(START <= date < end for date, calendar, event in merged)
+
+
+def test_merge_naive_and_aware():
+    events = [
+        build_event('floating', R.DAILY,
+                    dtstart=datetime.datetime(2012, 1, 1, 12)),
+        build_event('utc', R.HOURLY, interval=5,
+                    dtstart=datetime.datetime(2012, 1, 1, tzinfo=utc)),
+        ]
+    merged = list(merge([('default', events)], START, count=20))
+    dates = [to_local(date) for date, calendar, event in merged]
+    eq_(dates, sorted(dates))
+    eq_(set([event.event_id for date, calendar, event in merged]),
+        set(['floating', 'utc']))
+
+
+def test_merge_end_matches_heap():
+    events = [
+        build_rule_event(R.HOURLY, interval=5,
+                         dtstart=datetime.datetime(2012, 1, 1, 0, 30)),
+        build_rule_event(R.WEEKLY, byweekday=[R.MO, R.TH],
+                         dtstart=datetime.datetime(2011, 1, 1, 9)),
+        build_rule_event(R.MONTHLY, bymonthday=31,
+                         dtstart=datetime.datetime(2012, 1, 31, 10)),
+        build_rule_event(R.DAILY, interval=3,
+                         dtstart=datetime.datetime(2012, 6, 1, tzinfo=utc)),
+        build_event('plain', R.WEEKLY,
+                    dtstart=datetime.datetime(2012, 2, 3)),
+        ]
+    sources = [('default', events[:3]), ('other', events[3:])]
+    end = START + datetime.timedelta(days=100)
+
+    expected = []
+    for date, calendar, event in merge(sources, START, count=1000):
+        if to_local(date) >= end:
+            break
+        expected.append((date, calendar, event))
+    eq_(list(merge(sources, START, end=end)), expected)
+    eq_(list(merge(sources, START, end=end, count=7)), expected[:7])
+
+
+ICS = """BEGIN:VCALENDAR
+VERSION:1.0
+BEGIN:VEVENT
+DTSTART:20111118T120000
+SUMMARY:bi-weekly conference call
+RRULE:FREQ=DAILY;INTERVAL=14
+DESCRIPTION:conference call
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class PhilAgendaTest(TempFileTestCase):
+    def test_agenda(self):
+        icsfile = os.path.join(self.tempdir, 'test.ics')
+        open(icsfile, 'w').write(ICS)
+        conffile = os.path.join(self.tempdir, 'config.ini')
+        open(conffile, 'w').write(
+            '[default]\n'
+            'datadir = {0}\n'
+            'icsfile = {1}\n'
+            'smtp_host = localhost\n'
+            'from = phil@example.com\n'
+            'to = recip@example.com\n'
+            'remind = 3\n'.format(self.tempdir, icsfile))
+        p = Phil(quiet=True)
+
+        stream = StringIO()
+        eq_(p.agenda(conffile, START, count=2, fmt='json', stream=stream), 0)
+        eq_([item['date'] for item in json.loads(stream.getvalue())],
+            ['2013-01-11T12:00:00', '2013-01-25T12:00:00'])
+
+        stream = StringIO()
+        end = START + datetime.timedelta(days=30)
+        eq_(p.agenda(conffile, START, end, fmt='csv', stream=stream), 0)
+        rows = list(csv.reader(StringIO(stream.getvalue())))
+        eq_(rows[0][:3], ['date', 'calendar', 'summary'])
+        eq_(len(rows), 3)
+
+        stream = StringIO()
+        eq_(p.agenda(conffile, START, count=1, stream=stream), 0)
+        eq_(stream.getvalue(),
+            'Fri January 11, 2013 12:00  bi-weekly conference call\n')
+
+        # Without -q the json on stdout is still only json.
+        p = Phil()
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            eq_(p.agenda(conffile, START, count=2, fmt='json'), 0)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        eq_(len(json.loads(output)), 2)
+        eq_(p.quiet, False)
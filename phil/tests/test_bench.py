@@ -0,0 +1,38 @@
+######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+
+from nose.tools import eq_
+
+from phil.bench import percentile, run_benchmarks
+
+
+def test_percentile():
+    values = range(101)
+    eq_(percentile(values, 50), 50)
+    eq_(percentile(values, 99), 99)
+    eq_(percentile([], 50), 0.0)
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(events=20, messages=5, recipients=2)
+
+    eq_([(result.name, result.count) for result in results],
+        [('parse_ics', 20), ('convert_rrule', 20), ('get_next_date', 20),
+         ('expand_window', 1), ('render', 20), ('send_smtp', 5)])
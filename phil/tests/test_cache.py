@@ -0,0 +1,89 @@
+######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+
+import os
+import shutil
+
+import fudge
+from nose.tools import eq_
+
+from phil.cache import get_cache_path, iter_events, load_events
+from phil.tests import get_test_data_dir, TempFileTestCase
+
+
+class CacheTests(TempFileTestCase):
+    def setUp(self):
+        super(CacheTests, self).setUp()
+        self.icsfile = os.path.join(self.tempdir, 'test.ics')
+        shutil.copy(os.path.join(get_test_data_dir(), 'test1.ics'),
+                    self.icsfile)
+
+    def test_cold_then_warm(self):
+        events = load_events(self.icsfile, self.tempdir)
+        eq_([ev.summary for ev in events], [u'bi-weekly conference call'])
+        assert os.path.exists(get_cache_path(self.tempdir, self.icsfile))
+
+        @fudge.patch('phil.cache.iter_ics')
+        def warm(fakeparse):
+            fakeparse.is_callable().times_called(0)
+            return load_events(self.icsfile, self.tempdir)
+
+        warm_events = warm()
+        eq_([ev.event_id for ev in warm_events],
+            [ev.event_id for ev in events])
+
+    def test_touch_without_changes(self):
+        load_events(self.icsfile, self.tempdir)
+        os.utime(self.icsfile, (0, 0))
+
+        @fudge.patch('phil.cache.iter_ics')
+        def touched(fakeparse):
+            fakeparse.is_callable().times_called(0)
+            return load_events(self.icsfile, self.tempdir)
+
+        eq_(len(touched()), 1)
+
+    def test_changed_file(self):
+        load_events(self.icsfile, self.tempdir)
+        data = open(self.icsfile, 'rb').read()
+        open(self.icsfile, 'wb').write(
+            data.replace('bi-weekly conference call', 'standup'))
+
+        events = load_events(self.icsfile, self.tempdir)
+        eq_([ev.summary for ev in events], [u'standup'])
+
+    def test_corrupt_cache(self):
+        open(get_cache_path(self.tempdir, self.icsfile), 'wb').write('junk')
+        eq_(len(load_events(self.icsfile, self.tempdir)), 1)
+
+    def test_truncated_cache(self):
+        load_events(self.icsfile, self.tempdir)
+        path = get_cache_path(self.tempdir, self.icsfile)
+        data = open(path, 'rb').read()
+        open(path, 'wb').write(data[:-10])
+
+        eq_(len(load_events(self.icsfile, self.tempdir)), 1)
+        assert not os.path.exists(path)
+
+    def test_partial_read_leaves_no_cache(self):
+        events = iter_events(self.icsfile, self.tempdir)
+        events.next()
+        events.close()
+        eq_(os.listdir(self.tempdir), ['test.ics'])
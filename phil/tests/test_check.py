@@ -21,41 +21,237 @@
 import os
 import datetime
 import fudge
+from fudge.inspector import arg
+from nose.tools import eq_
 
+# phil.check imports icalendar when it first reads a calendar.  That
+# mustn't happen while test_check has datetime patched.
+import phil.ics
+from phil.mailer import Message, get_address_key, unique_addresses
+from phil.state import open_store
 from phil.tests import get_test_data_dir, TempFileTestCase
 from phil.util import Config
 from phil.check import Phil
 
 
+class FrozenDatetime(datetime.datetime):
+    @classmethod
+    def today(cls):
+        return datetime.datetime(2011, 12, 29, 22, 35, 44, 600000)
+
+
 class CheckTests(TempFileTestCase):
-    @fudge.patch('datetime.datetime.today')
+    # Only phil.check's clock is stopped.  Patching
+    # datetime.datetime.today replaces datetime.datetime everywhere,
+    # so the datetimes icalendar parses stop being datetimes and every
+    # meeting looks like it's at midnight.
+    @fudge.patch('phil.check.datetime')
     @fudge.patch('phil.util')
-    def test_check(self, faketoday, fakeutil):
-        (faketoday
-         .is_callable()
-         .expects_call()
-         .returns(
-             datetime.datetime(2011, 12, 29, 22, 35, 44, 600000)
-             )
-         )
+    @fudge.patch('phil.mailer')
+    def test_check(self, fakedatetime, fakeutil, fakemailer):
+        fakedatetime.has_attr(
+            datetime=FrozenDatetime, timedelta=datetime.timedelta)
 
         (fakeutil
          .expects('load_state')
          .returns({})
          .expects('save_state')
-         .expects('send_mail_smtp')
+         )
+
+        fakepool = (fakemailer
+                    .expects('MailerPool')
+                    .with_args(1, host_rates={})
+                    .returns_fake()
+                    .has_attr(timings=[], connect_timings=[], waited=0.0)
+                    .expects('close'))
+
+        (fakemailer
+         .expects('Dispatcher')
+         .with_args(fakepool, 1, arg.any())
+         .returns_fake()
+         .expects('start')
+         .expects('submit')
          .with_args(
-             'sender@example.com', ['recip@example.com'],
-             u'bi-weekly conference call (Fri December 30, 2011 00:00)',
-             u'Weekly conference call\nLocation: IRC\nMeeting agenda '
-             'and notes: http://example.com/notes/2011-12-30\n\nBe '
-             'there or be square!',
-             'localhost', 25)
+             ((u'2011-11-18 12:00:00+00:00::bi-weekly conference call::',
+               '2011-12-30'),),
+             'localhost', 25,
+             ('sender@example.com', ('recip@example.com',),
+              u'bi-weekly conference call (Fri December 30, 2011 12:00)',
+              u'Weekly conference call\nLocation: IRC\nMeeting agenda '
+              'and notes: http://example.com/notes/2011-12-30\n\nBe '
+              'there or be square!',
+              'each'))
+         .expects('join')
+         .returns([])
          )
 
+        fakemailer.provides('Message').calls(Message)
+        fakemailer.provides('unique_addresses').calls(unique_addresses)
+        fakemailer.provides('get_address_key').calls(get_address_key)
+
         test2_path = os.path.join(get_test_data_dir(), 'test2.ics')
 
         p = Phil(quiet=True, debug=False)
         p.config = Config(test2_path, 3, self.tempdir, 'localhost', 25,
-                          'sender@example.com', ['recip@example.com'])
+                          'sender@example.com', ['recip@example.com'],
+                          cache=False)
         p._run()
+
+
+ICS = """BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+DTSTART:20130201T090000
+SUMMARY:standup
+ORGANIZER:mailto:lead@example.com
+ATTENDEE:mailto:sam@example.com
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20130201T090000
+SUMMARY:standup
+ORGANIZER:MAILTO:Lead@Example.com
+ATTENDEE;PARTSTAT=ACCEPTED:mailto:sam@example.com
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20130201T090000
+SUMMARY:launch
+X-PHIL-TO:ops@example.com, recip@example.com
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class RecordingMailer(object):
+    def __init__(self):
+        self.sent = []
+        # Messages to these addresses are refused.
+        self.refuse = set()
+
+    def send(self, sender, to_list, subject, body, delivery='each'):
+        if self.refuse.intersection(to_list):
+            raise IOError('refused')
+        self.sent.append((to_list, subject))
+
+
+class RecordingPool(object):
+    def __init__(self):
+        self.mailer = RecordingMailer()
+        self.timings = []
+        self.connect_timings = []
+        self.waited = 0.0
+
+    def acquire(self, host, port):
+        return self.mailer
+
+    def release(self, mailer):
+        pass
+
+
+class RecipientsTests(TempFileTestCase):
+    def send(self, recipients):
+        icsfile = os.path.join(self.tempdir, 'people.ics')
+        open(icsfile, 'w').write(ICS)
+        p = Phil(quiet=True)
+        p.config = Config(icsfile, 3, self.tempdir, 'localhost', 25,
+                          'sender@example.com', ['recip@example.com'],
+                          cache=False, outbox=False, recipients=recipients)
+        p.pool = RecordingPool()
+        today = datetime.datetime(2013, 1, 30, 9)
+
+        state = open_store(self.tempdir)
+        events = list(p._load_events())
+        eq_(p._send(p._due_reminders(events, today, state, p._load_index()),
+                    state), 0)
+        # Every reminder is recorded, even ones sent with another.
+        for event in events:
+            eq_(state.get(event.event_id), '2013-02-01')
+        state.close()
+        return sorted(p.pool.mailer.sent), p.metrics.counts
+
+    def test_to(self):
+        # The standups are the same message to the same people.
+        sent, counts = self.send('to')
+        eq_(sent, [
+            (('recip@example.com',),
+             'standup (Fri February 01, 2013 09:00)'),
+            (('recip@example.com', 'ops@example.com'),
+             'launch (Fri February 01, 2013 09:00)')])
+        eq_(counts['grouped'], 1)
+
+    def test_attendees(self):
+        sent, counts = self.send('attendees')
+        eq_(sent, [
+            (('lead@example.com', 'sam@example.com'),
+             'standup (Fri February 01, 2013 09:00)'),
+            (('recip@example.com', 'ops@example.com'),
+             'launch (Fri February 01, 2013 09:00)')])
+
+    def test_both(self):
+        sent, counts = self.send('both')
+        eq_([to_list for to_list, subject in sent], [
+            ('recip@example.com', 'lead@example.com', 'sam@example.com'),
+            ('recip@example.com', 'ops@example.com')])
+
+
+class DigestTests(TempFileTestCase):
+    def test_digest(self):
+        icsfile = os.path.join(self.tempdir, 'people.ics')
+        open(icsfile, 'w').write(ICS)
+        p = Phil(quiet=True)
+        p.config = Config(icsfile, 3, self.tempdir, 'localhost', 25,
+                          'sender@example.com', ['recip@example.com'],
+                          cache=False, recipients='both', digest=True)
+        p.pool = RecordingPool()
+        p.pool.mailer.refuse.add('ops@example.com')
+        today = datetime.datetime(2013, 1, 30, 9)
+
+        state = open_store(self.tempdir)
+        outbox = p._open_outbox()
+        events = list(p._load_events())
+        reminders = p._due_reminders(
+            events, today, state, p._load_index(), outbox)
+        eq_(p._send(reminders, state, outbox), 1)
+
+        # recip gets all three reminders in one message and the people
+        # at the standups get one with both.  The launch reminder for
+        # ops couldn't be sent.
+        eq_(sorted(p.pool.mailer.sent), [
+            (('lead@example.com', 'sam@example.com'),
+             'Reminders for 2 meetings'),
+            (('recip@example.com',), 'Reminders for 3 meetings')])
+        eq_(p.metrics.counts['digests'], 3)
+
+        standup, other_standup, launch = events
+        eq_(state.get(standup.event_id), '2013-02-01')
+        eq_(state.get(other_standup.event_id), '2013-02-01')
+        eq_(state.get(launch.event_id), None)
+
+        # Only ops is left to get the launch reminder.
+        entry, = outbox.entries()
+        eq_(entry.token[0], launch.event_id)
+        eq_(entry.message.to_list, ['ops@example.com'])
+        state.close()
+
+
+class GarbageCollectionTests(TempFileTestCase):
+    def test_run_forgets_gone_events(self):
+        test3_path = os.path.join(get_test_data_dir(), 'test3.ics')
+        state = open_store(self.tempdir)
+        state.record(u'2013-01-07 10:00:00::team meeting::', '2013-01-07')
+        state.record(u'2011-11-18 12:00:00::deleted meeting::', '2011-12-30')
+        state.close()
+
+        p = Phil(quiet=True)
+        p.config = Config(test3_path, 3, self.tempdir, 'localhost', 25,
+                          'sender@example.com', ['recip@example.com'],
+                          cache=False)
+        p.pool = RecordingPool()
+        eq_(p._run(), 0)
+
+        # The team meeting's state moved to its UID and the deleted
+        # meeting's is gone.
+        state = open_store(self.tempdir)
+        eq_(state.keys(), [u'weekly@example.com'])
+        eq_(state.get(u'weekly@example.com'), '2013-01-07')
+        state.close()
+        eq_(p.metrics.counts['state_removed'], 1)
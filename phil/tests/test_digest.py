@@ -0,0 +1,64 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+from nose.tools import eq_
+
+from phil.digest import build_digests, format_digest
+from phil.mailer import Message
+
+
+def make_job(event_id, date, to_list):
+    return ((event_id, date),
+            Message('phil@example.com', to_list,
+                    u'{0} ({1})'.format(event_id, date), u'notes'))
+
+
+def test_format_digest():
+    subject, body = format_digest([
+        make_job('a', '2013-02-01', ['x@example.com'])[1],
+        make_job('b', '2013-02-02', ['x@example.com'])[1]])
+    eq_(subject, 'Reminders for 2 meetings')
+    eq_(body, u'a (2013-02-01)\n==============\n\nnotes\n\n\n'
+        u'b (2013-02-02)\n==============\n\nnotes')
+
+
+def test_build_digests():
+    jobs = [
+        make_job('late', '2013-02-03', ['One <one@example.com>']),
+        make_job('early', '2013-02-01',
+                 ['one@example.com', 'two@example.com']),
+        make_job('solo', '2013-02-02', ['three@example.com']),
+        make_job('pair', '2013-02-02',
+                 ['TWO@example.com', 'four@example.com']),
+        ]
+    digests = build_digests(jobs)
+    eq_([(tokens, message.to_list) for tokens, message in digests], [
+        # The first form of each address is kept.
+        ((('early', '2013-02-01'), ('late', '2013-02-03')),
+         ('one@example.com',)),
+        ((('early', '2013-02-01'), ('pair', '2013-02-02')),
+         ('two@example.com',)),
+        ((('pair', '2013-02-02'),), ('four@example.com',)),
+        ((('solo', '2013-02-02'),), ('three@example.com',)),
+        ])
+
+    # A digest of one is that reminder's own message.
+    eq_(digests[2][1].subject, u'pair (2013-02-02)')
+    eq_(digests[0][1].subject, 'Reminders for 2 meetings')
+    eq_(digests[0][1].sender, 'phil@example.com')
@@ -0,0 +1,113 @@
+######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+
+import datetime
+
+import dateutil.rrule
+import dateutil.tz
+from nose.tools import eq_
+
+import phil.expand
+from phil.expand import compile_rule, occurrences_between
+from phil.util import Event
+
+
+R = dateutil.rrule
+START = datetime.datetime(2011, 1, 31, 9, 30)
+
+RULES = [
+    ('hourly', R.HOURLY, {'interval': 7}),
+    ('daily', R.DAILY, {'interval': 14}),
+    ('daily-until', R.DAILY,
+     {'until': datetime.datetime(2012, 3, 1, 9, 30)}),
+    ('daily-count', R.DAILY, {'count': 400}),
+    ('weekly', R.WEEKLY, {}),
+    ('weekly-days', R.WEEKLY,
+     {'interval': 2, 'byweekday': [R.MO, R.FR, R.SU]}),
+    ('weekly-wkst', R.WEEKLY,
+     {'interval': 3, 'byweekday': [R.MO, R.SA], 'wkst': R.SU}),
+    ('weekly-count', R.WEEKLY, {'byweekday': [R.SA], 'count': 60}),
+    ('monthly-31', R.MONTHLY, {}),
+    ('monthly-day', R.MONTHLY, {'bymonthday': 15, 'interval': 5}),
+    ('monthly-count', R.MONTHLY, {'bymonthday': 3, 'count': 14}),
+    ('monthly-nth', R.MONTHLY, {'byweekday': R.TU(2)}),
+    ('yearly', R.YEARLY, {}),
+    ]
+
+
+def build_events(tzinfo=None):
+    events = []
+    for event_id, freq, args in RULES:
+        args = dict(args, dtstart=START.replace(tzinfo=tzinfo))
+        if 'until' in args:
+            args['until'] = args['until'].replace(tzinfo=tzinfo)
+        events.append(
+            Event(event_id, R.rrule(freq, **args), '', '', (freq, args)))
+    return events
+
+
+def expected(events, start, end):
+    pairs = []
+    for i, event in enumerate(events):
+        for date in event.rrule.between(start, end, inc=True):
+            if date < end:
+                pairs.append((date, i, event.event_id))
+    pairs.sort()
+    return [(event_id, date) for date, i, event_id in pairs]
+
+
+def test_compile_rule():
+    events = build_events()
+    compiled = dict((event.event_id, compile_rule(event.rule_args))
+                    for event in events)
+
+    eq_(len(compiled['weekly-days']), 3)
+    eq_(compiled['monthly-nth'], None)
+    eq_(compiled['yearly'], None)
+    eq_(compiled['hourly'], [('step', START, 7 * 3600, 0, None, None)])
+
+
+def test_matches_dateutil():
+    for tzinfo in (None, dateutil.tz.tzutc()):
+        events = build_events(tzinfo)
+        windows = [
+            (datetime.datetime(2011, 1, 1), datetime.datetime(2011, 3, 1)),
+            (datetime.datetime(2012, 2, 20, 9, 30),
+             datetime.datetime(2012, 3, 20, 9, 30)),
+            (datetime.datetime(2013, 6, 1), datetime.datetime(2014, 6, 1)),
+            ]
+        for start, end in windows:
+            start = start.replace(tzinfo=tzinfo)
+            end = end.replace(tzinfo=tzinfo)
+            eq_(occurrences_between(events, start, end),
+                expected(events, start, end))
+
+
+def test_without_numpy():
+    numpy = phil.expand.numpy
+    phil.expand.numpy = None
+    try:
+        events = build_events()
+        start = datetime.datetime(2012, 1, 1)
+        end = datetime.datetime(2012, 2, 1)
+        eq_(occurrences_between(events, start, end),
+            expected(events, start, end))
+    finally:
+        phil.expand.numpy = numpy
@@ -0,0 +1,196 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+import datetime
+import gzip
+import os
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+from nose.tools import eq_, assert_raises
+
+from phil.check import Phil
+from phil.fetch import FetchError, Fetcher, get_fetch_path
+from phil.tests import TempFileTestCase
+from phil.util import parse_configuration
+
+
+ICS = """BEGIN:VCALENDAR
+VERSION:1.0
+BEGIN:VEVENT
+DTSTART:20111118T120000
+SUMMARY:bi-weekly conference call
+RRULE:FREQ=DAILY;INTERVAL=14
+DESCRIPTION:conference call
+END:VEVENT
+END:VCALENDAR
+"""
+
+ETAG = '"v1"'
+
+
+class CalendarHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between requests.
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def respond(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.dict)
+        if self.path == '/moved.ics':
+            self.respond(302, headers={'Location': '/cal.ics'})
+        elif self.path == '/cal.ics':
+            if self.headers.get('If-None-Match') == ETAG:
+                self.respond(304)
+            else:
+                self.respond(200, ICS, {'ETag': ETAG})
+        elif self.path == '/gzip.ics':
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(ICS)
+            f.close()
+            self.respond(200, buf.getvalue(), {'Content-Encoding': 'gzip'})
+        else:
+            self.respond(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class CalendarServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), CalendarHandler)
+        self.connections = 0
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+
+class FetchTestCase(TempFileTestCase):
+    def setUp(self):
+        TempFileTestCase.setUp(self)
+        self.server = CalendarServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        TempFileTestCase.tearDown(self)
+
+
+class FetcherTest(FetchTestCase):
+    def test_conditional(self):
+        path = os.path.join(self.tempdir, 'cal.ics')
+        fetcher = Fetcher()
+        try:
+            eq_(fetcher.fetch(self.server.url + '/cal.ics', path), True)
+            eq_(open(path).read(), ICS)
+            mtime = os.stat(path).st_mtime
+
+            eq_(fetcher.fetch(self.server.url + '/cal.ics', path), False)
+            eq_(self.server.requests[1]['if-none-match'], ETAG)
+            eq_(os.stat(path).st_mtime, mtime)
+
+            # Both requests went over the same connection.
+            eq_(self.server.connections, 1)
+        finally:
+            fetcher.close()
+
+    def test_redirect_and_gzip(self):
+        path = os.path.join(self.tempdir, 'cal.ics')
+        fetcher = Fetcher()
+        try:
+            eq_(fetcher.fetch(self.server.url + '/moved.ics', path), True)
+            eq_(open(path).read(), ICS)
+            eq_(fetcher.fetch(self.server.url + '/gzip.ics', path), True)
+            eq_(open(path).read(), ICS)
+        finally:
+            fetcher.close()
+
+    def test_errors(self):
+        path = os.path.join(self.tempdir, 'cal.ics')
+        fetcher = Fetcher()
+        try:
+            assert_raises(FetchError, fetcher.fetch,
+                          self.server.url + '/missing.ics', path)
+            eq_(os.path.exists(path), False)
+        finally:
+            fetcher.close()
+
+
+class PhilFetchTest(FetchTestCase):
+    def write_config(self, url):
+        conffile = os.path.join(self.tempdir, 'config.ini')
+        open(conffile, 'w').write(
+            '[default]\n'
+            'datadir = {0}\n'
+            'icsfile = {1}\n'
+            'smtp_host = localhost\n'
+            'from = phil@example.com\n'
+            'to = recip@example.com\n'
+            'remind = 3\n'.format(self.tempdir, url))
+        return conffile
+
+    def test_parse_configuration(self):
+        url = self.server.url + '/cal.ics'
+        config = parse_configuration(self.write_config(url))
+        eq_(config.url, url)
+        eq_(config.icsfile, get_fetch_path(self.tempdir, url))
+
+    def test_agenda(self):
+        conffile = self.write_config(self.server.url + '/cal.ics')
+        start = datetime.datetime(2013, 1, 1)
+        p = Phil(quiet=True)
+        for i in range(2):
+            stream = StringIO()
+            eq_(p.agenda(conffile, start, count=1, stream=stream), 0)
+            eq_(stream.getvalue(),
+                'Fri January 11, 2013 12:00  bi-weekly conference call\n')
+        eq_(p.metrics.counts.get('fetch_not_modified'), 1)
+
+        # If the server is gone, the copy from last time is used.
+        self.server.shutdown()
+        self.server.server_close()
+        stream = StringIO()
+        eq_(p.agenda(conffile, start, count=1, stream=stream), 0)
+        eq_(stream.getvalue(),
+            'Fri January 11, 2013 12:00  bi-weekly conference call\n')
+
+    def test_no_copy(self):
+        conffile = self.write_config(self.server.url + '/missing.ics')
+        p = Phil(quiet=True)
+        eq_(p.agenda(conffile, count=1, stream=StringIO()), 1)
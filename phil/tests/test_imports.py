@@ -0,0 +1,83 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+import json
+import os
+import subprocess
+import sys
+
+from nose.tools import eq_
+
+from phil.tests import TempFileTestCase
+
+
+# Modules that should only be imported by the code that uses them.
+HEAVY = ['argparse', 'dateutil', 'email', 'httplib', 'icalendar', 'numpy',
+         'pytz', 'smtplib', 'sqlite3']
+
+# Seconds "import phil" may take.  It's about 0.02s; this is loose
+# enough for slow machines but catches something heavy sneaking in.
+IMPORT_BUDGET = 0.5
+
+PROBE = """
+import json, sys, time
+start = time.time()
+import phil
+elapsed = time.time() - start
+{run}
+modules = sorted(set(name.split('.')[0] for name, mod in sys.modules.items()
+                     if mod is not None))
+print
+print json.dumps({{'elapsed': elapsed, 'modules': modules}})
+"""
+
+
+def probe(run=''):
+    """Imports phil in a fresh interpreter, runs run and returns
+    (seconds to import phil, top-level modules that are loaded).
+
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    proc = subprocess.Popen(
+        [sys.executable, '-c', PROBE.format(run=run)],
+        cwd=root, stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    eq_(proc.returncode, 0)
+    data = json.loads(output.splitlines()[-1])
+    return data['elapsed'], data['modules']
+
+
+def loaded(modules):
+    return [name for name in HEAVY if name in modules]
+
+
+def test_import_phil():
+    elapsed, modules = min(probe() for i in range(3))
+    eq_(loaded(modules), [])
+    assert elapsed < IMPORT_BUDGET, elapsed
+
+
+class CmdlineImportsTest(TempFileTestCase):
+    def test_createfile(self):
+        path = os.path.join(self.tempdir, 'phil.ini')
+        elapsed, modules = probe(
+            'phil.main(["-q", "createfile", {0!r}])'.format(path))
+        eq_(loaded(modules), ['argparse'])
+        assert os.path.exists(path)
@@ -0,0 +1,132 @@
+######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+
+import datetime
+import os
+import shutil
+
+import dateutil.rrule
+from nose.tools import eq_
+
+from phil.index import OccurrenceIndex, iter_batches
+from phil.tests import get_test_data_dir, TempFileTestCase
+from phil.util import Event
+
+
+def build_event(event_id, freq, **args):
+    return Event(event_id, dateutil.rrule.rrule(freq, **args), '', '')
+
+
+def test_after_matches_rrule():
+    start = datetime.datetime(2011, 1, 1, 9, 30)
+    events = [
+        build_event('hourly', dateutil.rrule.HOURLY, dtstart=start,
+                    interval=5),
+        build_event('monthly', dateutil.rrule.MONTHLY, dtstart=start,
+                    bymonthday=31),
+        build_event('count', dateutil.rrule.DAILY, dtstart=start, count=3),
+        build_event('sparse', dateutil.rrule.YEARLY, dtstart=start,
+                    interval=2),
+        ]
+
+    index = OccurrenceIndex()
+    dt = datetime.datetime(2012, 2, 1)
+    for i in range(40):
+        for event in events:
+            eq_(index.after(event, dt, inc=True),
+                event.rrule.after(dt, inc=True))
+            eq_(index.after(event, dt), event.rrule.after(dt))
+        dt += datetime.timedelta(hours=181)
+
+
+def test_fill_matches_rrule():
+    start = datetime.datetime(2011, 1, 1, 9, 30)
+    rules = [
+        (dateutil.rrule.HOURLY, {'interval': 5}),
+        (dateutil.rrule.WEEKLY,
+         {'byweekday': [dateutil.rrule.TU, dateutil.rrule.FR]}),
+        (dateutil.rrule.MONTHLY, {'bymonthday': 31}),
+        (dateutil.rrule.DAILY, {'count': 3}),
+        (dateutil.rrule.YEARLY, {'interval': 2}),
+        ]
+    events = []
+    for i, (freq, args) in enumerate(rules):
+        args = dict(args, dtstart=start)
+        events.append(Event(str(i), dateutil.rrule.rrule(freq, **args),
+                            '', '', (freq, args)))
+
+    index = OccurrenceIndex()
+    dt = datetime.datetime(2012, 2, 1)
+    for i in range(40):
+        index.fill(events, dt)
+        for event in events:
+            eq_(index.after(event, dt, inc=True),
+                event.rrule.after(dt, inc=True))
+        dt += datetime.timedelta(hours=181)
+
+
+def test_iter_batches():
+    eq_(list(iter_batches(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+    eq_(list(iter_batches([], 2)), [])
+
+
+def test_next_n():
+    start = datetime.datetime(2011, 1, 1, 9, 30)
+    event = build_event('hourly', dateutil.rrule.HOURLY, dtstart=start)
+    index = OccurrenceIndex()
+
+    eq_(index.next_n(event, datetime.datetime(2011, 1, 1, 10), 3),
+        [datetime.datetime(2011, 1, 1, 10, 30),
+         datetime.datetime(2011, 1, 1, 11, 30),
+         datetime.datetime(2011, 1, 1, 12, 30)])
+
+
+class SavedIndexTests(TempFileTestCase):
+    def test_save_and_load(self):
+        icsfile = os.path.join(self.tempdir, 'test.ics')
+        shutil.copy(os.path.join(get_test_data_dir(), 'test1.ics'), icsfile)
+        event = build_event('daily', dateutil.rrule.DAILY,
+                            dtstart=datetime.datetime(2011, 1, 1))
+        dt = datetime.datetime(2012, 1, 1)
+
+        index = OccurrenceIndex.load(self.tempdir, 'default', icsfile)
+        index.after(event, dt)
+        index.save()
+
+        index = OccurrenceIndex.load(self.tempdir, 'default', icsfile)
+        eq_(index.entries['daily'].start, dt)
+
+        # Changing the ics file throws the index away.
+        os.utime(icsfile, (0, 0))
+        index = OccurrenceIndex.load(self.tempdir, 'default', icsfile)
+        eq_(index.entries, {})
+
+    def test_prune(self):
+        event = build_event('daily', dateutil.rrule.DAILY,
+                            dtstart=datetime.datetime(2011, 1, 1))
+        gone = build_event('gone', dateutil.rrule.DAILY,
+                           dtstart=datetime.datetime(2011, 1, 1))
+        index = OccurrenceIndex()
+        index.after(event, datetime.datetime(2012, 1, 1))
+        index.after(gone, datetime.datetime(2012, 1, 1))
+
+        index.prune(datetime.datetime(2012, 1, 10), set(['daily']))
+        eq_(index.entries.keys(), ['daily'])
+        eq_(index.entries['daily'].dates[0], datetime.datetime(2012, 1, 10))
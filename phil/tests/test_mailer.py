@@ -0,0 +1,258 @@
+######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+
+import smtplib
+
+import fudge
+from nose.tools import eq_, assert_raises
+
+from phil.mailer import (
+    DeliveryError, Dispatcher, Mailer, MailerPool, Message, RateLimiter,
+    build_envelopes, build_message, get_failed)
+
+
+def test_build_message():
+    sender, to_addrs, text = build_message(
+        'Phil <phil@example.com>',
+        ['One <one@example.com>', 'two@example.com'],
+        'Meeting', 'body')
+
+    eq_(sender, 'phil@example.com')
+    eq_(to_addrs, ['one@example.com', 'two@example.com'])
+    assert 'To: One <one@example.com>, two@example.com\n' in text
+
+
+def test_build_envelopes():
+    to_list = ['One <one@example.com>', 'two@example.com']
+
+    envelopes = build_envelopes(
+        'phil@example.com', to_list, 'Meeting', 'body', 'each')
+    eq_([to_addrs for sender, to_addrs, text in envelopes],
+        [['one@example.com'], ['two@example.com']])
+    first, second = [text for sender, to_addrs, text in envelopes]
+    eq_(first.split('\n', 1),
+        ['To: One <one@example.com>', second.split('\n', 1)[1]])
+
+    envelopes = build_envelopes(
+        'phil@example.com', to_list, 'Meeting', 'body', 'bcc')
+    eq_(len(envelopes), 1)
+    sender, to_addrs, text = envelopes[0]
+    eq_(to_addrs, ['one@example.com', 'two@example.com'])
+    assert 'To: undisclosed-recipients:;\n' in text
+    assert 'one@example.com' not in text
+
+
+@fudge.patch('smtplib.SMTP')
+def test_mailer_reuses_connection(fakesmtp):
+    (fakesmtp
+     .expects_call()
+     .with_args('localhost', 25)
+     .returns_fake()
+     .expects('sendmail')
+     .times_called(3)
+     .expects('quit')
+     )
+
+    # One copy each for a and b and one for a, all on one connection.
+    mailer = Mailer('localhost', 25)
+    mailer.send('phil@example.com', ['a@example.com', 'b@example.com'],
+                'first', 'body')
+    mailer.send('phil@example.com', ['a@example.com'], 'second', 'body')
+    mailer.close()
+
+    eq_([subject for subject, elapsed in mailer.timings],
+        ['first', 'second'])
+
+
+class FakeSMTP(object):
+    def __init__(self, bad=()):
+        self.bad = bad
+        self.sent = []
+
+    def sendmail(self, sender, to_addrs, text):
+        # Like smtplib, it's an error only if every recipient is
+        # refused.
+        refused = dict([(addr, (550, 'no such user'))
+                        for addr in to_addrs if addr in self.bad])
+        if len(refused) == len(to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        self.sent.append(to_addrs)
+        return refused
+
+
+def test_mailer_each_partial_failure():
+    mailer = Mailer('localhost', 25)
+    mailer.server = FakeSMTP(bad=['c@example.com'])
+    to_list = ['a@example.com', 'B <b@example.com>', 'c@example.com',
+               'd@example.com']
+    try:
+        mailer.send('phil@example.com', to_list, 'Meeting', 'body', 'each')
+    except DeliveryError, exc:
+        pass
+    else:
+        raise AssertionError('DeliveryError not raised')
+
+    # a and b got it, so only c and d are left.
+    eq_(mailer.server.sent, [['a@example.com'], ['b@example.com']])
+    eq_(exc.failed, ('c@example.com', 'd@example.com'))
+    eq_(get_failed(to_list, exc), ('c@example.com', 'd@example.com'))
+
+    # If nothing got through, it's the original error and everyone
+    # failed.
+    mailer.server = FakeSMTP(bad=['a@example.com'])
+    assert_raises(smtplib.SMTPRecipientsRefused, mailer.send,
+                  'phil@example.com', to_list, 'Meeting', 'body', 'each')
+    eq_(get_failed(to_list, ValueError()), tuple(to_list))
+
+
+def test_mailer_refused_recipients():
+    mailer = Mailer('localhost', 25)
+    mailer.server = FakeSMTP(bad=['B@example.com'])
+    to_list = ['a@example.com', 'B <B@example.com>']
+    try:
+        mailer.send('phil@example.com', to_list, 'Meeting', 'body', 'to')
+    except DeliveryError, exc:
+        pass
+    else:
+        raise AssertionError('DeliveryError not raised')
+
+    # The server took the message for a, but not for b.
+    eq_(mailer.server.sent, [['a@example.com', 'B@example.com']])
+    eq_(exc.failed, ('B <B@example.com>',))
+    assert isinstance(exc.error, smtplib.SMTPRecipientsRefused)
+    assert 'not sent to B <B@example.com>' in str(exc)
+    eq_(len(mailer.timings), 1)
+
+
+class FakeMailer(object):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sent = []
+
+    def send(self, sender, to_list, subject, body, delivery='each'):
+        if subject == 'bad':
+            raise ValueError('rejected')
+        self.sent.append(subject)
+
+
+class FakePool(object):
+    def __init__(self):
+        self.mailer = FakeMailer('localhost', 25)
+
+    def acquire(self, host, port):
+        return self.mailer
+
+    def release(self, mailer):
+        pass
+
+
+def test_dispatcher():
+    for workers in (1, 3):
+        pool = FakePool()
+        dispatcher = Dispatcher(pool, workers)
+        dispatcher.start()
+        for subject in ('one', 'bad', 'two'):
+            dispatcher.submit(
+                subject, 'localhost', 25,
+                Message('phil@example.com', ['a@example.com'], subject, ''))
+        results = dict(dispatcher.join())
+
+        eq_(sorted(results.keys()), ['bad', 'one', 'two'])
+        eq_(results['one'], None)
+        eq_(results['two'], None)
+        assert isinstance(results['bad'], ValueError)
+        eq_(sorted(pool.mailer.sent), ['one', 'two'])
+
+
+class BrokenPool(FakePool):
+    def acquire(self, host, port):
+        if host == 'broken':
+            raise IOError('no mailer')
+        return self.mailer
+
+
+def test_dispatcher_unexpected_errors():
+    for workers in (1, 3):
+        pool = BrokenPool()
+        done = []
+
+        def callback(token, error):
+            if token == 'callback':
+                raise KeyError(token)
+            done.append((token, error))
+
+        dispatcher = Dispatcher(pool, workers, callback)
+        dispatcher.start()
+        for subject, host in (('one', 'localhost'), ('pool', 'broken'),
+                              ('callback', 'localhost'), ('two', 'localhost')):
+            dispatcher.submit(
+                subject, host, 25,
+                Message('phil@example.com', ['a@example.com'], subject, ''))
+        # The callback's error comes back once everything is done.
+        assert_raises(KeyError, dispatcher.join)
+
+        results = dict(dispatcher.results)
+        eq_(sorted(results.keys()), ['callback', 'one', 'pool', 'two'])
+        assert isinstance(results['pool'], IOError)
+        assert isinstance(results['callback'], KeyError)
+        eq_(results['two'], None)
+        eq_(sorted([token for token, error in done]), ['one', 'pool', 'two'])
+        eq_(sorted(pool.mailer.sent), ['callback', 'one', 'two'])
+
+
+def test_mailer_pool_limits_per_host():
+    pool = MailerPool(limit=1, host_limits={'relay': 2})
+
+    first = pool.acquire('relay', 25)
+    second = pool.acquire('relay', 25)
+    assert first is not second
+    pool.release(first)
+    eq_(pool.acquire('relay', 25), first)
+
+    other = pool.acquire('localhost', 25)
+    eq_(len(pool.mailers), 3)
+    pool.release(other)
+    eq_(pool.acquire('localhost', 25), other)
+
+
+def test_rate_limiter():
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    # 30 a minute is one every 2 seconds, with 3 allowed at once.
+    limiter = RateLimiter(30, burst=3, clock=lambda: clock[0], sleep=sleep)
+    eq_([limiter.acquire() for i in range(5)], [0.0, 0.0, 0.0, 2.0, 2.0])
+    eq_(limiter.waited, 4.0)
+
+    # After a quiet spell, the bucket fills up to the burst again.
+    clock[0] += 60
+    eq_([limiter.acquire() for i in range(4)], [0.0, 0.0, 0.0, 2.0])
+
+
+def test_mailer_pool_shares_limiter_per_host():
+    pool = MailerPool(limit=2, host_rates={'relay': (60, 1)})
+    first = pool.acquire('relay', 25)
+    second = pool.acquire('relay', 25)
+    assert first.limiter is second.limiter
+    eq_(first.limiter.rate, 1.0)
+    eq_(pool.acquire('localhost', 25).limiter, None)
@@ -0,0 +1,91 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+import json
+import os
+
+from nose.tools import eq_
+
+from phil.check import Phil
+from phil.metrics import Metrics, get_metrics_path
+from phil.tests import TempFileTestCase
+from phil.util import Config
+
+
+def test_metrics():
+    clock = [0.0]
+
+    def tick():
+        clock[0] += 0.5
+        return clock[0]
+
+    metrics = Metrics(clock=tick)
+    metrics.incr('sent')
+    metrics.incr('sent', 2)
+    eq_(list(metrics.timed('cache_load', 'ab')), ['a', 'b'])
+    metrics.add_time('smtp_send', 1.5, 3)
+
+    eq_(metrics.as_dict(), {
+        'counts': {'sent': 3},
+        'timings': {
+            'cache_load': {'count': 2, 'seconds': 1.0},
+            'smtp_send': {'count': 3, 'seconds': 1.5}
+            }
+        })
+
+    text = metrics.to_prometheus('work', 100)
+    assert 'phil_sent{calendar="work"} 3\n' in text
+    assert ('phil_stage_seconds{calendar="work",stage="smtp_send"} 1.5\n'
+            in text)
+    assert 'phil_stage_count{calendar="work",stage="cache_load"} 2\n' in text
+
+
+ICS = """BEGIN:VCALENDAR
+VERSION:1.0
+BEGIN:VEVENT
+DTSTART:20111118T120000
+SUMMARY:bi-weekly conference call
+RRULE:FREQ=DAILY;INTERVAL=14
+DESCRIPTION:conference call
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class RunMetricsTest(TempFileTestCase):
+    def test_run_writes_metrics(self):
+        icsfile = os.path.join(self.tempdir, 'test.ics')
+        open(icsfile, 'w').write(ICS)
+        p = Phil(quiet=True, debug=True)
+        for fmt in ('json', 'prometheus'):
+            p.config = Config(icsfile, 3, self.tempdir, 'localhost', 25,
+                              'sender@example.com', ['recip@example.com'],
+                              cache=False, metrics=fmt)
+            p._run()
+
+        path = get_metrics_path(self.tempdir, 'default', 'json')
+        data = json.loads(open(path).read())
+        eq_(data['calendar'], 'default')
+        eq_(data['counts']['events'], 1)
+        for stage in ('state_load', 'ics_parse', 'rrule_convert', 'evaluate',
+                      'state_save', 'run'):
+            eq_(data['timings'][stage]['count'], 1)
+
+        path = get_metrics_path(self.tempdir, 'default', 'prometheus')
+        assert 'phil_events{calendar="default"} 1\n' in open(path).read()
@@ -0,0 +1,184 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+import datetime
+import os
+import time
+
+import pytz
+from nose.tools import eq_
+
+from phil.check import Phil
+from phil.mailer import DeliveryError, Message
+from phil.outbox import BACKOFF, MAX_BACKOFF, Outbox, get_backoff
+from phil.state import open_store
+from phil.tests import TempFileTestCase, get_test_data_dir
+from phil.util import Config
+
+
+MESSAGE = Message('phil@example.com', ['recip@example.com'], u'Call',
+                  u'conference call')
+
+
+def test_get_backoff():
+    eq_([get_backoff(attempts) for attempts in (1, 2, 3)],
+        [BACKOFF, 2 * BACKOFF, 4 * BACKOFF])
+    eq_(get_backoff(100), MAX_BACKOFF)
+
+
+class FakeMailer(object):
+    def __init__(self):
+        self.host = 'localhost'
+        self.port = 25
+        self.up = False
+        self.sent = []
+        self.timings = []
+        # Set to an address to have sending stop there.
+        self.stop_at = None
+
+    def send(self, *message):
+        if not self.up:
+            raise IOError('connection refused')
+        to_list = list(message[1])
+        if self.stop_at in to_list:
+            i = to_list.index(self.stop_at)
+            raise DeliveryError(to_list[i:], IOError('connection lost'))
+        self.sent.append(message[2])
+
+
+class FakePool(object):
+    def __init__(self):
+        self.mailer = FakeMailer()
+        self.timings = []
+        self.connect_timings = []
+        self.waited = 0.0
+
+    def acquire(self, host, port):
+        return self.mailer
+
+    def release(self, mailer):
+        pass
+
+
+class OutboxTests(TempFileTestCase):
+    def setUp(self):
+        super(OutboxTests, self).setUp()
+        self.clock = [1000.0]
+        self.outbox = Outbox(self.tempdir, now=lambda: self.clock[0])
+
+    def test_put_and_retry(self):
+        token = (u'call', '2011-12-30')
+        self.outbox.put(token, MESSAGE, 'refused')
+        assert token in self.outbox
+        eq_(self.outbox.due(), [])
+
+        self.clock[0] += BACKOFF
+        entry, = self.outbox.due()
+        eq_(entry.token, token)
+        eq_(entry.message, MESSAGE)
+        eq_(entry.error, 'refused')
+
+        self.outbox.retry(entry, 'refused again')
+        eq_(self.outbox.due(), [])
+        self.clock[0] += 2 * BACKOFF
+        eq_(self.outbox.due()[0].attempts, 2)
+
+        self.outbox.remove(entry)
+        eq_(len(self.outbox), 0)
+        assert token not in self.outbox
+
+    def test_expire(self):
+        self.outbox.put((u'past', '2011-12-30'), MESSAGE)
+        self.outbox.put((u'today', '2011-12-31'), MESSAGE)
+
+        expired = self.outbox.expire(datetime.date(2011, 12, 31))
+        eq_([entry.token for entry in expired], [(u'past', '2011-12-30')])
+        eq_([entry.token for entry in self.outbox.entries()],
+            [(u'today', '2011-12-31')])
+
+    def test_phil_queues_and_flushes(self):
+        test2_path = os.path.join(get_test_data_dir(), 'test2.ics')
+        p = Phil(quiet=True)
+        p.config = Config(test2_path, 3, self.tempdir, 'localhost', 25,
+                          'sender@example.com', ['recip@example.com'],
+                          cache=False)
+        p.pool = FakePool()
+        today = datetime.datetime(2011, 12, 29, 9, 0, tzinfo=pytz.utc)
+
+        state = open_store(self.tempdir)
+        events = list(p._load_events())
+        index = p._load_index()
+        outbox = p._open_outbox()
+        outbox.now = lambda: time.mktime(today.timetuple())
+        eq_(p._send(p._due_reminders(events, today, state, index, outbox),
+                    state, outbox), 1)
+        eq_(len(outbox), 1)
+
+        # It's not sent again while it's in the outbox.
+        eq_(list(p._due_reminders(events, today, state, index, outbox)), [])
+
+        p.pool.mailer.up = True
+        for entry in outbox.entries():
+            entry.next_try = 0
+            outbox._write(entry)
+        eq_(p._flush_outbox(state, outbox), 0)
+        eq_(len(outbox), 0)
+        eq_(len(p.pool.mailer.sent), 1)
+        eq_(state.get(events[0].event_id), '2011-12-30')
+        state.close()
+
+    def test_partial_delivery_queues_the_rest(self):
+        test2_path = os.path.join(get_test_data_dir(), 'test2.ics')
+        p = Phil(quiet=True)
+        p.config = Config(test2_path, 3, self.tempdir, 'localhost', 25,
+                          'sender@example.com',
+                          ['a@example.com', 'b@example.com',
+                           'c@example.com'],
+                          cache=False, delivery='each')
+        p.pool = FakePool()
+        p.pool.mailer.up = True
+        p.pool.mailer.stop_at = 'b@example.com'
+        today = datetime.datetime(2011, 12, 29, 9, 0, tzinfo=pytz.utc)
+
+        state = open_store(self.tempdir)
+        events = list(p._load_events())
+        outbox = p._open_outbox()
+        outbox.now = lambda: time.mktime(today.timetuple())
+        eq_(p._send(p._due_reminders(events, today, state, p._load_index(),
+                                     outbox), state, outbox), 1)
+
+        # a got it, so only b and c are queued.
+        entry, = outbox.entries()
+        eq_(entry.message.to_list, ['b@example.com', 'c@example.com'])
+        eq_(state.get(events[0].event_id), None)
+
+        # Failing partway again narrows it down further.
+        p.pool.mailer.stop_at = 'c@example.com'
+        entry.next_try = 0
+        outbox._write(entry)
+        eq_(p._flush_outbox(state, outbox), 1)
+        entry, = outbox.entries()
+        eq_(entry.message.to_list, ['c@example.com'])
+
+        p.pool.mailer.stop_at = None
+        entry.next_try = 0
+        outbox._write(entry)
+        eq_(p._flush_outbox(state, outbox), 0)
+        eq_(state.get(events[0].event_id), '2011-12-30')
+        state.close()
@@ -0,0 +1,161 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+import datetime
+import json
+import os
+import sys
+from StringIO import StringIO
+
+from nose.tools import eq_
+
+from phil.check import Phil
+from phil.plan import get_token, write_message
+from phil.state import BACKENDS, open_store
+from phil.tests import TempFileTestCase, get_test_data_dir
+from phil.util import load_state, save_state
+
+
+START = datetime.datetime(2013, 1, 30)
+
+
+class FakeMailer(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, sender, to_list, subject, body, delivery='each'):
+        self.sent.append(subject)
+
+
+class FakePool(object):
+    def __init__(self):
+        self.mailer = FakeMailer()
+        self.timings = []
+        self.connect_timings = []
+        self.waited = 0.0
+
+    def acquire(self, host, port):
+        return self.mailer
+
+    def release(self, mailer):
+        pass
+
+    def close(self):
+        pass
+
+
+class PlanTests(TempFileTestCase):
+    def setUp(self):
+        super(PlanTests, self).setUp()
+        self.conffile = os.path.join(self.tempdir, 'config.ini')
+        open(self.conffile, 'w').write(
+            '[default]\n'
+            'datadir = {0}\n'
+            'icsfile = {1}\n'
+            'smtp_host = localhost\n'
+            'from = phil@example.com\n'
+            'to = recip@example.com\n'
+            'remind = 3\n'
+            'recipients = attendees\n'.format(
+                self.tempdir,
+                os.path.join(get_test_data_dir(), 'test3.ics')))
+
+    def test_plan(self):
+        p = Phil(quiet=True)
+        plan = p.plan(self.conffile, START)
+        eq_([get_token(reminder) for reminder in plan],
+            [(u'weekly@example.com', '2013-01-30'),
+             (u'once@example.com', '2013-02-01')])
+        eq_(plan[1].message.to_list, (
+            '"Pat Organizer" <pat@example.com>', '"Sam" <sam@example.com>',
+            'Kim@Example.com', 'ops@example.com'))
+        eq_(plan[1].config.name, 'default')
+
+        # Nothing was sent or recorded.
+        state = open_store(self.tempdir)
+        eq_(state.keys(), [])
+        state.close()
+
+    def test_plan_is_read_only(self):
+        # The launch was reminded about under its pre-UID id.
+        legacy_id = u'2013-02-01 09:00:00::launch::mailto:pat@example.com'
+        for backend in BACKENDS:
+            save_state(self.tempdir, {legacy_id: '2013-02-01'})
+            open(self.conffile, 'a').write(
+                'cache = false\nstate_backend = {0}\n'.format(backend))
+            before = sorted(os.listdir(self.tempdir))
+
+            p = Phil(quiet=True)
+            plan = p.plan(self.conffile, START)
+            eq_([get_token(reminder)[0] for reminder in plan],
+                [u'weekly@example.com'])
+
+            # Nothing was migrated, created or saved.
+            eq_(sorted(os.listdir(self.tempdir)), before)
+            eq_(load_state(self.tempdir), {legacy_id: '2013-02-01'})
+
+    def test_debug_writes_messages(self):
+        p = Phil(quiet=True)
+        plan = p.plan(self.conffile, START)
+        stream = StringIO()
+        write_message(plan[1].message, stream)
+        eq_(stream.getvalue().splitlines()[:3], [
+            'From: phil@example.com',
+            'To: "Pat Organizer" <pat@example.com>, "Sam" <sam@example.com>,'
+            ' Kim@Example.com, ops@example.com',
+            'Subject: launch (Fri February 01, 2013 09:00)'])
+
+    def test_show_plan_json(self):
+        p = Phil(quiet=True)
+        stream = StringIO()
+        eq_(p.show_plan(self.conffile, START, 'json', stream), 0)
+        data = json.loads(stream.getvalue())
+        eq_([item['subject'] for item in data],
+            [u'team meeting (Wed January 30, 2013 09:00)',
+             u'launch (Fri February 01, 2013 09:00)'])
+        eq_(data[0]['to'], [u'recip@example.com'])
+        eq_(data[0]['date'], u'2013-01-30T09:00:00')
+
+        # Without -q the json on stdout is still only json.
+        p = Phil()
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            eq_(p.show_plan(self.conffile, START, 'json'), 0)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        eq_(json.loads(output), data)
+
+    def test_execute(self):
+        p = Phil(quiet=True)
+        plan = p.plan(self.conffile, START)
+        pool = FakePool()
+        p._make_pool = lambda configs: pool
+        eq_(p.execute(plan), 0)
+        eq_(len(pool.mailer.sent), 2)
+
+        state = open_store(self.tempdir)
+        eq_(state.get(u'once@example.com'), '2013-02-01')
+        state.close()
+
+        # Reminders sent since the plan was made are skipped.
+        eq_(p.execute(plan), 0)
+        eq_(len(pool.mailer.sent), 2)
+        eq_(p.plan(self.conffile, START), [])
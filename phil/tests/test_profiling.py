@@ -0,0 +1,61 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+import datetime
+import os
+from StringIO import StringIO
+
+import dateutil.rrule
+from nose.tools import eq_
+
+from phil.profiling import area_times, format_func, profile_call, summarize
+from phil.tests import TempFileTestCase
+
+
+def expand(count):
+    rule = dateutil.rrule.rrule(
+        dateutil.rrule.DAILY, dtstart=datetime.datetime(2013, 1, 1))
+    return len(list(rule[:count]))
+
+
+class ProfilingTest(TempFileTestCase):
+    def test_profile_call(self):
+        path = os.path.join(self.tempdir, 'phil.prof')
+        ret, stats = profile_call(path, expand, 500)
+
+        eq_(ret, 500)
+        assert os.path.exists(path)
+        times = dict(area_times(stats))
+        eq_(sorted(times),
+            ['dateutil rrules', 'icalendar parsing', 'smtplib I/O'])
+        assert times['dateutil rrules'] > 0
+        eq_(times['smtplib I/O'], 0.0)
+
+        stream = StringIO()
+        summarize(stats, 3, stream)
+        lines = stream.getvalue().splitlines()
+        assert lines[0].startswith('Profile: ')
+        eq_(lines[4], 'Top 3 functions by own time:')
+        eq_(len(lines), 9)
+
+
+def test_format_func():
+    eq_(format_func(('/usr/lib/python2.7/smtplib.py', 10, 'sendmail')),
+        'smtplib.py:10(sendmail)')
+    eq_(format_func(('~', 0, '<len>')), '<len>')
@@ -0,0 +1,135 @@
+######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+
+import datetime
+import os
+
+from nose.tools import eq_
+
+from phil.check import Phil
+from phil.scheduler import Scheduler
+from phil.tests import TempFileTestCase
+
+
+ICS = """BEGIN:VCALENDAR
+VERSION:1.0
+BEGIN:VEVENT
+DTSTART:20111118T120000
+SUMMARY:bi-weekly conference call
+RRULE:FREQ=DAILY;INTERVAL=14
+DESCRIPTION:conference call
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class SchedulerTests(TempFileTestCase):
+    def setUp(self):
+        super(SchedulerTests, self).setUp()
+        icsfile = self.icsfile = os.path.join(self.tempdir, 'test.ics')
+        open(icsfile, 'w').write(ICS)
+        self.conffile = os.path.join(self.tempdir, 'config.ini')
+        open(self.conffile, 'w').write(
+            '[default]\n'
+            'datadir = {0}\n'
+            'icsfile = {1}\n'
+            'smtp_host = localhost\n'
+            'from = phil@example.com\n'
+            'to = recip@example.com\n'
+            'remind = 3\n'.format(self.tempdir, icsfile))
+
+        self.clock = [datetime.datetime(2011, 12, 20, 10, 0)]
+        self.sent = []
+        self.phil = Phil(quiet=True)
+        self.phil._send = self.fake_send
+        self.scheduler = Scheduler(
+            self.phil, self.conffile, poll=60,
+            now=lambda: self.clock[0], sleep=self.fake_sleep)
+
+    def fake_send(self, reminders, state, outbox=None):
+        for event, next_date in reminders:
+            self.sent.append(next_date)
+            state.record(event.event_id, str(next_date.date()))
+        return 0
+
+    def fake_sleep(self, seconds):
+        self.clock[0] += datetime.timedelta(seconds=seconds)
+
+    def test_due_at_exact_time(self):
+        self.scheduler.load()
+        eq_(self.scheduler.heap[0][0], datetime.datetime(2011, 12, 27, 12, 0))
+
+        self.clock[0] = datetime.datetime(2011, 12, 27, 11, 59)
+        self.scheduler.run_pending()
+        eq_(self.sent, [])
+        eq_(self.scheduler.seconds_until_due(), 60)
+
+        self.clock[0] = datetime.datetime(2011, 12, 27, 12, 0)
+        self.scheduler.run_pending()
+        eq_(self.sent, [datetime.datetime(2011, 12, 30, 12, 0)])
+
+        # The next occurrence is two weeks later.
+        eq_(self.scheduler.heap[0][0], datetime.datetime(2012, 1, 10, 12, 0))
+
+    def test_sent_reminders_are_not_rescheduled_on_load(self):
+        self.clock[0] = datetime.datetime(2011, 12, 28, 8, 0)
+        self.scheduler.load()
+        self.scheduler.run_pending()
+        eq_(len(self.sent), 1)
+
+        self.scheduler.load()
+        self.scheduler.run_pending()
+        eq_(len(self.sent), 1)
+
+    def test_reload_on_change(self):
+        self.scheduler.load()
+        eq_(self.scheduler.changed(), False)
+
+        os.utime(self.conffile, (0, 0))
+        eq_(self.scheduler.changed(), True)
+
+    def test_serve(self):
+        self.clock[0] = datetime.datetime(2011, 12, 27, 11, 58, 30)
+        self.scheduler.serve(iterations=3)
+        eq_(self.sent, [datetime.datetime(2011, 12, 30, 12, 0)])
+
+    def test_bad_reload_keeps_schedule(self):
+        self.clock[0] = datetime.datetime(2011, 12, 27, 11, 58, 30)
+        self.scheduler.load()
+        heap = list(self.scheduler.heap)
+
+        # The ics file is broken mid-edit.
+        open(self.icsfile, 'w').write(
+            'BEGIN:VCALENDAR\nBEGIN:VEVENT\nDTSTART:2011111\n'
+            'SUMMARY:half\nEND:VEVENT\nEND:VCALENDAR\n')
+        os.utime(self.icsfile, (0, 0))
+        eq_(self.scheduler.reload(), False)
+        eq_(self.scheduler.heap, heap)
+
+        # The reminder that was due still goes out.
+        self.clock[0] = datetime.datetime(2011, 12, 27, 12, 0)
+        self.scheduler.run_pending()
+        eq_(self.sent, [datetime.datetime(2011, 12, 30, 12, 0)])
+
+        # Once the file is fixed, the next poll picks it up.
+        open(self.icsfile, 'w').write(ICS)
+        eq_(self.scheduler.changed(), True)
+        eq_(self.scheduler.reload(), True)
+        eq_(self.scheduler.changed(), False)
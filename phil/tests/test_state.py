@@ -0,0 +1,127 @@
+######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+
+import os
+
+from nose.tools import eq_, assert_raises
+
+from phil.state import (
+    BACKENDS, collect_garbage, get_reminded, get_state_path, open_store)
+from phil.tests import TempFileTestCase
+from phil.util import Event, save_state
+
+
+class StateStoreTests(TempFileTestCase):
+    def test_round_trip(self):
+        for backend in BACKENDS:
+            store = open_store(self.tempdir, backend, backend)
+            eq_(store.get('event'), None)
+            store.record('event', '2011-12-30')
+            store.record('other', '2011-12-31')
+            store.record('event', '2012-01-13')
+            store.close()
+
+            store = open_store(self.tempdir, backend, backend)
+            eq_(store.get('event'), '2012-01-13')
+            eq_(store.get('other'), '2011-12-31')
+            store.close()
+
+    def test_migrates_state_js(self):
+        for backend in ('log', 'sqlite'):
+            save_state(self.tempdir, {'event': '2011-12-30'}, backend)
+            store = open_store(self.tempdir, backend, backend)
+            eq_(store.get('event'), '2011-12-30')
+            store.close()
+
+    def test_log_ignores_torn_line(self):
+        store = open_store(self.tempdir, 'default', 'log')
+        store.record('event', '2011-12-30')
+        store.close()
+
+        path = get_state_path(self.tempdir, 'default', 'log')
+        open(path, 'ab').write('["other", "2011-')
+
+        store = open_store(self.tempdir, 'default', 'log')
+        eq_(store.get('event'), '2011-12-30')
+        eq_(store.get('other'), None)
+        # Records after the tear aren't lost with it.
+        store.record('next', '2012-01-13')
+        store.close()
+
+        store = open_store(self.tempdir, 'default', 'log')
+        eq_(store.get('event'), '2011-12-30')
+        eq_(store.get('next'), '2012-01-13')
+        store.close()
+
+    def test_log_compaction(self):
+        store = open_store(self.tempdir, 'default', 'log')
+        for i in range(200):
+            store.record('event', str(i))
+        store.close()
+
+        path = get_state_path(self.tempdir, 'default', 'log')
+        eq_(len(open(path).readlines()), 1)
+        store = open_store(self.tempdir, 'default', 'log')
+        eq_(store.get('event'), '199')
+        store.close()
+
+    def test_remove_and_keys(self):
+        for backend in BACKENDS:
+            store = open_store(self.tempdir, backend, backend)
+            store.record('event', '2011-12-30')
+            store.record('gone', '2011-12-31')
+            store.remove('gone')
+            store.remove('never there')
+            eq_(sorted(store.keys()), ['event'])
+            store.close()
+
+            store = open_store(self.tempdir, backend, backend)
+            eq_(sorted(store.keys()), ['event'])
+            eq_(store.get('gone'), None)
+            store.close()
+
+    def test_get_reminded_migrates_legacy_id(self):
+        for backend in BACKENDS:
+            store = open_store(self.tempdir, backend, backend)
+            store.record('2011-11-18 12:00:00::call::', '2011-12-30')
+            event = Event('call@example.com', None, u'call', u'', None,
+                          legacy_id='2011-11-18 12:00:00::call::')
+            eq_(get_reminded(store, event), '2011-12-30')
+            eq_(store.keys(), ['call@example.com'])
+            eq_(get_reminded(store, event), '2011-12-30')
+            eq_(get_reminded(store, Event('new', None, u'', u'')), None)
+            store.close()
+
+    def test_collect_garbage(self):
+        for backend in BACKENDS:
+            store = open_store(self.tempdir, backend, backend)
+            for i in range(10):
+                store.record('event{0}'.format(i), '2011-12-30')
+            eq_(collect_garbage(store, set(['event1', 'event3'])), 8)
+            eq_(sorted(store.keys()), ['event1', 'event3'])
+            store.close()
+
+            store = open_store(self.tempdir, backend, backend)
+            eq_(sorted(store.keys()), ['event1', 'event3'])
+            store.close()
+
+    def test_unknown_backend(self):
+        assert_raises(ValueError, open_store, self.tempdir, None, 'xml')
+        eq_(os.listdir(self.tempdir), [])
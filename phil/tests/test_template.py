@@ -0,0 +1,62 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+import datetime
+
+import pytz
+from nose.tools import eq_, assert_raises
+
+from phil.template import Template, compile_template, render
+from phil.util import Event, generate_date_bits
+
+
+DATE = datetime.datetime(2013, 6, 3, 14, 30)
+
+
+def test_matches_date_bits():
+    text = u'Notes: http://example.com/%(Y)s-%(m)s-%(d)s\n%(A)s %(H)s:%(M)s'
+    event = Event('id', None, u'Call', text)
+    eq_(render(text, event, DATE), text % generate_date_bits(DATE))
+
+
+def test_only_used_fields():
+    eq_(sorted(Template(u'%(Y)s %%(m)s %(Y)s %(d)s').fields), ['Y', 'd'])
+    eq_(Template(u'no placeholders').fields, {})
+
+
+def test_fields():
+    event = Event('id', None, u'Call', u'')
+    eq_(render(u'%(summary)s on %(date)s', event, DATE),
+        u'Call on Mon June 03, 2013 14:30')
+    eq_(render(u'100%% sure', event, DATE), u'100% sure')
+
+    assert_raises(KeyError, render, u'%(nope)s', event, DATE)
+
+
+def test_zones():
+    event = Event('id', None, u'Call', u'')
+    date = pytz.timezone('America/New_York').localize(DATE)
+    eq_(render(u'%(H)s:%(M)s / %(H@UTC)s:%(M@UTC)s', event, date),
+        u'14:30 / 18:30')
+    # naive dates are left alone
+    eq_(render(u'%(H@UTC)s', event, DATE), u'14')
+
+
+def test_compile_once():
+    eq_(compile_template(u'%(Y)s') is compile_template(u'%(Y)s'), True)
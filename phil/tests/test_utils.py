@@ -19,14 +19,17 @@
 
 
 import os
+import ConfigParser
 from nose.tools import eq_, assert_raises
 import datetime
 import dateutil.rrule
+import icalendar
 
-from phil.tests import get_test_data_dir
+from phil.tests import get_test_data_dir, TempFileTestCase
 from phil.util import (
-    normalize_path, FILE, DIR, parse_ics, should_remind, get_next_date,
-    FREQ_MAP)
+    normalize_path, FILE, DIR, should_remind, get_next_date,
+    parse_configurations, get_state_js)
+from phil.ics import parse_ics, iter_vevents, convert_rrule, FREQ_MAP
 
 
 def test_normalize_path():
@@ -65,6 +68,31 @@ def test_parse_ics():
     # TODO: Test multiple events
 
 
+def test_iter_vevents():
+    lines = [
+        'BEGIN:VCALENDAR\r\n',
+        'BEGIN:VTIMEZONE\r\n',
+        'END:VTIMEZONE\r\n',
+        'BEGIN:VEVENT\r\n',
+        'SUMMARY:first\r\n',
+        'DESCRIPTION:a long\r\n',
+        ' END:VEVENT\r\n',
+        'BEGIN:VALARM\r\n',
+        'END:VALARM\r\n',
+        'END:VEVENT\r\n',
+        'BEGIN:VEVENT\n',
+        'SUMMARY:second\n',
+        'END:VEVENT\n',
+        'END:VCALENDAR\r\n',
+        ]
+
+    eq_(list(iter_vevents(lines)), [
+        'BEGIN:VEVENT\r\nSUMMARY:first\r\nDESCRIPTION:a long\r\n'
+        ' END:VEVENT\r\nBEGIN:VALARM\r\nEND:VALARM\r\nEND:VEVENT\r\n',
+        'BEGIN:VEVENT\r\nSUMMARY:second\r\nEND:VEVENT\r\n',
+        ])
+
+
 def test_ics_description_expansion():
     test2 = os.path.join(get_test_data_dir(), 'test2.ics')
     events = parse_ics(test2)
@@ -78,6 +106,92 @@ def test_ics_description_expansion():
         'square!')
 
 
+def test_convert_rrule():
+    R = dateutil.rrule
+    tests = (
+        ('FREQ=WEEKLY;BYDAY=MO,WE,FR',
+         (R.WEEKLY, {'byweekday': [R.MO, R.WE, R.FR]})),
+        ('FREQ=MONTHLY;BYDAY=-1FR,2TU;COUNT=4;WKST=SU',
+         (R.MONTHLY, {'byweekday': [R.FR(-1), R.TU(+2)], 'count': 4,
+                      'wkst': R.SU})),
+        ('FREQ=YEARLY;BYMONTH=1,7;BYMONTHDAY=1,15;INTERVAL=2',
+         (R.YEARLY, {'bymonth': [1, 7], 'bymonthday': [1, 15],
+                     'interval': 2})),
+        ('FREQ=MINUTELY;INTERVAL=15', (R.MINUTELY, {'interval': 15})),
+        ('FREQ=SECONDLY;BYSETPOS=-1', (R.SECONDLY, {'bysetpos': [-1]})),
+        )
+    for text, expected in tests:
+        rule = icalendar.vRecur(icalendar.vRecur.from_ical(text))
+        freq, args = convert_rrule(rule)
+        eq_((freq, args), expected)
+        eq_([type(value) for value in args.get('bymonthday', [])],
+            [int] * len(args.get('bymonthday', [])))
+
+
+def test_parse_ics_overrides():
+    test3 = os.path.join(get_test_data_dir(), 'test3.ics')
+    events = dict((ev.summary, ev) for ev in parse_ics(test3))
+
+    eq_(sorted(events), [u'launch', u'moved retro', u'planning',
+                         u'team meeting'])
+
+    # EXDATE, RDATE, a moved occurrence and a cancelled one.
+    ev = events[u'team meeting']
+    eq_(ev.rule_args, None)
+    eq_(list(ev.rrule), [
+        datetime.datetime(2013, 1, 7, 10),
+        datetime.datetime(2013, 1, 15, 11),
+        datetime.datetime(2013, 1, 21, 10),
+        datetime.datetime(2013, 1, 24, 10),
+        datetime.datetime(2013, 1, 30, 9),
+        ])
+
+    eq_(list(events[u'planning'].rrule), [
+        datetime.datetime(2013, 1, 8, 15),
+        datetime.datetime(2013, 2, 12, 15),
+        datetime.datetime(2013, 3, 12, 15),
+        ])
+    eq_(list(events[u'launch'].rrule), [datetime.datetime(2013, 2, 1, 9)])
+    eq_(list(events[u'moved retro'].rrule),
+        [datetime.datetime(2013, 3, 2, 9)])
+
+    after = datetime.datetime(2013, 1, 14)
+    eq_(get_next_date(after, events[u'team meeting'].rrule),
+        datetime.datetime(2013, 1, 15, 11))
+
+
+def test_parse_ics_people():
+    test3 = os.path.join(get_test_data_dir(), 'test3.ics')
+    events = dict((ev.summary, ev) for ev in parse_ics(test3))
+
+    # Declined attendees and rooms don't get reminders.
+    ev = events[u'launch']
+    eq_(ev.organizer, u'"Pat Organizer" <pat@example.com>')
+    eq_(ev.attendees, (u'"Sam" <sam@example.com>', u'Kim@Example.com'))
+    eq_(ev.properties, ((u'X-PHIL-TO', u'ops@example.com'),))
+
+    ev = events[u'planning']
+    eq_((ev.organizer, ev.attendees, ev.properties), (None, (), ()))
+
+
+def test_parse_ics_event_ids():
+    test3 = os.path.join(get_test_data_dir(), 'test3.ics')
+    events = dict((ev.summary, ev) for ev in parse_ics(test3))
+
+    # Ids come from the UID so they don't change when an event is
+    # edited.  The old id is kept so state can be carried over.
+    eq_(events[u'team meeting'].event_id, u'weekly@example.com')
+    eq_(events[u'team meeting'].legacy_id,
+        u'2013-01-07 10:00:00::team meeting::')
+    eq_(events[u'moved retro'].event_id,
+        u'gone@example.com::20130301T090000')
+
+    test1 = os.path.join(get_test_data_dir(), 'test1.ics')
+    ev = parse_ics(test1)[0]
+    eq_(ev.event_id.endswith(u'::' + ev.summary + u'::'), True)
+    eq_(ev.legacy_id, None)
+
+
 def test_should_remind():
     def build_rrule(freq, **args):
         freq = FREQ_MAP[freq]
@@ -114,3 +228,83 @@ def test_should_remind():
     # 3 days from now, remind in 3
     rule = build_rrule('DAILY', dtstart=today + td(3), interval=7)
     eq_(should_remind(today, get_next_date(today, rule), 3), True)
+
+
+class ParseConfigurationsTests(TempFileTestCase):
+    def write_config(self, text):
+        path = os.path.join(self.tempdir, 'config.ini')
+        open(path, 'w').write(text.format(
+            datadir=self.tempdir,
+            icsfile=os.path.join(get_test_data_dir(), 'test1.ics')))
+        return path
+
+    def test_single_calendar(self):
+        path = self.write_config(
+            '[default]\n'
+            'datadir = {datadir}\n'
+            'icsfile = {icsfile}\n'
+            'smtp_host = localhost\n'
+            'from = phil@example.com\n'
+            'to = one@example.com\n'
+            '    two@example.com\n'
+            'remind = 3\n')
+
+        configs = parse_configurations(path)
+        eq_(len(configs), 1)
+        eq_(configs[0].name, 'default')
+        eq_(configs[0].port, 25)
+        eq_(configs[0].to_list, ['one@example.com', 'two@example.com'])
+        # Everyone gets their own copy unless the config says otherwise.
+        eq_(configs[0].delivery, 'each')
+
+    def test_many_calendars(self):
+        path = self.write_config(
+            '[default]\n'
+            'datadir = {datadir}\n'
+            'smtp_host = localhost\n'
+            'from = phil@example.com\n'
+            'remind = 3\n'
+            '\n'
+            '[team-a]\n'
+            'icsfile = {icsfile}\n'
+            'to = a@example.com\n'
+            '\n'
+            '[team-b]\n'
+            'icsfile = {icsfile}\n'
+            'to = b@example.com\n'
+            'remind = 1\n')
+
+        configs = parse_configurations(path)
+        eq_([(c.name, c.to_list, c.remind) for c in configs],
+            [('team-a', ['a@example.com'], 3),
+             ('team-b', ['b@example.com'], 1)])
+        eq_(configs[0].host, 'localhost')
+
+    def test_missing_option(self):
+        path = self.write_config(
+            '[default]\n'
+            'datadir = {datadir}\n'
+            '\n'
+            '[team-a]\n'
+            'icsfile = {icsfile}\n')
+
+        assert_raises(ConfigParser.NoOptionError, parse_configurations, path)
+
+    def test_bad_state_backend(self):
+        path = self.write_config(
+            '[default]\n'
+            'datadir = {datadir}\n'
+            'icsfile = {icsfile}\n'
+            'smtp_host = localhost\n'
+            'from = phil@example.com\n'
+            'to = one@example.com\n'
+            'remind = 3\n'
+            'state_backend = sqllite\n')
+
+        assert_raises(ValueError, parse_configurations, path)
+
+
+def test_get_state_js():
+    eq_(get_state_js('/tmp'), '/tmp/state.js')
+    eq_(get_state_js('/tmp', 'default'), '/tmp/state.js')
+    eq_(get_state_js('/tmp', 'team-a'), '/tmp/state-team-a.js')
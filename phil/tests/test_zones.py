@@ -0,0 +1,148 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+import cPickle
+import datetime
+import os
+
+import pytz
+from nose.tools import eq_
+
+from phil.ics import parse_ics
+from phil.tests import TempFileTestCase
+from phil.util import get_next_date, to_local, utc
+from phil.zones import from_pytz, get_zone, load_zone
+
+
+HOUR = datetime.timedelta(hours=1)
+
+VTIMEZONE = """BEGIN:VTIMEZONE\r
+TZID:Custom Eastern\r
+BEGIN:STANDARD\r
+DTSTART:19701101T020000\r
+RRULE:FREQ=YEARLY;BYMONTH=11;BYDAY=1SU\r
+TZOFFSETFROM:-0400\r
+TZOFFSETTO:-0500\r
+TZNAME:EST\r
+END:STANDARD\r
+BEGIN:DAYLIGHT\r
+DTSTART:19700308T020000\r
+RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=2SU\r
+TZOFFSETFROM:-0500\r
+TZOFFSETTO:-0400\r
+TZNAME:EDT\r
+END:DAYLIGHT\r
+END:VTIMEZONE\r
+"""
+
+
+def test_vtimezone():
+    zone = load_zone(None, VTIMEZONE)
+    eq_(zone.name, u'Custom Eastern')
+    eq_(load_zone(None, VTIMEZONE) is zone, True)
+
+    winter = datetime.datetime(2013, 1, 10, 10, tzinfo=zone)
+    summer = datetime.datetime(2013, 7, 10, 10, tzinfo=zone)
+    eq_(winter.utcoffset(), -5 * HOUR)
+    eq_(summer.utcoffset(), -4 * HOUR)
+    eq_(winter.tzname(), 'EST')
+    eq_(summer.dst(), HOUR)
+
+    # 2013-03-10 07:00 UTC is 03:00 EDT, right after the clocks change.
+    dt = datetime.datetime(2013, 3, 10, 7, tzinfo=utc).astimezone(zone)
+    eq_(dt.replace(tzinfo=None), datetime.datetime(2013, 3, 10, 3))
+    dt = datetime.datetime(2013, 3, 10, 6, 59, tzinfo=utc).astimezone(zone)
+    eq_(dt.replace(tzinfo=None), datetime.datetime(2013, 3, 10, 1, 59))
+
+    # Only the name and text are pickled.
+    eq_(cPickle.loads(cPickle.dumps(zone, 2)) is zone, True)
+
+
+def test_matches_pytz():
+    for name in ('America/New_York', 'Australia/Sydney', 'UTC'):
+        tz = pytz.timezone(name)
+        zone = from_pytz(name, tz)
+        for month in range(1, 13):
+            for hour in (0, 12):
+                dt = datetime.datetime(2013, month, 15, hour)
+                eq_(dt.replace(tzinfo=zone).utcoffset(),
+                    tz.localize(dt).utcoffset())
+                utc_dt = dt.replace(tzinfo=utc)
+                eq_(utc_dt.astimezone(zone).replace(tzinfo=None),
+                    utc_dt.astimezone(tz).replace(tzinfo=None))
+
+    eq_(get_zone('America/New_York') is get_zone('America/New_York'), True)
+    eq_(get_zone('Nowhere/Special'), None)
+
+
+ICS = """BEGIN:VCALENDAR\r
+VERSION:2.0\r
+BEGIN:VEVENT\r
+DTSTART;TZID=Custom Eastern:20130301T100000\r
+SUMMARY:custom\r
+RRULE:FREQ=DAILY;INTERVAL=7;UNTIL=20130330T000000Z\r
+END:VEVENT\r
+{0}BEGIN:VEVENT\r
+DTSTART;TZID=Europe/London:20130301T100000\r
+SUMMARY:olson\r
+RRULE:FREQ=DAILY;INTERVAL=28\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+DTSTART:20130301T100000Z\r
+SUMMARY:utc\r
+RRULE:FREQ=DAILY;INTERVAL=28\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+DTSTART;TZID=Nowhere:20130301T100000\r
+SUMMARY:unknown\r
+RRULE:FREQ=DAILY;INTERVAL=28\r
+END:VEVENT\r
+END:VCALENDAR\r
+""".format(VTIMEZONE)
+
+
+class ParseZonesTest(TempFileTestCase):
+    def test_parse(self):
+        icsfile = os.path.join(self.tempdir, 'zones.ics')
+        open(icsfile, 'wb').write(ICS)
+        events = dict((event.summary, event) for event in parse_ics(icsfile))
+
+        # The VTIMEZONE comes after the event that uses it.  The
+        # meeting stays at 10:00 local time across the DST change.
+        dates = list(events[u'custom'].rrule)
+        eq_([(dt.day, dt.hour) for dt in dates],
+            [(1, 10), (8, 10), (15, 10), (22, 10), (29, 10)])
+        eq_([dt.utcoffset() for dt in dates],
+            [-5 * HOUR, -5 * HOUR, -4 * HOUR, -4 * HOUR, -4 * HOUR])
+
+        # London changes on March 31st.
+        dates = events[u'olson'].rrule[:3]
+        eq_([(dt.hour, dt.utcoffset()) for dt in dates],
+            [(10, 0 * HOUR), (10, 0 * HOUR), (10, HOUR)])
+
+        eq_(events[u'utc'].rrule[0].utcoffset(), datetime.timedelta(0))
+        eq_(events[u'unknown'].rrule[0].tzinfo, None)
+
+        # Naive and aware dates can be compared with any event.
+        now = datetime.datetime(2013, 3, 20)
+        for event in events.values():
+            date = get_next_date(now, event.rrule)
+            assert to_local(date) >= now, (event.summary, date)
+        date = get_next_date(now.replace(tzinfo=utc), events[u'unknown'].rrule)
+        eq_(date, datetime.datetime(2013, 3, 29, 10))
@@ -18,17 +18,20 @@
 #######################################################################
 
 
+import calendar
+import datetime
 import os
 import textwrap
 import sys
 import json
+import time
 import ConfigParser
-from icalendar import Calendar, vDatetime, vDDDTypes, vText
-import dateutil.rrule
 from collections import namedtuple
-import smtplib
-import email.utils
-from email.mime.text import MIMEText
+
+import phil.fetch
+import phil.mailer
+import phil.metrics
+import phil.state
 
 
 FILE = 'file'
@@ -39,11 +42,13 @@ def format_date(date):
     return date.strftime('%a %B %d, %Y %H:%M')
 
 
+# strftime directives descriptions can use as placeholders
+DATE_FIELDS = ('a', 'A', 'b', 'B', 'c', 'd', 'H', 'I', 'j', 'm', 'M', 'p',
+               'S', 'U', 'v', 'W', 'x', 'X', 'y', 'Y', 'Z')
+
+
 def generate_date_bits(date):
-    return dict((m, date.strftime('%' + m))
-                for m in ('a', 'A', 'b', 'B', 'c', 'd', 'H', 'I', 'j',
-                          'm', 'M', 'p', 'S', 'U', 'v', 'W', 'x', 'X',
-                          'y', 'Y', 'Z'))
+    return dict((m, date.strftime('%' + m)) for m in DATE_FIELDS)
 
 
 def normalize_path(path, filetype=FILE):
@@ -106,24 +111,42 @@ def out(*output, **kwargs):
     sys.stdout.write(output + '\n')
 
 
-def get_state_js(datadir):
-    return os.path.join(datadir, 'state.js')
+def get_state_js(datadir, name=None):
+    """Returns the path to the state file for calendar name.
+
+    The [default] calendar uses ``state.js`` and every other calendar
+    gets its own ``state-NAME.js``.
+
+    """
+    if not name or name == 'default':
+        return os.path.join(datadir, 'state.js')
+    return os.path.join(datadir, 'state-{0}.js'.format(name))
 
 
-def load_state(datadir):
-    path = get_state_js(datadir)
+def load_state(datadir, name=None):
+    path = get_state_js(datadir, name)
     if not os.path.exists(path):
         # save the state here so we can fail on permissions errors
         # before sending email.
-        save_state(datadir, {})
+        save_state(datadir, {}, name)
         return {}
 
     return json.loads(open(path, 'rb').read())
 
 
-def save_state(datadir, data):
-    path = get_state_js(datadir)
-    open(path, 'wb').write(json.dumps(data))
+def save_state(datadir, data, name=None):
+    path = get_state_js(datadir, name)
+    # Write to a temp file and move it into place so a crash can't
+    # leave a half-written state file.
+    tmppath = path + '.tmp'
+    f = open(tmppath, 'wb')
+    try:
+        f.write(json.dumps(data))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmppath, path)
 
 
 def ParseException(Exception):
@@ -141,125 +164,240 @@ def get_template():
 
 
 Config = namedtuple('Config', ['icsfile', 'remind', 'datadir', 'host',
-                               'port', 'sender', 'to_list'])
+                               'port', 'sender', 'to_list', 'workers',
+                               'max_connections', 'cache', 'name',
+                               'state_backend', 'delivery', 'outbox',
+                               'rate', 'burst', 'metrics', 'url',
+                               'recipients', 'digest'])
+# workers, max_connections, cache, name, state_backend, delivery, outbox,
+# rate, burst, metrics, url, recipients, digest
+Config.__new__.__defaults__ = (1, None, True, 'default', 'json', 'each',
+                               True, None, 1, None, None, 'to', False)
+
+# Who an event's reminders go to:
+#
+# to:        the config's to list
+# attendees: the event's organizer and attendees, or the to list if it
+#            doesn't have any
+# both:      the to list and the event's organizer and attendees
+RECIPIENTS = ('to', 'attendees', 'both')
 
 
-def parse_configuration(conffile):
-    cfg = ConfigParser.SafeConfigParser()
-    cfg.readfp(open(conffile))
-
-    icsfile = normalize_path(cfg.get('default', 'icsfile'))
-    remind = int(cfg.get('default', 'remind'))
-    datadir = normalize_path(cfg.get('default', 'datadir'), DIR)
-    host = cfg.get('default', 'smtp_host')
-    if cfg.has_option('default', 'smtp_port'):
-        port = int(cfg.get('default', 'smtp_port'))
+DEFAULT_SECTION = 'default'
+
+# Marker for options that have to be in the config file.
+REQUIRED = object()
+
+BOOLEANS = {
+    '1': True, 'yes': True, 'true': True, 'on': True,
+    '0': False, 'no': False, 'false': False, 'off': False
+    }
+
+
+def parse_bool(value):
+    try:
+        return BOOLEANS[value.lower()]
+    except KeyError:
+        raise ValueError('"{0}" is not a boolean.'.format(value))
+
+
+def get_option(cfg, section, option, default=REQUIRED):
+    """Returns the value of option in section, falling back to the
+    [default] section and then to default.
+
+    :raises ConfigParser.NoOptionError: if the option isn't anywhere
+        and there's no default
+
+    """
+    for sect in (section, DEFAULT_SECTION):
+        if cfg.has_option(sect, option):
+            return cfg.get(sect, option)
+    if default is REQUIRED:
+        raise ConfigParser.NoOptionError(option, section)
+    return default
+
+
+def parse_section(cfg, section):
+    """Returns the Config for a section of a parsed config file."""
+    def get(option, default=REQUIRED):
+        return get_option(cfg, section, option, default)
+
+    remind = int(get('remind'))
+    datadir = normalize_path(get('datadir'), DIR)
+    icsfile = get('icsfile')
+    url = None
+    if phil.fetch.is_url(icsfile):
+        # Fetched into the datadir before it's used.
+        url = icsfile
+        icsfile = phil.fetch.get_fetch_path(datadir, url)
     else:
-        port = 25
-    sender = cfg.get('default', 'from')
-    to_list = cfg.get('default', 'to').splitlines()
+        icsfile = normalize_path(icsfile)
+    host = get('smtp_host')
+    port = int(get('smtp_port', 25))
+    sender = get('from')
+    to_list = get('to').splitlines()
+    workers = int(get('workers', 1))
+    max_connections = get('smtp_max_connections', None)
+    if max_connections is not None:
+        max_connections = int(max_connections)
+    cache = parse_bool(get('cache', 'true'))
+    state_backend = get('state_backend', 'json')
+    if state_backend not in phil.state.BACKENDS:
+        raise ValueError('"{0}" is not a state backend.'.format(
+            state_backend))
+    delivery = get('delivery', 'each')
+    if delivery not in phil.mailer.DELIVERIES:
+        raise ValueError('"{0}" is not a delivery.'.format(delivery))
+    recipients = get('recipients', 'to')
+    if recipients not in RECIPIENTS:
+        raise ValueError('"{0}" is not a recipients setting.'.format(
+            recipients))
+    digest = parse_bool(get('digest', 'false'))
+    outbox = parse_bool(get('outbox', 'true'))
+    rate = get('smtp_rate', None)
+    if rate is not None:
+        rate = float(rate)
+    burst = int(get('smtp_burst', 1))
+    metrics = get('metrics', None)
+    if metrics is not None and metrics not in phil.metrics.FORMATS:
+        raise ValueError('"{0}" is not a metrics format.'.format(metrics))
+
+    return Config(icsfile, remind, datadir, host, port, sender, to_list,
+                  workers, max_connections, cache, section, state_backend,
+                  delivery, outbox, rate, burst, metrics, url, recipients,
+                  digest)
+
+
+def read_configuration(conffile):
+    cfg = ConfigParser.SafeConfigParser()
+    f = open(conffile)
+    try:
+        cfg.readfp(f)
+    finally:
+        f.close()
+    return cfg
 
-    return Config(icsfile, remind, datadir, host, port, sender, to_list)
 
+def parse_configuration(conffile):
+    """Returns the Config for the [default] section of conffile."""
+    return parse_section(read_configuration(conffile), DEFAULT_SECTION)
 
-Event = namedtuple('Event', ['event_id', 'rrule', 'summary', 'description'])
 
+def parse_configurations(conffile):
+    """Returns a list of Configs, one for each calendar in conffile.
 
-FREQ_MAP = {
-    # TODO: Make sure this covers all of them.
-    'HOURLY': dateutil.rrule.HOURLY,
-    'DAILY': dateutil.rrule.DAILY,
-    'MONTHLY': dateutil.rrule.MONTHLY,
-    'YEARLY': dateutil.rrule.YEARLY
-    }
+    Every section other than [default] is a calendar and any option it
+    doesn't set comes from [default].  [default] is a calendar, too, if
+    it has an ``icsfile``.
 
+    """
+    cfg = read_configuration(conffile)
+    sections = [sect for sect in cfg.sections() if sect != DEFAULT_SECTION]
+    if (not sections
+            or cfg.has_option(DEFAULT_SECTION, 'icsfile')):
+        sections.insert(0, DEFAULT_SECTION)
+    return [parse_section(cfg, sect) for sect in sections]
 
-WEEKDAY_MAP = {
-    # TODO: Make sure this covers all of them.
-    'SU': dateutil.rrule.SU,
-    'MO': dateutil.rrule.MO,
-    'TU': dateutil.rrule.TU,
-    'WE': dateutil.rrule.WE,
-    'TH': dateutil.rrule.TH,
-    'FR': dateutil.rrule.FR,
-    'SA': dateutil.rrule.SA
-    }
 
+Event = namedtuple('Event', ['event_id', 'rrule', 'summary', 'description',
+                             'rule_args', 'organizer', 'attendees',
+                             'properties', 'legacy_id'])
+# rule_args is (freq, args) that rrule was built from or None if the
+# rule isn't a single dateutil rrule.  organizer is an address or None,
+# attendees is a tuple of addresses and properties is a sorted tuple of
+# (name, value) for the event's X- properties.  legacy_id is the id
+# phil 1.3 used for the event if it's not event_id, or None.
+Event.__new__.__defaults__ = (None, None, (), (), None)
 
-def get_next_date(dtstart, rrule):
-    return rrule.after(dtstart, inc=True)
 
+ZERO = datetime.timedelta(0)
 
-def should_remind(dtstart, next_date, remind):
-    delta = next_date.date() - dtstart.date()
-    return remind >= delta.days
+
+class UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return ZERO
+
+    def dst(self, dt):
+        return ZERO
+
+    def tzname(self, dt):
+        return 'UTC'
 
 
-def convert_rrule(rrule):
-    """Converts icalendar rrule to dateutil rrule."""
-    args = {}
+utc = UTC()
 
-    # TODO: rrule['freq'] is a list, but I'm unclear as to why.
-    freq = FREQ_MAP[rrule['freq'][0]]
 
-    keys = ['wkst', 'until', 'bysetpos', 'interval',
-            'bymonth', 'bymonthday', 'byyearday', 'byweekno',
-            'byhour', 'byminute', 'bysecond']
+def to_local(date):
+    """Returns date as a naive datetime in the local timezone."""
+    if date.tzinfo is None:
+        return date
+    stamp = calendar.timegm(date.utctimetuple())
+    return datetime.datetime.fromtimestamp(stamp).replace(
+        microsecond=date.microsecond)
 
-    def tweak(rrule, key):
-        value = rrule.get(key)
-        if isinstance(value, list):
-            return value[0]
-        return value
 
-    args = dict((key, tweak(rrule, key)) for key in keys if rrule.get(key))
+def from_local(date):
+    """Returns the naive local datetime date as an aware UTC one."""
+    stamp = time.mktime(date.timetuple())
+    return datetime.datetime.utcfromtimestamp(stamp).replace(
+        microsecond=date.microsecond, tzinfo=utc)
 
-    byweekday = rrule.get('byweekday')
-    if byweekday:
-        byweekday = byweekday[0]
-        count, day = int(byweekday[0]), byweekday[1:]
-        args['byweekday'] = WEEKDAY_MAP[day](count)
 
-    return freq, args
+def get_dtstart(rrule):
+    """Returns the dtstart of an rrule or of the first thing in an
+    rruleset.
 
+    """
+    if hasattr(rrule, '_dtstart'):
+        return rrule._dtstart
+    for rule in rrule._rrule:
+        return rule._dtstart
+    for date in rrule._rdate:
+        return date
+    return None
+
+
+def align_with(date, like):
+    """Returns date as a naive local datetime if like is naive or as
+    an aware one if like is aware, so the two can be compared.
+
+    """
+    if like is None or like.tzinfo is None:
+        return to_local(date)
+    if date.tzinfo is None:
+        return from_local(date)
+    return date
 
-def parse_ics(icsfile):
-    """Takes an icsfilename, parses it, and returns Events."""
-    events = []
 
-    cal = Calendar.from_ical(open(icsfile, 'rb').read())
-    for component in cal.walk('vevent'):
-        dtstart = component['dtstart'].dt
-        rrule = component['rrule']
+def align(date, rrule):
+    """Returns date so it can be compared with rrule's occurrences.
 
-        freq, args = convert_rrule(rrule)
-        args['dtstart'] = dtstart
+    Events with a TZID or a UTC DTSTART have aware occurrences and
+    floating events have naive ones.
 
-        rrule = dateutil.rrule.rrule(freq, **args)
+    """
+    return align_with(date, get_dtstart(rrule))
 
-        summary = vText.from_ical(component.get('summary', u''))
-        description = vText.from_ical(component.get('description', u''))
-        organizer = vText.from_ical(component.get('organizer', u''))
 
-        # TODO: Find an event id.  If it's not there, then compose one
-        # with dtstart, summary, and organizer.
-        event_id = "::".join((str(dtstart), summary, organizer))
+def get_next_date(dtstart, rrule):
+    return rrule.after(align(dtstart, rrule), inc=True)
 
-        events.append(Event(event_id, rrule, summary, description))
-    return events
 
+def should_remind(dtstart, next_date, remind):
+    delta = to_local(next_date).date() - to_local(dtstart).date()
+    return remind >= delta.days
 
-def send_mail_smtp(sender, to_list, subject, body, host, port):
-    server = smtplib.SMTP(host, port)
 
-    sender_name, sender_addr = email.utils.parseaddr(sender)
-    to_list = [email.utils.parseaddr(addr) for addr in to_list]
+def send_mail_smtp(sender, to_list, subject, body, host, port,
+                   delivery='each'):
+    """Sends a single message over its own SMTP connection.
 
-    for to_name, to_addr in to_list:
-        msg = MIMEText(body)
-        msg['To'] = email.utils.formataddr((to_name, to_addr))
-        msg['From'] = email.utils.formataddr((sender_name, sender_addr))
-        msg['Subject'] = subject
-        server.sendmail(sender_addr, [to_addr], msg.as_string())
+    If you're sending more than one message, use a
+    :py:class:`phil.mailer.Mailer` so they share a connection.
 
-    server.quit()
+    """
+    mailer = phil.mailer.Mailer(host, port)
+    try:
+        mailer.send(sender, to_list, subject, body, delivery)
+    finally:
+        mailer.close()
@@ -0,0 +1,236 @@
+#######################################################################
+# This file is part of phil.
+#
+# Copyright (C) 2011, 2012, 2013 Will Kahn-Greene
+#
+# phil is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# phil is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with phil.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+
+"""
+Timezones for TZIDs in ics files.
+
+A Zone is a table of the UTC offset transitions for a VTIMEZONE or an
+Olson zone from pytz.  Its UTC offset depends on the wall-clock time
+it's asked about, so dateutil can step an rrule across DST changes and
+keep the meeting at the same local time.  pytz zones only have the
+right offset for the datetime they localized.
+
+Each zone's table is built once per process and shared by every event
+that uses it.  A pickled Zone is just its name and VTIMEZONE text, so
+the cache doesn't hold a copy of the table per event.
+"""
+
+import bisect
+import datetime
+
+import dateutil.rrule
+
+
+ZERO = datetime.timedelta(0)
+
+# VTIMEZONE rules are expanded up to here.  After that the zone keeps
+# its last offset.
+HORIZON = datetime.datetime(2100, 1, 1)
+
+# Olson name or VTIMEZONE text -> Zone
+_zones = {}
+
+
+class Zone(datetime.tzinfo):
+    """A timezone given by its UTC offset transitions.
+
+    :arg name: the TZID
+    :arg transitions: sorted list of (naive UTC datetime, info) where
+        info is (utcoffset, dst, tzname) from then on
+    :arg initial: the info before the first transition
+    :arg source: the VTIMEZONE text the zone came from or None if it's
+        an Olson zone
+
+    """
+    def __init__(self, name, transitions, initial, source=None):
+        self.name = name
+        self.source = source
+        self._utc = [when for when, info in transitions]
+        self._infos = [initial] + [info for when, info in transitions]
+        # When each transition happens by the clock before it.
+        self._wall = [when + self._infos[i][0]
+                      for i, (when, info) in enumerate(transitions)]
+
+    def _find(self, dt):
+        if dt is None:
+            return self._infos[-1]
+        i = bisect.bisect_right(self._wall, dt.replace(tzinfo=None))
+        return self._infos[i]
+
+    def utcoffset(self, dt):
+        return self._find(dt)[0]
+
+    def dst(self, dt):
+        return self._find(dt)[1]
+
+    def tzname(self, dt):
+        return self._find(dt)[2]
+
+    def fromutc(self, dt):
+        i = bisect.bisect_right(self._utc, dt.replace(tzinfo=None))
+        return dt + self._infos[i][0]
+
+    def __reduce__(self):
+        return load_zone, (self.name, self.source)
+
+    def __repr__(self):
+        return '<Zone {0}>'.format(self.name)
+
+
+def from_pytz(name, tz):
+    """Builds a Zone from a pytz timezone."""
+    times = getattr(tz, '_utc_transition_times', None)
+    if not times:
+        # A zone with one offset, like UTC.
+        dt = datetime.datetime(2000, 1, 1)
+        return Zone(name, [], (tz.utcoffset(dt), tz.dst(dt), tz.tzname(dt)))
+
+    # pytz starts with a transition at the start of time that's really
+    # the zone's first offset.
+    infos = tz._transition_info
+    return Zone(name, zip(times[1:], infos[1:]), infos[0])
+
+
+def unfold(text):
+    lines = []
+    for line in text.splitlines():
+        if line[:1] in (' ', '\t') and lines:
+            lines[-1] += line[1:]
+        elif line:
+            lines.append(line)
+    return lines
+
+
+def get_onsets(component, offset_from):
+    """Returns the local times a STANDARD or DAYLIGHT component starts,
+    up to HORIZON.
+
+    """
+    import icalendar
+
+    dtstart = component['DTSTART'].dt.replace(tzinfo=None)
+    onsets = [dtstart]
+
+    rule = component.get('RRULE')
+    if rule is not None:
+        until = rule.get('UNTIL')
+        until = until and until[0]
+        if until is not None and until.tzinfo is not None:
+            # UNTIL is in UTC.
+            until = until.replace(tzinfo=None) + offset_from
+        args = icalendar.vRecur(
+            dict((key, value) for key, value in rule.items()
+                 if key != 'UNTIL'))
+        rule = dateutil.rrule.rrulestr(args.to_ical(), dtstart=dtstart)
+        for onset in rule:
+            if onset > HORIZON or (until is not None and onset > until):
+                break
+            onsets.append(onset)
+
+    rdates = component.get('RDATE', [])
+    if not isinstance(rdates, list):
+        rdates = [rdates]
+    for rdate in rdates:
+        onsets.extend([dt.dt.replace(tzinfo=None) for dt in rdate.dts])
+
+    return sorted(set(onsets))
+
+
+def from_vtimezone(text):
+    """Builds a Zone from the text of a VTIMEZONE block."""
+    import icalendar.cal
+
+    # icalendar's own VTIMEZONE support needs a newer dateutil, so the
+    # STANDARD and DAYLIGHT components are parsed on their own.
+    name = None
+    blocks = []
+    block = None
+    for line in unfold(text):
+        upper = line.upper()
+        if block is not None:
+            block.append(line)
+            if upper in ('END:STANDARD', 'END:DAYLIGHT'):
+                blocks.append('\r\n'.join(block) + '\r\n')
+                block = None
+        elif upper in ('BEGIN:STANDARD', 'BEGIN:DAYLIGHT'):
+            block = [line]
+        elif upper.startswith('TZID'):
+            name = line.split(':', 1)[1].decode('utf-8')
+    if name is None:
+        raise ValueError('VTIMEZONE has no TZID')
+
+    transitions = []
+    for block in blocks:
+        component = icalendar.cal.Component.from_ical(block)
+        offset_from = component['TZOFFSETFROM'].td
+        offset_to = component['TZOFFSETTO'].td
+        dst = ZERO
+        if component.name == 'DAYLIGHT':
+            dst = offset_to - offset_from
+        tzname = component.get('TZNAME', name)
+        if isinstance(tzname, unicode):
+            tzname = tzname.encode('utf-8')
+        for onset in get_onsets(component, offset_from):
+            transitions.append(
+                (onset - offset_from, (offset_to, dst, str(tzname)),
+                 offset_from))
+    if not transitions:
+        raise ValueError('VTIMEZONE {0} has no offsets'.format(name))
+
+    transitions.sort()
+    initial = (transitions[0][2], ZERO, name.encode('utf-8'))
+    return Zone(name, [(when, info) for when, info, offset_from
+                       in transitions], initial, text)
+
+
+def load_zone(name, source=None):
+    """Returns the Zone for the VTIMEZONE text source or, if there's
+    no source, for an Olson name.  Each zone is built the first time
+    it's asked for.
+
+    :raises pytz.UnknownTimeZoneError: if there's no source and name
+        isn't an Olson zone
+
+    """
+    key = source or name
+    if key not in _zones:
+        if source is None:
+            import pytz
+
+            _zones[key] = from_pytz(name, pytz.timezone(name))
+        else:
+            _zones[key] = from_vtimezone(source)
+    return _zones[key]
+
+
+def get_zone(tzid, defined=None):
+    """Returns the Zone for tzid or None if it's not known.
+
+    :arg defined: dict of TZID -> Zone for the VTIMEZONEs in the ics
+        file; they win over Olson zones with the same name
+
+    """
+    if defined and tzid in defined:
+        return defined[tzid]
+    import pytz
+
+    try:
+        return load_zone(tzid)
+    except (pytz.UnknownTimeZoneError, UnicodeError):
+        return None
@@ -54,7 +54,12 @@ setup(
         "argparse",
         "icalendar",
         "python-dateutil==1.5",  # 2.0 and higher are for python3
+        "pytz",  # TZIDs and %(H@Zone)s placeholders
         ],
+    extras_require={
+        # speeds up expanding occurrences for large calendars
+        "numpy": ["numpy"],
+        },
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Environment :: Console",